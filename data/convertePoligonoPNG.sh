@@ -7,24 +7,12 @@
 # na mesma pasta das imagens. Este script vai converter
 # estas anotações para o formato de máscaras e colocá-las
 # na pasta chamada "anotacoes".
+#
+# Agora apenas chama utilitarios/converte_labelme.py, que desenha
+# as máscaras sem precisar do labelme, usa vários processos e só
+# converte os arquivos .json novos ou modificados (por isso os
+# .json não são mais apagados). Outras opções são repassadas, por
+# exemplo: sh convertePoligonoPNG.sh --classes fundo serpente
 
-mkdir -p anotacoes
-cd imagens
-for imagem in *.json; do
-    echo 'Processando ' $imagem
-    semExtensao="${imagem%.*}"
-    labelme_json_to_dataset $imagem -o ../anotacoes/$imagem
-    cd ../anotacoes
-    mv $imagem/label.png .
-    nomePNG=${semExtensao}.png
-    mv label.png $nomePNG
-    rm -rf ./$imagem/
-    cd ../imagens
-done   
-
-# Apagar os arquivos json originais
-rm *.json
-cd ..
-echo 'Terminei...'
-   
-
+pasta_projeto="$(cd "$(dirname "$0")/.." && pwd)"
+PYTHONPATH="$pasta_projeto${PYTHONPATH:+:$PYTHONPATH}" exec python -m utilitarios.converte_labelme "$@"
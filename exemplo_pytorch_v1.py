@@ -9,7 +9,7 @@ Traduzido e adaptado do site oficial do python: https://pytorch.org/tutorials/be
 
 import torch   # Biblioteca pytorch principal
 from torch import nn  # Módulo para redes neurais (neural networks)
-from torch.utils.data import DataLoader # Manipulação de bancos de imagens
+from utilitarios.carregadores import cria_dataloader # Manipulação de bancos de imagens
 from torchvision import datasets # Ajuda a importar alguns bancos já prontos e famosos
 from torchvision.transforms import ToTensor # Realiza transformações nas imagens
 import matplotlib.pyplot as plt # Mostra imagens e gráficos
@@ -17,6 +17,11 @@ import matplotlib.pyplot as plt # Mostra imagens e gráficos
 # Definindo alguns hiperparâmetros importantes:
 epocas = 10  # Total de passagens durante a aprendizagem pelo conjunto de imagens
 tamanho_lote = 64  # Tamanho de cada lote sobre o qual é calculado o gradiente
+processos_carregamento = None  # Total de processos que carregam as imagens em
+                               # paralelo. None = escolhe pelo total de núcleos,
+                               # "auto" = testa alguns valores e usa o mais rápido
+intervalo_log = 100  # Mostra a perda do treinamento a cada "intervalo_log" lotes
+                     # (cada vez que mostra, o processamento espera a GPU terminar)
 taxa_aprendizagem = 0.001   # Magnitude das alterações nos pesos
 
 # Definindo os dados para treinamento da rede neural
@@ -37,8 +42,10 @@ val_data = datasets.FashionMNIST(
 )
 
 # Cria os objetos que irão manipular os dados
-train_dataloader = DataLoader(training_data, batch_size=tamanho_lote)
-val_dataloader = DataLoader(val_data, batch_size=tamanho_lote)
+train_dataloader = cria_dataloader(training_data, tamanho_lote,
+                                   num_workers=processos_carregamento)
+val_dataloader = cria_dataloader(val_data, tamanho_lote,
+                                 num_workers=processos_carregamento)
 
 # Mostra informações do primeiro lote de imagens 
 # X vai conter um lote de imagens
@@ -170,8 +177,8 @@ def train(dataloader, model, loss_fn, optimizer):
         loss.backward()        # Retropropaga o gradiente do erro
         optimizer.step()       # e recalcula todos os pesos da rede
 
-        # Imprime informação a cada 100 lotes processados 
-        if batch % 100 == 0:
+        # Imprime informação a cada "intervalo_log" lotes processados
+        if batch % intervalo_log == 0:
             # Mostra a perda e o total de imagens já processadas
             loss, current = loss.item(), batch * len(X)
             print(f"Perda: {loss:>7f}  [{current:>5d}/{size:>5d}]")
@@ -182,7 +189,9 @@ def validation(dataloader, model, loss_fn):
     num_batches = len(dataloader)   # Total de lotes
     model.eval()  # Coloca a rede em modo de avaliação (e não de aprendizagem)
     # Vai calcular o erro no conjunto de validação
-    val_loss, correct = 0, 0
+    # Ficam no dispositivo (GPU ou CPU) e só são lidos no final
+    val_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.int64, device=device)
 
     # Na validação os pesos não são ajustados e por isso não precisa
     # calcular o gradiente
@@ -190,11 +199,11 @@ def validation(dataloader, model, loss_fn):
         for X, y in dataloader:
             X, y = X.to(device), y.to(device)
             pred = model(X)
-            val_loss += loss_fn(pred, y).item()
-            correct += (pred.argmax(1) == y).type(torch.float).sum().item()
+            val_loss += loss_fn(pred, y)
+            correct += (pred.argmax(1) == y).sum()
 
-    val_loss /= num_batches
-    acuracia = correct / size
+    val_loss = val_loss.item() / num_batches
+    acuracia = correct.item() / size
     print("Informações na Validação:")
     print(f"Total de acertos: {int(correct)}")
     print(f"Total de imagens: {size}")
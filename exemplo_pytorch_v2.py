@@ -18,7 +18,11 @@ Mudanças desta versão:
 
 import torch   # Biblioteca pytorch principal
 from torch import nn  # Módulo para redes neurais (neural networks)
-from torch.utils.data import DataLoader # Manipulação de bancos de imagens
+from utilitarios.carregadores import cria_dataloader # Manipulação de bancos de imagens
+from utilitarios.checkpoint import (GravadorCheckpoint, monta_checkpoint, retoma_checkpoint,
+                                   nome_checkpoint, descarta_checkpoint) # Checkpoints
+from utilitarios.fragmentos import prepara_fragmentos # Imagens em poucos arquivos grandes
+from utilitarios.avaliacao import avalia_classificacao # Avaliação em lotes
 from torchvision import datasets # Ajuda a importar alguns bancos já prontos e famosos
 from torchvision.transforms import ToTensor # Realiza transformações nas imagens
 import torchvision.transforms as transforms
@@ -26,18 +30,27 @@ import matplotlib.pyplot as plt # Mostra imagens e gráficos
 from torch.utils.tensorboard import SummaryWriter # Salva "log" da aprendizagem
 import torchvision
 import PIL  # Biblioteca para manipulação de imagens
-import sklearn.metrics as metrics  # Ajuda a calcular métricas de desempenho
-from sklearn.metrics import precision_recall_fscore_support as score
-import seaborn as sn  # Usado para gerar um mapa de calor para a matriz de confusão
-import pandas as pd   # Ajuda a trabalhar com tabelas
 import numpy as np    # Várias funções numéricas
 
 # Definindo alguns hiperparâmetros importantes:
 epocas = 50  # Total de passagens durante a aprendizagem pelo conjunto de imagens
 tamanho_lote = 64  # Tamanho de cada lote sobre o qual é calculado o gradiente
+processos_carregamento = None  # Total de processos que carregam as imagens em
+                               # paralelo. None = escolhe pelo total de núcleos,
+                               # "auto" = testa alguns valores e usa o mais rápido
+intervalo_log = 100  # Mostra a perda do treinamento a cada "intervalo_log" lotes
+                     # (cada vez que mostra, o processamento espera a GPU terminar)
 taxa_aprendizagem = 0.001   # Magnitude das alterações nos pesos
 paciencia = 5  # Total de épocas sem melhoria da acurácia na validação até parar
 tolerancia = 0.01 # Melhoria menor que este valor não é considerada melhoria
+retomar = False  # True = se existir o checkpoint de um treinamento interrompido
+                 # com os mesmos hiperparâmetros, continua de onde parou
+                 # (False = começa do zero)
+intervalo_checkpoint = 1  # Salva o estado completo do treinamento a cada
+                          # "intervalo_checkpoint" épocas
+usar_fragmentos = False  # True = decodifica e redimensiona as imagens da pasta
+                         # uma única vez e as guarda em poucos arquivos grandes
+                         # (ver utilitarios/fragmentos.py)
 
 # As imagens de teste, que eu peguei da Internet e não estão nem no conjunto
 # de treinamento e nem de validação, ficarão nesta pasta:
@@ -62,8 +75,10 @@ val_data = datasets.FashionMNIST(
 
 # Cria os objetos que irão manipular os dados (basicamente ajuda a pegar
 # lote (batch) de imagens de treinamento e de validação)
-train_dataloader = DataLoader(training_data, batch_size=tamanho_lote)
-val_dataloader = DataLoader(val_data, batch_size=tamanho_lote)
+train_dataloader = cria_dataloader(training_data, tamanho_lote,
+                                   num_workers=processos_carregamento)
+val_dataloader = cria_dataloader(val_data, tamanho_lote,
+                                 num_workers=processos_carregamento)
 
 # Mostra informações do primeiro lote de imagens 
 # X vai conter um lote de imagens
@@ -187,7 +202,10 @@ def train(dataloader, model, loss_fn, optimizer):
     num_batches = len(dataloader)   # Total de lotes
     model.train()  # Avisa que a rede vai entrar em modo de aprendizagem
 
-    train_loss, train_correct = 0, 0  # Usado para calcular perda e acurácia médias
+    # Usado para calcular perda e acurácia médias. Ficam no dispositivo (GPU ou
+    # CPU) para não precisar esperar a GPU a cada lote. Só são lidos no final.
+    train_loss = torch.zeros((), device=device)
+    train_correct = torch.zeros((), dtype=torch.int64, device=device)
 
     # Pega um lote de imagens de cada vez do conjunto de treinamento
     for batch, (X, y) in enumerate(dataloader):
@@ -196,25 +214,26 @@ def train(dataloader, model, loss_fn, optimizer):
         pred = model(X)         # Realiza uma previsão usando os pesos atuais
         loss = loss_fn(pred, y) # Calcula o erro com os pesos atuais
 
-        train_loss += loss_fn(pred, y).item() # Guarda para calcular a perda média
+        train_loss += loss.detach() # Guarda para calcular a perda média
         # Calcula os acertos para o lote inteiro de imagens
-        train_correct += (pred.argmax(1) == y).type(torch.float).sum().item() 
+        train_correct += (pred.argmax(1) == y).sum()
 
         optimizer.zero_grad()  # Zera os gradientes pois vai acumular para todas
                                # as imagens do lote
         loss.backward()        # Calcula os gradientes com base no erro (loss)
         optimizer.step()       # Ajusta os pesos com base nos gradientes
 
-        # Imprime informação a cada 100 lotes processados 
-        if batch % 100 == 0:
+        # Imprime informação a cada "intervalo_log" lotes processados
+        if batch % intervalo_log == 0:
             # Mostra a perda e o total de imagens já processadas
             loss, current = loss.item(), batch * len(X)
             print(f"Perda: {loss:>7f}  [{current:>5d}/{size:>5d}]")
 
-    train_loss /= num_batches  # Como a perda foi calculada por lote, divide
-                               # pelo total de lotes para calcular a média
-    train_acuracia = train_correct / size  # Já o total de acertos é em relação
-                                           # ao total geral de imagens
+    # Como a perda foi calculada por lote, divide pelo total de lotes para
+    # calcular a média (só aqui o valor sai do dispositivo)
+    train_loss = train_loss.item() / num_batches
+    train_acuracia = train_correct.item() / size  # Já o total de acertos é em
+                                                  # relação ao total geral de imagens
 
     return train_loss, train_acuracia        
 
@@ -227,7 +246,9 @@ def validation(dataloader, model, loss_fn):
     model.eval()  # Coloca a rede em modo de avaliação (e não de aprendizagem)
     
     # Vai calcular a perda e o total de acertos no conjunto de validação
-    val_loss, val_correct = 0, 0
+    # Ficam no dispositivo (GPU ou CPU) e só são lidos no final
+    val_loss = torch.zeros((), device=device)
+    val_correct = torch.zeros((), dtype=torch.int64, device=device)
 
     # Na validação os pesos não são ajustados e por isso não precisa
     # calcular o gradiente
@@ -235,11 +256,11 @@ def validation(dataloader, model, loss_fn):
         for X, y in dataloader:
             X, y = X.to(device), y.to(device)
             pred = model(X)
-            val_loss += loss_fn(pred, y).item()
-            val_correct += (pred.argmax(1) == y).type(torch.float).sum().item()
+            val_loss += loss_fn(pred, y)
+            val_correct += (pred.argmax(1) == y).sum()
 
-    val_loss /= num_batches
-    val_acuracia = val_correct / size
+    val_loss = val_loss.item() / num_batches
+    val_acuracia = val_correct.item() / size
 
     print("Informações na Validação:")
     print(f"Total de acertos: {int(val_correct)}")
@@ -255,9 +276,31 @@ def validation(dataloader, model, loss_fn):
 maior_acuracia = 0  # Guarda a melhor acurácia no conjunto de validação
 total_sem_melhora = 0  # Guarda quantas épocas passou sem melhoria na acurácia
 
+# O estado completo do treinamento (rede, otimizador, época, variáveis da
+# parada antecipada e dos números aleatórios) é salvo em segundo plano, sem
+# parar o treinamento para esperar o disco (ver utilitarios/checkpoint.py)
+gravador = GravadorCheckpoint()
+# O arquivo do checkpoint depende dos hiperparâmetros abaixo: um treinamento
+# com outros valores não continua o checkpoint deste (e vice-versa). O
+# checkpoint é apagado quando o treinamento termina.
+config_treino = {'tamanho_lote': tamanho_lote, 'taxa_aprendizagem': taxa_aprendizagem,
+                 'usar_fragmentos': usar_fragmentos}
+arquivo_checkpoint = nome_checkpoint("checkpoint", config_treino)
+epoca_inicial = 0
+if retomar:
+    retomado = retoma_checkpoint(arquivo_checkpoint, model, otimizador, device=device,
+                                 config=config_treino)
+    if retomado is not None:
+        epoca_inicial, variaveis = retomado
+        maior_acuracia = variaveis['maior_acuracia']
+        total_sem_melhora = variaveis['total_sem_melhora']
+        print(f"Continuando o treinamento interrompido a partir da época {epoca_inicial+1}")
+        if variaveis['terminou']:
+            epoca_inicial = epocas  # Já tinha acabado a paciência
+
 # Passa por todas as imagens várias vezes (a quantidade de vezes
 # é definida pelo hiperparâmetro "epocas")
-for epoca in range(epocas):
+for epoca in range(epoca_inicial, epocas):
     print(f"-------------------------------")
     print(f"Época {epoca+1} \n-------------------------------")
     train_loss, train_acuracia = train(train_dataloader, model, funcao_perda, otimizador)
@@ -275,10 +318,20 @@ for epoca in range(epocas):
     else: 
       total_sem_melhora += 1 
       print(f"Sem melhora há {total_sem_melhora} épocas ({100*val_acuracia}% <= {100*(maior_acuracia+tolerancia)}%)")
-    if total_sem_melhora > paciencia:
+    terminou = total_sem_melhora > paciencia
+    # Salva o estado completo do treinamento (em segundo plano)
+    if (epoca+1) % intervalo_checkpoint == 0 or terminou or epoca+1 == epocas:
+      gravador.salva(arquivo_checkpoint,
+                     monta_checkpoint(epoca+1, model, otimizador,
+                                      {'maior_acuracia': maior_acuracia,
+                                       'total_sem_melhora': total_sem_melhora,
+                                       'terminou': terminou}, config=config_treino))
+    if terminou:
       print(f"Acabou a paciência com {epoca+1} épocas ")
       break
 
+gravador.fecha()  # Espera terminar a gravação dos arquivos
+descarta_checkpoint(arquivo_checkpoint)  # Terminou: o próximo treinamento começa do zero
 print("Terminou a fase de aprendizagem !")
 
 writer.close()
@@ -307,8 +360,9 @@ print("Salvou o modelo treinado em modelo_treinado.pth")
 
 """
 
-model = NeuralNetwork()
-model.load_state_dict(torch.load("modelo_treinado.pth"))
+# A rede fica no mesmo dispositivo (GPU ou CPU) usado na avaliação em lotes
+model = NeuralNetwork().to(device)
+model.load_state_dict(torch.load("modelo_treinado.pth", map_location=device))
 
 """## Usando a rede treinada para classificar algumas imagens 
 
@@ -334,7 +388,7 @@ Usando um conjunto de teste próprio que será lido do disco. As imagens são um
 def classifica_uma_imagem(model,x,y):
     model.eval()
     with torch.no_grad():
-       pred = model(x)
+       pred = model(x.to(device))
        predita, real = labels_map[int(pred[0].argmax(0))], labels_map[y]
        print(f'Predita: "{predita}", Real: "{real}"')
     return(predita)
@@ -347,14 +401,19 @@ def invert(image: PIL.Image.Image) -> PIL.Image.Image:
 
 # Carrega o banco de imagens de teste aplicando as transformações
 # necessárias
-test_data = datasets.ImageFolder(root=pasta_imagens_teste,
-                                    transform=transforms.Compose(
-                                        [  transforms.Resize((28,28)),
-                                           transforms.Grayscale(num_output_channels=1),
-                                           transforms.Lambda(invert),
-                                           transforms.ToTensor(),
-                                        ])
-                                 ) 
+if usar_fragmentos:
+    # Mesmas transformações, feitas uma única vez (28x28, cinza, invertida)
+    test_data = prepara_fragmentos(pasta_imagens_teste, "data/fragmentos_FashionMNIST_custom_testset/",
+                                   28, 28, modo='L', inverte=True)
+else:
+    test_data = datasets.ImageFolder(root=pasta_imagens_teste,
+                                        transform=transforms.Compose(
+                                            [  transforms.Resize((28,28)),
+                                               transforms.Grayscale(num_output_channels=1),
+                                               transforms.Lambda(invert),
+                                               transforms.ToTensor(),
+                                            ])
+                                     ) 
 
 # Vai mostrar a classificação da rede para 16 imagens do conjunto de teste
 figure = plt.figure(figsize=(8, 8))  # Cria o local para mostrar as imagens
@@ -378,31 +437,26 @@ plt.show() # Este é o comando que vai mostrar as imagens
 
 """## Gera matriz de confusão e algumas métricas de avaliação"""
 
-# Listas para guardar valores preditos e reais
-predicoes = []
-reais = []
-
-# Vai acumular acertos para calcular acurácia
-test_correct=0
+# Passa o conjunto de teste inteiro pela rede, em lotes. As predições ficam
+# no dispositivo (GPU ou CPU) e são acumuladas em uma matriz de confusão
+lote_teste = cria_dataloader(test_data, tamanho_lote,
+                             num_workers=processos_carregamento)
+matriz_confusao = avalia_classificacao(model, lote_teste, len(labels_map), device)
 
-model.eval() # Coloca a rede no modo de avaliação (e não de aprendizagem)
-with torch.no_grad():   # Avisa que não devem ser calculados gradientes
-   for img, label in test_data:   # Para cada imagem do conjunto de teste
-      predicao = model(img)       # Faz a predição usando a rede
-      predicao = int(predicao[0].argmax(0))  # Pega a classe com maior valor
-      predicoes.extend([predicao]) # Guarda predição na lista
-      reais.extend([label])        # Guarda valor real na lista
-      test_correct += (predicao == label)
-
-# Acurácia no conjunto de teste
-test_acuracia = test_correct/len(test_data)
-
-# Constroi a matriz de confusão
-matriz = metrics.confusion_matrix(reais,predicoes)
+# Calcula todas as métricas a partir da matriz de confusão
+resultados = matriz_confusao.calcula()
+matriz = resultados['matriz']
+test_correct = np.trace(matriz)  # Total de imagens classificadas corretamente
+test_acuracia = resultados['acuracia']  # Acurácia no conjunto de teste
 
 # Pega a lista de classes 
 classes=list(labels_map.values())
 
+# Bibliotecas usadas apenas para o mapa de calor. São importadas só aqui
+# para não atrasar o início do exemplo.
+import seaborn as sn  # Usado para gerar um mapa de calor para a matriz de confusão
+import pandas as pd   # Ajuda a trabalhar com tabelas
+
 # Transforma a matriz no formato da biblioteca PANDA
 df_matriz = pd.DataFrame(matriz/np.sum(matriz), index = classes,
                      columns = [i for i in classes])
@@ -413,9 +467,11 @@ sn.heatmap(df_matriz, annot=True)
 plt.savefig('matriz_confusao.png')
 
 print('Métricas de desempenho no conjunto de teste:')
-print(metrics.classification_report(reais,predicoes))
+print(matriz_confusao.relatorio())
 
-precision,recall,fscore,support=score(reais,predicoes,average='macro')
+precision = resultados['precisao_macro']
+recall = resultados['revocacao_macro']
+fscore = resultados['fscore_macro']
 print('-----------------------------------')
 print(f'Resumo para as {len(test_data)} imagens de teste:')
 print(f"Acertos: {int(test_correct)}")
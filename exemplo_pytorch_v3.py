@@ -13,7 +13,12 @@ Mudanças nesta versão:
 
 import torch   # Biblioteca pytorch principal
 from torch import nn  # Módulo para redes neurais (neural networks)
-from torch.utils.data import DataLoader # Manipulação de bancos de imagens
+from utilitarios.carregadores import cria_dataloader # Manipulação de bancos de imagens
+from utilitarios.checkpoint import (GravadorCheckpoint, monta_checkpoint, retoma_checkpoint,
+                                   nome_checkpoint, descarta_checkpoint) # Checkpoints
+from utilitarios.avaliacao import avalia_classificacao # Avaliação em lotes
+from utilitarios.precisao import ModoDesempenho, registra_e_compara # Precisão mista
+from utilitarios.transformacoes_lote import amplia_lote_cinza # Transformações no lote
 from torchvision import datasets,models # Ajuda a importar alguns bancos e
                                         # e modelos já prontos e famosos
 import torchvision.transforms as transforms
@@ -21,20 +26,27 @@ import matplotlib.pyplot as plt # Mostra imagens e gráficos
 from torch.utils.tensorboard import SummaryWriter # Salva "log" da aprendizagem
 import torchvision
 import PIL  # Biblioteca para manipulação de imagens
-import sklearn.metrics as metrics  # Ajuda a calcular métricas de desempenho
-from sklearn.metrics import precision_recall_fscore_support as score
-import seaborn as sn  # Usado para gerar um mapa de calor para a matriz de confusão
-import pandas as pd   # Ajuda a trabalhar com tabelas
 import numpy as np    # Várias funções numéricas
+import time  # Mede a velocidade do treinamento
 
 # Definindo alguns hiperparâmetros importantes:
 epocas = 50  # Total de passagens durante a aprendizagem pelo conjunto de imagens
 tamanho_lote = 64  # Tamanho de cada lote sobre o qual é calculado o gradiente
+processos_carregamento = None  # Total de processos que carregam as imagens em
+                               # paralelo. None = escolhe pelo total de núcleos,
+                               # "auto" = testa alguns valores e usa o mais rápido
+intervalo_log = 100  # Mostra a perda do treinamento a cada "intervalo_log" lotes
+                     # (cada vez que mostra, o processamento espera a GPU terminar)
 taxa_aprendizagem = 0.001   # Magnitude das alterações nos pesos
 momento = 0.9  # Mantem informação de pesos anteriores (as mudanças de
                # de peso passam a ser mais suaves)
 paciencia = 3  # Total de épocas sem melhoria da acurácia na validação até parar
 tolerancia = 0.01 # Melhoria menor que este valor não é considerada melhoria
+retomar = False  # True = se existir o checkpoint de um treinamento interrompido
+                 # com os mesmos hiperparâmetros, continua de onde parou
+                 # (False = começa do zero)
+intervalo_checkpoint = 1  # Salva o estado completo do treinamento a cada
+                          # "intervalo_checkpoint" épocas
 
 # As imagens de teste, que eu peguei da Internet e não estão nem no conjunto
 # de treinamento e nem de validação, ficarão nesta pasta:
@@ -44,6 +56,12 @@ pasta_imagens_teste = "data/FashionMNIST_custom_testset/"
 # Opções atuais: "resnet", "squeezenet", "densenet"
 nome_rede = "resnet"
 tamanho_imagens = 224  # Tamanho das imagens para estas arquiteturas
+
+# Modo de desempenho (ver utilitarios/precisao.py)
+precisao = "fp32"  # "fp32" = padrão, "bf16" = bfloat16 (CPU ou GPU recente),
+                   # "fp16" = float16 (apenas GPU, escala a perda automaticamente)
+canais_no_fim = False  # True = guarda rede e imagens no formato channels_last
+                       # (NHWC), mais rápido nas convoluções
                        
 
 
@@ -54,16 +72,12 @@ training_data = datasets.FashionMNIST(
     root="data",  # Pasta onde ficarão os dados
     train=True,   # Usa apenas dados de treinamento
     download=True,  # Faz download dos dados pela Internet
-    # Realiza transformações para deixar a imagem no formato necessário
-    # em que a rede foi pré-treinada (RGB e com outro tamanho). Retirei
-    # a normalização pois as imagens originais não eram coloridas e a normalização
-    # só iria atrapalhar.
-    transform=transforms.Compose(
-              [transforms.Resize((tamanho_imagens,tamanho_imagens)),
-               transforms.ToTensor(),
-               transforms.Lambda(lambda x: x.repeat(3, 1, 1) ),
-#               transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-              ])
+    # Mantém a imagem pequena (28x28, tons de cinza, uint8). As transformações
+    # para o formato em que a rede foi pré-treinada (RGB e com outro tamanho)
+    # são feitas no lote inteiro, já no dispositivo (ver amplia_lote_cinza).
+    # Retirei a normalização pois as imagens originais não eram coloridas e a
+    # normalização só iria atrapalhar.
+    transform=transforms.PILToTensor()
 )
 
 # Definindo os dados para validação da rede neural
@@ -71,27 +85,26 @@ val_data = datasets.FashionMNIST(
     root="data",
     train=False,
     download=True,
-    # Realiza transformações para deixar a imagem no formato necessário
-    # em que a rede foi pré-treinada (RGB e com outro tamanho). Retirei
-    # a normalização pois as imagens originais não eram coloridas e a normalização
-    # só iria atrapalhar.
-    transform=transforms.Compose(
-              [transforms.Resize((tamanho_imagens,tamanho_imagens)),
-               transforms.ToTensor(),
-               transforms.Lambda(lambda x: x.repeat(3, 1, 1) ),
-#               transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-              ])
+    # Mantém a imagem pequena (28x28, tons de cinza, uint8). As transformações
+    # para o formato em que a rede foi pré-treinada (RGB e com outro tamanho)
+    # são feitas no lote inteiro, já no dispositivo (ver amplia_lote_cinza).
+    # Retirei a normalização pois as imagens originais não eram coloridas e a
+    # normalização só iria atrapalhar.
+    transform=transforms.PILToTensor()
 )
 
 # Cria os objetos que irão manipular os dados (basicamente ajuda a pegar
 # lote (batch) de imagens de treinamento e de validação)
-train_dataloader = DataLoader(training_data, batch_size=tamanho_lote)
-val_dataloader = DataLoader(val_data, batch_size=tamanho_lote)
+train_dataloader = cria_dataloader(training_data, tamanho_lote,
+                                   num_workers=processos_carregamento)
+val_dataloader = cria_dataloader(val_data, tamanho_lote,
+                                 num_workers=processos_carregamento)
 
 # Mostra informações do primeiro lote de imagens 
 # X vai conter um lote de imagens
 # y vai conter as classes (tipo de vestimenta) de cada imagem do lote
 for X, y in val_dataloader:
+    X = amplia_lote_cinza(X, tamanho_imagens)  # Formato que a rede vai receber
     print(f"Tamanho do lote de imagens: {X.shape[0]}")
     print(f"Quantidade de canais: {X.shape[1]}")
     print(f"Altura de cada imagem: {X.shape[2]}")
@@ -133,9 +146,8 @@ for i in range(1, cols * rows + 1):
     plt.title(labels_map[label])
     # Não mostra valores para os eixos X e Y
     plt.axis("off")
-    # Tem que ajustar a ordem das dimensões do tensor para que os canais
-    # fiquem na última dimensão (e não ma primeira)
-    plt.imshow(img.permute(1,2,0))
+    # A imagem ainda tem um único canal (tons de cinza), que é retirado
+    plt.imshow(img.squeeze(), cmap="gray")
     
 plt.show() # Este é o comando que vai mostrar as imagens
 
@@ -167,6 +179,10 @@ elif nome_rede == "densenet":
 
 # Prepara a rede para o dispositivo que irá processá-la
 model = model.to(device)
+# Ajusta o formato de memória da rede para o modo de desempenho escolhido
+modo = ModoDesempenho(device, precisao, canais_no_fim)
+model = modo.prepara_modelo(model)
+print(f"Modo de desempenho: {modo.nome}")
 
 # Imprime dados sobre a arquitetura da rede
 print(model)
@@ -190,34 +206,40 @@ def train(dataloader, model, loss_fn, optimizer):
     num_batches = len(dataloader)   # Total de lotes
     model.train()  # Avisa que a rede vai entrar em modo de aprendizagem
 
-    train_loss, train_correct = 0, 0  # Usado para calcular perda e acurácia médias
+    # Usado para calcular perda e acurácia médias. Ficam no dispositivo (GPU ou
+    # CPU) para não precisar esperar a GPU a cada lote. Só são lidos no final.
+    train_loss = torch.zeros((), device=device)
+    train_correct = torch.zeros((), dtype=torch.int64, device=device)
 
     # Pega um lote de imagens de cada vez do conjunto de treinamento
     for batch, (X, y) in enumerate(dataloader):
 
         X, y = X.to(device), y.to(device)  # Prepara os dados para o dispositivo (GPU ou CPU)
-        pred = model(X)         # Realiza uma previsão usando os pesos atuais
-        loss = loss_fn(pred, y) # Calcula o erro com os pesos atuais
+        X = amplia_lote_cinza(X, tamanho_imagens)  # 28x28 cinza -> 224x224 RGB
+        X = modo.prepara_entrada(X)  # Formato de memória do modo de desempenho
+        with modo.autocast():  # Usa a precisão do modo de desempenho
+            pred = model(X)         # Realiza uma previsão usando os pesos atuais
+            loss = loss_fn(pred, y) # Calcula o erro com os pesos atuais
 
-        train_loss += loss_fn(pred, y).item() # Guarda para calcular a perda média
+        train_loss += loss.detach() # Guarda para calcular a perda média
         # Calcula os acertos para o lote inteiro de imagens
-        train_correct += (pred.argmax(1) == y).type(torch.float).sum().item() 
+        train_correct += (pred.argmax(1) == y).sum()
 
-        optimizer.zero_grad()  # Zera os gradientes pois vai acumular para todas
-                               # as imagens do lote
-        loss.backward()        # Calcula os gradientes com base no erro (loss)
-        optimizer.step()       # Ajusta os pesos com base nos gradientes
+        # Calcula os gradientes com base no erro (loss), ajusta os pesos e
+        # zera os gradientes (escalando a perda se a precisão for fp16)
+        modo.passo(loss, optimizer)
 
-        # Imprime informação a cada 100 lotes processados 
-        if batch % 100 == 0:
+        # Imprime informação a cada "intervalo_log" lotes processados
+        if batch % intervalo_log == 0:
             # Mostra a perda e o total de imagens já processadas
             loss, current = loss.item(), batch * len(X)
             print(f"Perda: {loss:>7f}  [{current:>5d}/{size:>5d}]")
 
-    train_loss /= num_batches  # Como a perda foi calculada por lote, divide
-                               # pelo total de lotes para calcular a média
-    train_acuracia = train_correct / size  # Já o total de acertos é em relação
-                                           # ao total geral de imagens
+    # Como a perda foi calculada por lote, divide pelo total de lotes para
+    # calcular a média (só aqui o valor sai do dispositivo)
+    train_loss = train_loss.item() / num_batches
+    train_acuracia = train_correct.item() / size  # Já o total de acertos é em
+                                                  # relação ao total geral de imagens
 
     return train_loss, train_acuracia        
 
@@ -230,19 +252,24 @@ def validation(dataloader, model, loss_fn):
     model.eval()  # Coloca a rede em modo de avaliação (e não de aprendizagem)
     
     # Vai calcular a perda e o total de acertos no conjunto de validação
-    val_loss, val_correct = 0, 0
+    # Ficam no dispositivo (GPU ou CPU) e só são lidos no final
+    val_loss = torch.zeros((), device=device)
+    val_correct = torch.zeros((), dtype=torch.int64, device=device)
 
     # Na validação os pesos não são ajustados e por isso não precisa
     # calcular o gradiente
     with torch.no_grad():
         for X, y in dataloader:
             X, y = X.to(device), y.to(device)
-            pred = model(X)
-            val_loss += loss_fn(pred, y).item()
-            val_correct += (pred.argmax(1) == y).type(torch.float).sum().item()
+            X = amplia_lote_cinza(X, tamanho_imagens)
+            X = modo.prepara_entrada(X)
+            with modo.autocast():
+                pred = model(X)
+                val_loss += loss_fn(pred, y)
+            val_correct += (pred.argmax(1) == y).sum()
 
-    val_loss /= num_batches
-    val_acuracia = val_correct / size
+    val_loss = val_loss.item() / num_batches
+    val_acuracia = val_correct.item() / size
 
     print("Informações na Validação:")
     print(f"Total de acertos: {int(val_correct)}")
@@ -257,13 +284,42 @@ def validation(dataloader, model, loss_fn):
 
 maior_acuracia = 0  # Guarda a melhor acurácia no conjunto de validação
 total_sem_melhora = 0  # Guarda quantas épocas passou sem melhoria na acurácia
+tempo_treino, imagens_treino = 0, 0  # Para calcular a velocidade do treinamento
+
+# O estado completo do treinamento (rede, otimizador, época, variáveis da
+# parada antecipada e dos números aleatórios) é salvo em segundo plano, sem
+# parar o treinamento para esperar o disco (ver utilitarios/checkpoint.py)
+gravador = GravadorCheckpoint()
+# O arquivo do checkpoint depende dos hiperparâmetros abaixo: um treinamento
+# com outros valores não continua o checkpoint deste (e vice-versa). O
+# checkpoint é apagado quando o treinamento termina.
+config_treino = {'nome_rede': nome_rede, 'tamanho_imagens': tamanho_imagens,
+                 'tamanho_lote': tamanho_lote, 'taxa_aprendizagem': taxa_aprendizagem,
+                 'momento': momento, 'precisao': precisao, 'canais_no_fim': canais_no_fim}
+arquivo_checkpoint = nome_checkpoint("checkpoint_"+nome_rede, config_treino)
+epoca_inicial = 0
+if retomar:
+    retomado = retoma_checkpoint(arquivo_checkpoint, model, otimizador, modo.escalador, device=device,
+                                 config=config_treino)
+    if retomado is not None:
+        epoca_inicial, variaveis = retomado
+        maior_acuracia = variaveis['maior_acuracia']
+        total_sem_melhora = variaveis['total_sem_melhora']
+        tempo_treino = variaveis['tempo_treino']
+        imagens_treino = variaveis['imagens_treino']
+        print(f"Continuando o treinamento interrompido a partir da época {epoca_inicial+1}")
+        if variaveis['terminou']:
+            epoca_inicial = epocas  # Já tinha acabado a paciência
 
 # Passa por todas as imagens várias vezes (a quantidade de vezes
 # é definida pelo hiperparâmetro "epocas")
-for epoca in range(epocas):
+for epoca in range(epoca_inicial, epocas):
     print(f"-------------------------------")
     print(f"Época {epoca+1} \n-------------------------------")
+    inicio = time.perf_counter()
     train_loss, train_acuracia = train(train_dataloader, model, funcao_perda, otimizador)
+    tempo_treino += time.perf_counter() - inicio
+    imagens_treino += len(train_dataloader.dataset)
     val_loss, val_acuracia = validation(val_dataloader, model, funcao_perda)
 
     # Guarda informações para o tensorboard pode criar os gráficos depois
@@ -278,12 +334,29 @@ for epoca in range(epocas):
     else: 
       total_sem_melhora += 1 
       print(f"Sem melhora há {total_sem_melhora} épocas ({100*val_acuracia}% <= {100*(maior_acuracia+tolerancia)}%)")
-    if total_sem_melhora > paciencia:
+    terminou = total_sem_melhora > paciencia
+    # Salva o estado completo do treinamento (em segundo plano)
+    if (epoca+1) % intervalo_checkpoint == 0 or terminou or epoca+1 == epocas:
+      gravador.salva(arquivo_checkpoint,
+                     monta_checkpoint(epoca+1, model, otimizador,
+                                      {'maior_acuracia': maior_acuracia,
+                                       'total_sem_melhora': total_sem_melhora,
+                                       'tempo_treino': tempo_treino,
+                                       'imagens_treino': imagens_treino,
+                                       'terminou': terminou}, modo.escalador, config=config_treino))
+    if terminou:
       print(f"Acabou a paciência com {epoca+1} épocas ")
       break
 
+gravador.fecha()  # Espera terminar a gravação dos arquivos
+descarta_checkpoint(arquivo_checkpoint)  # Terminou: o próximo treinamento começa do zero
 print("Terminou a fase de aprendizagem !")
 
+# Mostra a velocidade e a melhor acurácia deste modo de desempenho e, se
+# já existir um treinamento em fp32 desta rede, a diferença para ele
+registra_e_compara("desempenho_modos.json", nome_rede, modo,
+                   imagens_treino/tempo_treino, maior_acuracia)
+
 writer.close()
 
 """## Visualização usando Tensorboard
@@ -383,32 +456,26 @@ plt.show() # Este é o comando que vai mostrar as imagens
 
 """## Gera matriz de confusão e algumas métricas de avaliação"""
 
-# Listas para guardar valores preditos e reais
-predicoes = []
-reais = []
-
-# Vai acumular acertos para calcular acurácia
-test_correct=0
+# Passa o conjunto de teste inteiro pela rede, em lotes. As predições ficam
+# no dispositivo (GPU ou CPU) e são acumuladas em uma matriz de confusão
+lote_teste = cria_dataloader(test_data, tamanho_lote,
+                             num_workers=processos_carregamento)
+matriz_confusao = avalia_classificacao(model, lote_teste, len(labels_map), device, modo)
 
-model.eval() # Coloca a rede no modo de avaliação (e não de aprendizagem)
-with torch.no_grad():   # Avisa que não devem ser calculados gradientes
-   for img, label in test_data:   # Para cada imagem do conjunto de teste
-      img = img.unsqueeze(0).to(device)
-      predicao = model(img)       # Faz a predição usando a rede
-      predicao = int(predicao[0].argmax(0))  # Pega a classe com maior valor
-      predicoes.extend([predicao]) # Guarda predição na lista
-      reais.extend([label])        # Guarda valor real na lista
-      test_correct += (predicao == label)
-
-# Acurácia no conjunto de teste
-test_acuracia = test_correct/len(test_data)
-
-# Constroi a matriz de confusão
-matriz = metrics.confusion_matrix(reais,predicoes)
+# Calcula todas as métricas a partir da matriz de confusão
+resultados = matriz_confusao.calcula()
+matriz = resultados['matriz']
+test_correct = np.trace(matriz)  # Total de imagens classificadas corretamente
+test_acuracia = resultados['acuracia']  # Acurácia no conjunto de teste
 
 # Pega a lista de classes 
 classes=list(labels_map.values())
 
+# Bibliotecas usadas apenas para o mapa de calor. São importadas só aqui
+# para não atrasar o início do exemplo.
+import seaborn as sn  # Usado para gerar um mapa de calor para a matriz de confusão
+import pandas as pd   # Ajuda a trabalhar com tabelas
+
 # Transforma a matriz no formato da biblioteca PANDA
 df_matriz = pd.DataFrame(matriz/np.sum(matriz), index = classes,
                      columns = [i for i in classes])
@@ -419,9 +486,11 @@ sn.heatmap(df_matriz, annot=True)
 plt.savefig('matriz_confusao.png')
 
 print('Métricas de desempenho no conjunto de teste:')
-print(metrics.classification_report(reais,predicoes))
+print(matriz_confusao.relatorio())
 
-precision,recall,fscore,support=score(reais,predicoes,average='macro')
+precision = resultados['precisao_macro']
+recall = resultados['revocacao_macro']
+fscore = resultados['fscore_macro']
 print('-----------------------------------')
 print(f'Resumo para as {len(test_data)} imagens de teste:')
 print(f"Acertos: {int(test_correct)}")
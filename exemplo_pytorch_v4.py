@@ -13,12 +13,19 @@ Mudanças nesta versão:
 ### Carregando um banco de imagens
 Usa como exemplo imagens disponíveis na pasta 'data' deste projeto aqui: http://git.inovisao.ucdb.br/inovisao/exemplos_pytorch
 
-Dentro de exemplos_pytorch, na pasta data, tem um script BASH (Linux) chamado split_train_test.sh para separar as suas imagens em treino e teste (dentro de script tem uma explicação de como usá-lo). É preciso usar o terminal Linux para executá-lo. Use chmod 755 ./split*.sh para transformar o script em executável, se necessário.
+Dentro de exemplos_pytorch, na pasta data, tem um script BASH (Linux) chamado split_train_test.sh para separar as suas imagens em treino e teste (dentro de script tem uma explicação de como usá-lo). É preciso usar o terminal Linux para executá-lo. Use chmod 755 ./split*.sh para transformar o script em executável, se necessário. O script chama utilitarios/separa_treino_teste.py, que cria links em vez de copiar as imagens (também pode ser usado diretamente, em qualquer sistema: python -m utilitarios.separa_treino_teste 70, a partir da pasta data).
 """
 
+import os      # Funções para manipulação de pastas e arquivos
 import torch   # Biblioteca pytorch principal
 from torch import nn  # Módulo para redes neurais (neural networks)
-from torch.utils.data import DataLoader # Manipulação de bancos de imagens
+from utilitarios.carregadores import cria_dataloader # Manipulação de bancos de imagens
+from utilitarios.checkpoint import (GravadorCheckpoint, monta_checkpoint, retoma_checkpoint,
+                                   nome_checkpoint, descarta_checkpoint) # Checkpoints
+from utilitarios.fragmentos import prepara_fragmentos # Imagens em poucos arquivos grandes
+from utilitarios.divisao import divide_com_manifesto # Divisão salva entre execuções
+from utilitarios.avaliacao import avalia_classificacao # Avaliação em lotes
+from utilitarios.precisao import ModoDesempenho, registra_e_compara # Precisão mista
 from torchvision import datasets,models # Ajuda a importar alguns bancos e
                                         # e modelos já prontos e famosos
 import torchvision.transforms as transforms
@@ -27,28 +34,45 @@ from torch.utils.tensorboard import SummaryWriter # Salva "log" da aprendizagem
 from torch.utils.data import Subset
 import torchvision
 import PIL  # Biblioteca para manipulação de imagens
-import sklearn.metrics as metrics  # Ajuda a calcular métricas de desempenho
-from sklearn.metrics import precision_recall_fscore_support as score
-from sklearn.model_selection import train_test_split
-import seaborn as sn  # Usado para gerar um mapa de calor para a matriz de confusão
-import pandas as pd   # Ajuda a trabalhar com tabelas
 import numpy as np    # Várias funções numéricas
+import time  # Mede a velocidade do treinamento
 
 # Definindo alguns hiperparâmetros importantes:
 epocas = 100  # Total de passagens durante a aprendizagem pelo conjunto de imagens
 tamanho_lote = 16  # Tamanho de cada lote sobre o qual é calculado o gradiente
+processos_carregamento = None  # Total de processos que carregam as imagens em
+                               # paralelo. None = escolhe pelo total de núcleos,
+                               # "auto" = testa alguns valores e usa o mais rápido
+intervalo_log = 4  # Mostra a perda do treinamento a cada "intervalo_log" lotes
+                   # (cada vez que mostra, o processamento espera a GPU terminar)
 taxa_aprendizagem = 0.01   # Magnitude das alterações nos pesos
 momento = 0.2  # Mantem informação de pesos anteriores (as mudanças de
                # de peso passam a ser mais suaves)
 paciencia = 5  # Total de épocas sem melhoria da acurácia na validação até parar
 tolerancia = 0.01 # Melhoria menor que este valor não é considerada melhoria
+retomar = False  # True = se existir o checkpoint de um treinamento interrompido
+                 # com os mesmos hiperparâmetros, continua de onde parou
+                 # (False = começa do zero)
+intervalo_checkpoint = 1  # Salva o estado completo do treinamento a cada
+                          # "intervalo_checkpoint" épocas
+usar_fragmentos = False  # True = decodifica e redimensiona as imagens da pasta
+                         # uma única vez e as guarda em poucos arquivos grandes
+                         # (ver utilitarios/fragmentos.py)
 perc_val = 0.2    # Percentual do treinamento a ser usado para validação
+semente_divisao = 0  # Semente da divisão entre treino e validação (a mesma
+                     # semente sempre gera a mesma divisão)
 
 # Define uma arquitetura já conhecida que será usada
 # Opções atuais: "resnet", "squeezenet", "densenet"
 nome_rede = "resnet"
 tamanho_imagens = 224  # Tamanho das imagens para estas arquiteturas
 
+# Modo de desempenho (ver utilitarios/precisao.py)
+precisao = "fp32"  # "fp32" = padrão, "bf16" = bfloat16 (CPU ou GPU recente),
+                   # "fp16" = float16 (apenas GPU, escala a perda automaticamente)
+canais_no_fim = False  # True = guarda rede e imagens no formato channels_last
+                       # (NHWC), mais rápido nas convoluções
+
 # Descomente o código abaixo se quiser montar e usar o seu próprio google drive
 # no lugar das pastas que o colab cria automaticamente 
 # from google.colab import drive
@@ -86,21 +110,37 @@ transform = transforms.Compose([transforms.Resize((tamanho_imagens,tamanho_image
                                 transforms.ToTensor(),
                                 #transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
                                ])
-# Prepara banco de imagens de treino (está junto com validação por enquanto)
-training_val_data = datasets.ImageFolder(root=pasta_treino,transform=transform)
-# Prepara banco de imagens de teste
-test_data = datasets.ImageFolder(root=pasta_teste,transform=transform)
-
-# Aqui vai separar em treinamento e validação
-train_idx, val_idx = train_test_split(list(range(len(training_val_data))), test_size=perc_val)
+if usar_fragmentos:
+    # As imagens já redimensionadas ficam em poucos arquivos grandes, criados
+    # na primeira execução e lidos direto da memória nas épocas seguintes
+    sufixo = f"_{tamanho_imagens}x{tamanho_imagens}"
+    training_val_data = prepara_fragmentos(pasta_treino, pasta_data+"fragmentos_train"+sufixo,
+                                           tamanho_imagens, tamanho_imagens)
+    test_data = prepara_fragmentos(pasta_teste, pasta_data+"fragmentos_test"+sufixo,
+                                   tamanho_imagens, tamanho_imagens)
+else:
+    # Prepara banco de imagens de treino (está junto com validação por enquanto)
+    training_val_data = datasets.ImageFolder(root=pasta_treino,transform=transform)
+    # Prepara banco de imagens de teste
+    test_data = datasets.ImageFolder(root=pasta_teste,transform=transform)
+
+# Aqui vai separar em treinamento e validação, mantendo a proporção de cada
+# classe. A divisão é salva em um manifesto (ver utilitarios/divisao.py) e
+# reaproveitada nas próximas execuções, enquanto as imagens forem as mesmas.
+nomes_treino_val = [os.path.relpath(caminho, pasta_treino) for caminho, _ in training_val_data.samples]
+train_idx, val_idx, _ = divide_com_manifesto(pasta_data+"divisao_treino_val.npz", nomes_treino_val,
+                                             0, perc_val, semente_divisao,
+                                             rotulos=training_val_data.targets)
 training_data = Subset(training_val_data, train_idx)
 val_data = Subset(training_val_data, val_idx)
 
 
 # Cria os objetos que irão manipular os dados (basicamente ajuda a pegar
 # lote (batch) de imagens de treinamento e de validação)
-train_dataloader = DataLoader(training_data, batch_size=tamanho_lote,shuffle=True)
-val_dataloader = DataLoader(val_data, batch_size=tamanho_lote,shuffle=True)
+train_dataloader = cria_dataloader(training_data, tamanho_lote, shuffle=True,
+                                   num_workers=processos_carregamento)
+val_dataloader = cria_dataloader(val_data, tamanho_lote, shuffle=True,
+                                 num_workers=processos_carregamento)
 
 # Mostra informações do primeiro lote de imagens de validação
 # X vai conter um lote de imagens
@@ -171,6 +211,10 @@ elif nome_rede == "densenet":
 
 # Prepara a rede para o dispositivo que irá processá-la
 model = model.to(device)
+# Ajusta o formato de memória da rede para o modo de desempenho escolhido
+modo = ModoDesempenho(device, precisao, canais_no_fim)
+model = modo.prepara_modelo(model)
+print(f"Modo de desempenho: {modo.nome}")
 
 # Imprime dados sobre a arquitetura da rede
 print(model)
@@ -194,35 +238,40 @@ def train(dataloader, model, loss_fn, optimizer):
     num_batches = len(dataloader)   # Total de lotes
     model.train()  # Avisa que a rede vai entrar em modo de aprendizagem
 
-    train_loss, train_correct = 0, 0  # Usado para calcular perda e acurácia médias
+    # Usado para calcular perda e acurácia médias. Ficam no dispositivo (GPU ou
+    # CPU) para não precisar esperar a GPU a cada lote. Só são lidos no final.
+    train_loss = torch.zeros((), device=device)
+    train_correct = torch.zeros((), dtype=torch.int64, device=device)
 
     # Pega um lote de imagens de cada vez do conjunto de treinamento
     for batch, (X, y) in enumerate(dataloader):
 
         X, y = X.to(device), y.to(device)  # Prepara os dados para o dispositivo (GPU ou CPU)
-        pred = model(X)         # Realiza uma previsão usando os pesos atuais
-        loss = loss_fn(pred, y) # Calcula o erro com os pesos atuais
+        X = modo.prepara_entrada(X)  # Formato de memória do modo de desempenho
+        with modo.autocast():  # Usa a precisão do modo de desempenho
+            pred = model(X)         # Realiza uma previsão usando os pesos atuais
+            loss = loss_fn(pred, y) # Calcula o erro com os pesos atuais
 
-        train_loss += loss.item() # Guarda para calcular a perda média
+        train_loss += loss.detach() # Guarda para calcular a perda média
         # Calcula os acertos para o lote inteiro de imagens
-        train_correct += (pred.argmax(1) == y).type(torch.float).sum().item()
+        train_correct += (pred.argmax(1) == y).sum()
 
 
-        loss.backward()        # Calcula os gradientes com base no erro (loss)
-        optimizer.step()       # Ajusta os pesos com base nos gradientes
-        optimizer.zero_grad()  # Zera os gradientes pois vai acumular para todas
-                               # as imagens do lote
+        # Calcula os gradientes com base no erro (loss), ajusta os pesos e
+        # zera os gradientes (escalando a perda se a precisão for fp16)
+        modo.passo(loss, optimizer)
 
-        # Imprime informação a cada 4 lotes processados
-        if batch % 4 == 0:
+        # Imprime informação a cada "intervalo_log" lotes processados
+        if batch % intervalo_log == 0:
             # Mostra a perda e o total de imagens já processadas
             loss, current = loss.item(), batch * len(X)
             print(f"Perda Treino: {loss:>7f}  [{current:>5d}/{size:>5d}]")
 
-    train_loss /= num_batches  # Como a perda foi calculada por lote, divide
-                               # pelo total de lotes para calcular a média
-    train_acuracia = train_correct / size  # Já o total de acertos é em relação
-                                           # ao total geral de imagens
+    # Como a perda foi calculada por lote, divide pelo total de lotes para
+    # calcular a média (só aqui o valor sai do dispositivo)
+    train_loss = train_loss.item() / num_batches
+    train_acuracia = train_correct.item() / size  # Já o total de acertos é em
+                                                  # relação ao total geral de imagens
 
     return train_loss, train_acuracia
 
@@ -235,19 +284,23 @@ def validation(dataloader, model, loss_fn):
     model.eval()  # Coloca a rede em modo de avaliação (e não de aprendizagem)
 
     # Vai calcular a perda e o total de acertos no conjunto de validação
-    val_loss, val_correct = 0, 0
+    # Ficam no dispositivo (GPU ou CPU) e só são lidos no final
+    val_loss = torch.zeros((), device=device)
+    val_correct = torch.zeros((), dtype=torch.int64, device=device)
 
     # Na validação os pesos não são ajustados e por isso não precisa
     # calcular o gradiente
     with torch.no_grad():
         for X, y in dataloader:
             X, y = X.to(device), y.to(device)
-            pred = model(X)
-            val_loss += loss_fn(pred, y).item()
-            val_correct += (pred.argmax(1) == y).type(torch.float).sum().item()
+            X = modo.prepara_entrada(X)
+            with modo.autocast():
+                pred = model(X)
+                val_loss += loss_fn(pred, y)
+            val_correct += (pred.argmax(1) == y).sum()
 
-    val_loss /= num_batches
-    val_acuracia = val_correct / size
+    val_loss = val_loss.item() / num_batches
+    val_acuracia = val_correct.item() / size
 
     print("Informações na Validação:")
     print(f"Total de acertos: {int(val_correct)}")
@@ -262,13 +315,44 @@ def validation(dataloader, model, loss_fn):
 
 maior_acuracia = 0  # Guarda a melhor acurácia no conjunto de validação
 total_sem_melhora = 0  # Guarda quantas épocas passou sem melhoria na acurácia
+tempo_treino, imagens_treino = 0, 0  # Para calcular a velocidade do treinamento
+
+# O estado completo do treinamento (rede, otimizador, época, variáveis da
+# parada antecipada e dos números aleatórios) é salvo em segundo plano, sem
+# parar o treinamento para esperar o disco (ver utilitarios/checkpoint.py)
+gravador = GravadorCheckpoint()
+# O arquivo do checkpoint depende dos hiperparâmetros abaixo: um treinamento
+# com outros valores não continua o checkpoint deste (e vice-versa). O
+# checkpoint é apagado quando o treinamento termina.
+config_treino = {'nome_rede': nome_rede, 'tamanho_imagens': tamanho_imagens,
+                 'tamanho_lote': tamanho_lote, 'taxa_aprendizagem': taxa_aprendizagem,
+                 'momento': momento, 'precisao': precisao, 'canais_no_fim': canais_no_fim,
+                 'usar_fragmentos': usar_fragmentos, 'perc_val': perc_val,
+                 'semente_divisao': semente_divisao}
+arquivo_checkpoint = nome_checkpoint(pasta_data+"checkpoint_"+nome_rede, config_treino)
+epoca_inicial = 0
+if retomar:
+    retomado = retoma_checkpoint(arquivo_checkpoint, model, otimizador, modo.escalador, device=device,
+                                 config=config_treino)
+    if retomado is not None:
+        epoca_inicial, variaveis = retomado
+        maior_acuracia = variaveis['maior_acuracia']
+        total_sem_melhora = variaveis['total_sem_melhora']
+        tempo_treino = variaveis['tempo_treino']
+        imagens_treino = variaveis['imagens_treino']
+        print(f"Continuando o treinamento interrompido a partir da época {epoca_inicial+1}")
+        if variaveis['terminou']:
+            epoca_inicial = epocas  # Já tinha acabado a paciência
 
 # Passa por todas as imagens várias vezes (a quantidade de vezes
 # é definida pelo hiperparâmetro "epocas")
-for epoca in range(epocas):
+for epoca in range(epoca_inicial, epocas):
     print(f"-------------------------------")
     print(f"Época {epoca+1} \n-------------------------------")
+    inicio = time.perf_counter()
     train_loss, train_acuracia = train(train_dataloader, model, funcao_perda, otimizador)
+    tempo_treino += time.perf_counter() - inicio
+    imagens_treino += len(train_dataloader.dataset)
     val_loss, val_acuracia = validation(val_dataloader, model, funcao_perda)
 
     # Guarda informações para o tensorboard pode criar os gráficos depois
@@ -279,19 +363,36 @@ for epoca in range(epocas):
     # pequenas não sejam consideradas
     if val_acuracia > (maior_acuracia+tolerancia):
       # Salva a melhor rede encontrada até o momento
-      torch.save(model.state_dict(), pasta_data+"modelo_treinado_"+nome_rede+".pth")
+      gravador.salva(pasta_data+"modelo_treinado_"+nome_rede+".pth", model.state_dict())
       print("Salvou o modelo com a maior acurácia na validação até agora em "+pasta_data+"modelo_treinado_"+nome_rede+".pth")
       maior_acuracia = val_acuracia
       total_sem_melhora = 0
     else:
       total_sem_melhora += 1
       print(f"Sem melhora há {total_sem_melhora} épocas ({100*val_acuracia}% <= {100*(maior_acuracia+tolerancia)}%)")
-    if total_sem_melhora > paciencia:
+    terminou = total_sem_melhora > paciencia
+    # Salva o estado completo do treinamento (em segundo plano)
+    if (epoca+1) % intervalo_checkpoint == 0 or terminou or epoca+1 == epocas:
+      gravador.salva(arquivo_checkpoint,
+                     monta_checkpoint(epoca+1, model, otimizador,
+                                      {'maior_acuracia': maior_acuracia,
+                                       'total_sem_melhora': total_sem_melhora,
+                                       'tempo_treino': tempo_treino,
+                                       'imagens_treino': imagens_treino,
+                                       'terminou': terminou}, modo.escalador, config=config_treino))
+    if terminou:
       print(f"Acabou a paciência com {epoca+1} épocas ")
       break
 
+gravador.fecha()  # Espera terminar a gravação dos arquivos
+descarta_checkpoint(arquivo_checkpoint)  # Terminou: o próximo treinamento começa do zero
 print("Terminou a fase de aprendizagem !")
 
+# Mostra a velocidade e a melhor acurácia deste modo de desempenho e, se
+# já existir um treinamento em fp32 desta rede, a diferença para ele
+registra_e_compara("desempenho_modos.json", nome_rede, modo,
+                   imagens_treino/tempo_treino, maior_acuracia)
+
 # Pega algumas imagens para o tensorboard mostrar depois
 images, labels = next(iter(train_dataloader))
 images = images.to(device)
@@ -361,32 +462,26 @@ plt.show() # Este é o comando que vai mostrar as imagens
 
 """## Gera matriz de confusão e algumas métricas de avaliação"""
 
-# Listas para guardar valores preditos e reais
-predicoes = []
-reais = []
-
-# Vai acumular acertos para calcular acurácia
-test_correct=0
+# Passa o conjunto de teste inteiro pela rede, em lotes. As predições ficam
+# no dispositivo (GPU ou CPU) e são acumuladas em uma matriz de confusão
+lote_teste = cria_dataloader(test_data, tamanho_lote,
+                             num_workers=processos_carregamento)
+matriz_confusao = avalia_classificacao(model, lote_teste, len(labels_map), device, modo)
 
-model.eval() # Coloca a rede no modo de avaliação (e não de aprendizagem)
-with torch.no_grad():   # Avisa que não devem ser calculados gradientes
-   for img, label in test_data:   # Para cada imagem do conjunto de teste
-      img = img.unsqueeze(0).to(device)
-      predicao = model(img)       # Faz a predição usando a rede
-      predicao = int(predicao[0].argmax(0))  # Pega a classe com maior valor
-      predicoes.extend([predicao]) # Guarda predição na lista
-      reais.extend([label])        # Guarda valor real na lista
-      test_correct += (predicao == label)
-
-# Acurácia no conjunto de teste
-test_acuracia = test_correct/len(test_data)
-
-# Constroi a matriz de confusão
-matriz = metrics.confusion_matrix(reais,predicoes)
+# Calcula todas as métricas a partir da matriz de confusão
+resultados = matriz_confusao.calcula()
+matriz = resultados['matriz']
+test_correct = np.trace(matriz)  # Total de imagens classificadas corretamente
+test_acuracia = resultados['acuracia']  # Acurácia no conjunto de teste
 
 # Pega a lista de classes
 classes=list(labels_map.values())
 
+# Bibliotecas usadas apenas para o mapa de calor. São importadas só aqui
+# para não atrasar o início do exemplo.
+import seaborn as sn  # Usado para gerar um mapa de calor para a matriz de confusão
+import pandas as pd   # Ajuda a trabalhar com tabelas
+
 # Normaliza a matriz para o intervalo 0 e 1 e arredonda em 2 casas decimais
 # cada célula
 matriz_normalizada = np.round(matriz/np.sum(matriz),2)
@@ -400,9 +495,11 @@ sn.heatmap(df_matriz, annot=True)
 plt.savefig('matriz_confusao.png')
 
 print('Métricas de desempenho no conjunto de teste:')
-print(metrics.classification_report(reais,predicoes))
+print(matriz_confusao.relatorio())
 
-precision,recall,fscore,support=score(reais,predicoes,average='macro')
+precision = resultados['precisao_macro']
+recall = resultados['revocacao_macro']
+fscore = resultados['fscore_macro']
 print('-----------------------------------')
 print(f'Resumo para as {len(test_data)} imagens de teste:')
 print(f"Acertos: {int(test_correct)}")
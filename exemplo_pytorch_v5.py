@@ -23,7 +23,7 @@ Anotações para treinamento, validação e teste:
 - Precisam ter o mesmo nome da imagem correspondente que está na pasta de imagens, mas com extensão .png
 - Precisa ser uma imagem em tons de cinza (1 canal) com o valor de pixel correspondente a cada classe do problema. Por exemplo: 0 = Fundo, 1 = Serpente
 - O código está assumindo apenas duas classes e realiza uma binarização na imagem de anotação
-- Tem um script chamado convertePoligonoPNG, que está na pasta "data" do projeto, que pega anotações de polígonos feitos no Labelme e converte para o formato usado neste exemplos (máscaras em arquivos PNG).
+- Tem um script chamado convertePoligonoPNG, que está na pasta "data" do projeto, que pega anotações de polígonos feitos no Labelme e converte para o formato usado neste exemplos (máscaras em arquivos PNG). O script chama utilitarios/converte_labelme.py, que também pode ser usado diretamente: python -m utilitarios.converte_labelme (a partir da pasta data).
 
 ## Carregando um banco de imagens
 """
@@ -37,27 +37,51 @@ import torchvision.transforms as transforms
 import matplotlib.pyplot as plt # Mostra imagens e gráficos
 from torch.utils.tensorboard import SummaryWriter # Salva "log" da aprendizagem
 import torchvision
-from PIL import Image,ImageOps
-import torch.utils.data as data
-import sklearn.metrics as metrics  # Ajuda a calcular métricas de desempenho
-from sklearn.metrics import precision_recall_fscore_support as score
-from sklearn.model_selection import train_test_split
-import seaborn as sn  # Usado para gerar um mapa de calor para a matriz de confusão
-import pandas as pd   # Ajuda a trabalhar com tabelas
-import numpy as np    # Várias funções numéricas
+from utilitarios.conjuntos import SegmentacaoDataset # Banco de imagens e máscaras
+from utilitarios.divisao import divide_pasta, PADRAO_IMAGENS # Divisão salva entre execuções
+from utilitarios.carregadores import cria_dataloader # Carrega os lotes em paralelo
+from utilitarios.acumulacao import AcumulacaoGradientes # Lote efetivo maior que o lote
+from utilitarios.checkpoint import (GravadorCheckpoint, monta_checkpoint, retoma_checkpoint,
+                                   nome_checkpoint, descarta_checkpoint) # Checkpoints
+from utilitarios.recomputacao import ativa_recomputacao, compara_recomputacao # Menos memória no treino
+from utilitarios.metricas import MatrizConfusao # Matriz de confusão acumulada por lote
 
 
 # Definindo alguns hiperparâmetros importantes:
 epocas = 100  # Total de passagens durante a aprendizagem pelo conjunto de imagens
 tamanho_lote = 2  # Tamanho de cada lote sobre o qual é calculado o gradiente
+acumula_gradientes = 1  # Total de lotes cujos gradientes são somados antes de
+                        # ajustar os pesos: simula um lote de
+                        # tamanho_lote*acumula_gradientes imagens sem precisar
+                        # de mais memória (ex.: 16 para um lote efetivo de 32).
+                        # Com um lote efetivo maior, em geral a taxa de
+                        # aprendizagem também pode ser maior.
+recomputa_ativacoes = False  # Não guarda as ativações de dentro dos blocos da
+                             # ResNet para o backward, recalcula quando precisar:
+                             # gasta menos memória (permite lotes ou imagens
+                             # maiores), mas cada passo fica mais lento
+compara_recomputacao_antes = False  # Antes de treinar, mede o tempo e o pico de
+                                    # memória de um passo com e sem a recomputação
+processos_carregamento = None  # Total de processos que carregam as imagens em
+                               # paralelo. None = escolhe pelo total de núcleos,
+                               # "auto" = testa alguns valores e usa o mais rápido
+intervalo_log = 1  # Mostra a perda do treinamento a cada "intervalo_log" lotes
+                   # (cada vez que mostra, o processamento espera a GPU terminar)
 taxa_aprendizagem = 0.1   # Magnitude das alterações nos pesos
 momento = 0.1  # Mantem informação de pesos anteriores (as mudanças de
                # de peso passam a ser mais suaves). Não é usado no
                # otimizador ADAM, apenas no SGD.
 paciencia = 10  # Total de épocas sem melhoria da acurácia na validação até parar
 tolerancia = 0.01 # Melhoria menor que este valor não é considerada melhoria
+retomar = False  # True = se existir o checkpoint de um treinamento interrompido
+                 # com os mesmos hiperparâmetros, continua de onde parou
+                 # (False = começa do zero)
+intervalo_checkpoint = 1  # Salva o estado completo do treinamento a cada
+                          # "intervalo_checkpoint" épocas
 perc_teste = 0.2  # Percentual a ser usado para teste
 perc_val = 0.3    # Percentual do treinamento a ser usado para validação
+semente_divisao = 0  # Semente da divisão entre treino, validação e teste
+                     # (a mesma semente sempre gera a mesma divisão)
 
 # Define uma arquitetura já conhecida que será usada
 # Opções atuais: "deeplabv3","fcn" 
@@ -96,57 +120,44 @@ transform = transforms.Compose([transforms.Resize((tamanho_imagens,tamanho_image
                                 #transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
                                ])    
 
-# Lê uma imagem aleatória do disco e sua anotação
-def ImagemAleatoria(pasta,nomes):
-    idx=np.random.randint(0,len(nomes)) # Seleciona um índice aleatório
-    
-    # Lê a imagem usando o índice aleatório
-    imagem=Image.open(os.path.join(pasta, "imagens", nomes[idx]))
-
-    # Aplica operações para resolver problema de orientação
-    # de imagens com tag de orientação EXIF
-    imagem = ImageOps.exif_transpose(imagem)
-
-    # Lê a anotação usando o índice aleatório. 
-    # Assume que as anotações são do tipo png
-    arquivo_anotacao=os.path.splitext(nomes[idx])[0]+'.png'  
-    anotacao=Image.open(os.path.join(pasta, "anotacoes", arquivo_anotacao))
-    # Aplica as transformações
-    imagem=transform(imagem)
-    anotacao=transform(anotacao)
-    # Binariza a anotação
-    # Dependendo do tipo do arquivo de anotação pode ser preciso mudar
-    # o teste "anotacao > 0". Tem que dar uma inspecionada nos valores dos pixels
-    anotacao=torch.where(anotacao > 0, 1, 0)
-
-    return imagem,anotacao
-
-# Lê um lote de imagens
-def LoteDeImagens(pasta,nomes,tamanho_lote): 
-    imagens = torch.zeros([tamanho_lote,3,tamanho_imagens,tamanho_imagens])
-    anotacoes = torch.zeros([tamanho_lote,tamanho_imagens,tamanho_imagens])
-    
-    for i in range(tamanho_lote):
-        imagens[i],anotacoes[i]=ImagemAleatoria(pasta,nomes)
-    
-    return imagens, anotacoes
-
-# Cria uma lista com os nomes das imagens que estão na pasta de treino 
-nomes_todas=os.listdir(os.path.join(pasta_data, "imagens")) 
-# Divide as imagens que estavam na pasta treino entre treino e validação
-other_idx,test_idx = train_test_split(list(range(len(nomes_todas))), test_size=perc_teste)
-nomes_teste = [nomes_todas[i] for i in test_idx]
-nomes_other = [nomes_todas[i] for i in other_idx]
-train_idx, val_idx = train_test_split(list(range(len(nomes_other))), test_size=perc_val)
-nomes_treino = [nomes_other[i] for i in train_idx]
-nomes_val = [nomes_other[i] for i in val_idx]
+# O banco de imagens e anotações (máscaras) é tratado pela classe
+# SegmentacaoDataset, que tem como base a classe "Dataset" do pytorch (ver
+# utilitarios/conjuntos.py). Junto com o DataLoader, cada época passa uma vez
+# por todas as imagens (em ordem aleatória quando shuffle=True) e as imagens
+# podem ser lidas por vários processos em paralelo.
+
+# Divide as imagens da pasta entre treino, validação e teste. A divisão é
+# feita uma única vez e salva em um manifesto (ver utilitarios/divisao.py),
+# reaproveitado nas próximas execuções enquanto as imagens forem as mesmas.
+nomes_treino, nomes_val, nomes_teste = divide_pasta(os.path.join(pasta_data, "imagens"),
+                                                    os.path.join(pasta_data, "divisao.npz"),
+                                                    perc_teste, perc_val, semente_divisao,
+                                                    padrao=PADRAO_IMAGENS)
 
 print('Treino:',nomes_treino)
 print('Validação:',nomes_val)
 print('Teste:',nomes_teste)
 
+# Cria os objetos que vão representar os bancos de treino, validação e teste
+treino = SegmentacaoDataset(pasta_data, nomes_treino, transform)
+val = SegmentacaoDataset(pasta_data, nomes_val, transform)
+teste = SegmentacaoDataset(pasta_data, nomes_teste, transform)
+
+# Cria os objetos para carregar lotes de imagens e anotações. O DataLoader
+# junta as imagens de cada lote direto em um único tensor (na memória
+# compartilhada entre os processos) e, se tiver GPU, em memória fixa (pinned)
+# reaproveitada de um lote para o outro
+# No treino o último lote é descartado se estiver incompleto: um lote com uma
+# única imagem dá erro na BatchNorm do pooling (ASPP) da deeplabv3
+lote_treino = cria_dataloader(treino, tamanho_lote, shuffle=True,
+                              num_workers=processos_carregamento, drop_last=True)
+lote_val = cria_dataloader(val, tamanho_lote,
+                           num_workers=processos_carregamento)
+lote_teste = cria_dataloader(teste, tamanho_lote, shuffle=True,
+                             num_workers=processos_carregamento)
+
 # Carrega um lote de imagens e de anotações de treino
-X,y = LoteDeImagens(pasta_data,nomes_treino,tamanho_lote)
+X,y = next(iter(lote_treino))
 
 # Mostra informações de um lote de imagens de validação 
 # X vai conter um lote de imagens
@@ -173,7 +184,7 @@ plt.axis("off")
 cols, rows = 4, 2  # Irá mostrar 2 imagens com suas anotações em uma grade 4x1
 
 # Carrega um lote de imagens e de anotações de treino
-X,y = LoteDeImagens(pasta_data,nomes_treino,tamanho_lote)
+X,y = next(iter(lote_treino))
 
 # Passa por cada imagem do lote
 for i in range(0,len(X)):
@@ -226,6 +237,20 @@ otimizador = torch.optim.Adam(model.parameters(), lr=taxa_aprendizagem)
 # Define a função de perda como entropia cruzada
 funcao_perda = nn.CrossEntropyLoss()
 
+# Recomputação de ativações (activation checkpointing) na ResNet da rede
+# (ver utilitarios/recomputacao.py)
+if compara_recomputacao_antes:
+    # Mede um passo de treinamento com um lote de treino, com e sem a
+    # recomputação (os pesos da rede voltam ao que eram antes)
+    X, y = next(iter(lote_treino))
+    X, y = X.to(device), y.to(device)
+    model.train()
+    def passo():
+        funcao_perda(model(X)['out'], y.long()).backward()
+    compara_recomputacao(model, passo, device)
+if recomputa_ativacoes:
+    print(f"Recomputação de ativações ligada em {ativa_recomputacao(model)} blocos da ResNet")
+
 # Cria o módulo do tensorboard de coleta de dados
 writer = SummaryWriter()
 
@@ -234,78 +259,91 @@ writer = SummaryWriter()
 # model = arquitetura da rede
 # loss_fn = função de perda
 # optimizer = otimizador 
-def train(pasta, nomes, model, loss_fn, optimizer):
+def train(dataloader, model, loss_fn, optimizer):
 
 
-    size = len(nomes)  # Total de imagens
-    num_batches = int(size/tamanho_lote)   # Total de lotes
-    pixels = num_batches*tamanho_lote*tamanho_imagens*tamanho_imagens
+    num_batches = len(dataloader)   # Total de lotes
+    size = num_batches*tamanho_lote  # Total de imagens usadas (o lote incompleto é descartado)
+    pixels = size*tamanho_imagens*tamanho_imagens
+    # Diz o peso da perda de cada lote e quando ajustar os pesos (a cada
+    # "acumula_gradientes" lotes, ver utilitarios/acumulacao.py)
+    acumulacao = AcumulacaoGradientes(size, tamanho_lote, acumula_gradientes)
+    print(f"Lote efetivo: {tamanho_lote*acumula_gradientes} imagens ({acumulacao.total_passos} ajustes dos pesos)")
 
     model.train()  # Avisa que a rede vai entrar em modo de aprendizagem
+    optimizer.zero_grad()  # Começa a época sem gradientes acumulados
 
-    train_loss, train_correct = 0, 0  # Usado para calcular perda e acurácia médias
+    # Usado para calcular perda e acurácia médias. Ficam no dispositivo (GPU ou
+    # CPU) para não precisar esperar a GPU a cada lote. Só são lidos no final.
+    train_loss = torch.zeros((), device=device)
+    train_correct = torch.zeros((), dtype=torch.int64, device=device)
 
     # Pega um lote de imagens de cada vez do conjunto de treinamento
-    for batch in range(0,num_batches):
+    for batch, (X, y) in enumerate(dataloader):
 
-        X,y = LoteDeImagens(pasta,nomes,tamanho_lote)
         X, y = X.to(device), y.to(device)  # Prepara os dados para o dispositivo (GPU ou CPU)
         pred = model(X)['out']    # Realiza uma previsão usando os pesos atuais
         loss = loss_fn(pred, y.long())  # Calcula o erro com os pesos atuais
 
-        train_loss += loss.item() # Guarda para calcular a perda média
+        train_loss += loss.detach() # Guarda para calcular a perda média
         # Calcula os acertos para o lote inteiro de imagens
-        train_correct += (pred.argmax(1) == y).type(torch.float).sum().item() 
-
-        loss.backward()        # Calcula os gradientes com base no erro (loss)
-        optimizer.step()       # Ajusta os pesos com base nos gradientes
-        optimizer.zero_grad()  # Zera os gradientes pois vai acumular para todas
-                               # as imagens do lote
-
-        # Imprime informação a cada 1 lote processado
-        if batch % 1 == 0:
+        train_correct += (pred.argmax(1) == y).sum()
+
+        # Calcula os gradientes com base no erro (loss). Eles são somados
+        # aos dos lotes anteriores do grupo, por isso a perda é multiplicada
+        # pela fração das imagens do grupo que estão neste lote.
+        (loss*acumulacao.peso(batch)).backward()
+        if acumulacao.ajusta(batch):  # Último lote do grupo
+            optimizer.step()       # Ajusta os pesos com base nos gradientes
+            optimizer.zero_grad()  # Zera os gradientes para o próximo grupo
+
+        # Imprime informação a cada "intervalo_log" lotes processados
+        if batch % intervalo_log == 0:
             # Mostra a perda e o total de imagens já processadas
             loss, current = loss.item(), batch * len(X)
             print(f"Perda Treino: {loss:>7f}  [{current:>5d}/{size:>5d}]")
 
-    train_loss /= num_batches  # Como a perda foi calculada por lote, divide
-                               # pelo total de lotes para calcular a média
-    train_acuracia = train_correct / pixels # Já o total de acertos é em relação
-                                            # ao total geral de pixels
+    # Como a perda foi calculada por lote (sem o peso da acumulação), divide
+    # pelo total de lotes para calcular a média (só aqui o valor sai do
+    # dispositivo)
+    train_loss = train_loss.item() / num_batches
+    train_acuracia = train_correct.item() / pixels # Já o total de acertos é em
+                                                   # relação ao total geral de pixels
 
     return train_loss, train_acuracia        
 
 # Define a função de validação (aqui a rede não está aprendendo, apenas
 # usando "aquilo que aprendeu", mas em um conjunto de imagens diferente
 # do conjunto usado para aprender)
-def validation(pasta, nomes, model, loss_fn):
+def validation(dataloader, model, loss_fn):
 
 
-    size = len(nomes)  # Total de imagens
+    size = len(dataloader.dataset)  # Total de imagens
     print('Total de imagens:',size)
-    num_batches = int(size/tamanho_lote)   # Total de lotes
+    num_batches = len(dataloader)   # Total de lotes
     print('Total de lotes:',num_batches)
-    pixels = num_batches*tamanho_lote*tamanho_imagens*tamanho_imagens
+    pixels = size*tamanho_imagens*tamanho_imagens
     model.eval()  # Avisa que a rede vai entrar em modo de aprendizagem
 
 
     # Vai calcular a perda e o total de acertos no conjunto de validação
-    val_loss, val_correct = 0, 0
+    # Ficam no dispositivo (GPU ou CPU) e só são lidos no final
+    val_loss = torch.zeros((), device=device)
+    val_correct = torch.zeros((), dtype=torch.int64, device=device)
 
     # Na validação os pesos não são ajustados e por isso não precisa
     # calcular o gradiente
     with torch.no_grad():
         # Pega um lote de imagens de cada vez do conjunto de treinamento
-        for batch in range(0,num_batches):
+        for X, y in dataloader:
 
-            X,y = LoteDeImagens(pasta,nomes,tamanho_lote)
             X, y = X.to(device), y.to(device)  # Prepara os dados para o dispositivo (GPU ou CPU)
             pred = model(X)['out']    # Realiza uma previsão usando os pesos atuais
-            val_loss += loss_fn(pred, y.long()).item()
-            val_correct += (pred.argmax(1) == y).type(torch.float).sum().item()
+            val_loss += loss_fn(pred, y.long())
+            val_correct += (pred.argmax(1) == y).sum()
 
-    val_loss /= num_batches
-    val_acuracia = val_correct / pixels
+    val_loss = val_loss.item() / num_batches
+    val_acuracia = val_correct.item() / pixels
 
     print("Informações na Validação:")
     print(f"Total de acertos: {int(val_correct)}")
@@ -321,13 +359,37 @@ def validation(pasta, nomes, model, loss_fn):
 maior_acuracia = 0  # Guarda a melhor acurácia no conjunto de validação
 total_sem_melhora = 0  # Guarda quantas épocas passou sem melhoria na acurácia
 
+# O estado completo do treinamento (rede, otimizador, época, variáveis da
+# parada antecipada e dos números aleatórios) é salvo em segundo plano, sem
+# parar o treinamento para esperar o disco (ver utilitarios/checkpoint.py)
+gravador = GravadorCheckpoint()
+# O arquivo do checkpoint depende dos hiperparâmetros abaixo: um treinamento
+# com outros valores não continua o checkpoint deste (e vice-versa). O
+# checkpoint é apagado quando o treinamento termina.
+config_treino = {'nome_rede': nome_rede, 'tamanho_imagens': tamanho_imagens, 'classes': classes,
+                 'tamanho_lote': tamanho_lote, 'acumula_gradientes': acumula_gradientes,
+                 'taxa_aprendizagem': taxa_aprendizagem, 'momento': momento,
+                 'perc_teste': perc_teste, 'perc_val': perc_val, 'semente_divisao': semente_divisao}
+arquivo_checkpoint = nome_checkpoint(pasta_data+"checkpoint_"+nome_rede, config_treino)
+epoca_inicial = 0
+if retomar:
+    retomado = retoma_checkpoint(arquivo_checkpoint, model, otimizador, device=device,
+                                 config=config_treino)
+    if retomado is not None:
+        epoca_inicial, variaveis = retomado
+        maior_acuracia = variaveis['maior_acuracia']
+        total_sem_melhora = variaveis['total_sem_melhora']
+        print(f"Continuando o treinamento interrompido a partir da época {epoca_inicial+1}")
+        if variaveis['terminou']:
+            epoca_inicial = epocas  # Já tinha acabado a paciência
+
 # Passa por todas as imagens várias vezes (a quantidade de vezes
 # é definida pelo hiperparâmetro "epocas")
-for epoca in range(epocas):
+for epoca in range(epoca_inicial, epocas):
     print(f"-------------------------------")
     print(f"Época {epoca+1} \n-------------------------------")
-    train_loss, train_acuracia = train(pasta_data,nomes_treino, model, funcao_perda, otimizador)
-    val_loss, val_acuracia = validation(pasta_data,nomes_val, model, funcao_perda)
+    train_loss, train_acuracia = train(lote_treino, model, funcao_perda, otimizador)
+    val_loss, val_acuracia = validation(lote_val, model, funcao_perda)
 
     # Guarda informações para o tensorboard pode criar os gráficos depois
     writer.add_scalars('Loss', {'train':train_loss,'val':val_loss}, epoca)
@@ -337,21 +399,31 @@ for epoca in range(epocas):
     # pequenas não sejam consideradas
     if val_acuracia > (maior_acuracia+tolerancia): 
       # Salva a melhor rede encontrada até o momento
-      torch.save(model.state_dict(), pasta_data+"modelo_treinado_"+nome_rede+".pth")
+      gravador.salva(pasta_data+"modelo_treinado_"+nome_rede+".pth", model.state_dict())
       print("Salvou o modelo com a maior acurácia na validação até agora em modelo_treinado_"+nome_rede+".pth")      
       maior_acuracia = val_acuracia
       total_sem_melhora = 0
     else: 
       total_sem_melhora += 1 
       print(f"Sem melhora há {total_sem_melhora} épocas ({100*val_acuracia}% <= {100*(maior_acuracia+tolerancia)}%)")
-    if total_sem_melhora > paciencia:
+    terminou = total_sem_melhora > paciencia
+    # Salva o estado completo do treinamento (em segundo plano)
+    if (epoca+1) % intervalo_checkpoint == 0 or terminou or epoca+1 == epocas:
+      gravador.salva(arquivo_checkpoint,
+                     monta_checkpoint(epoca+1, model, otimizador,
+                                      {'maior_acuracia': maior_acuracia,
+                                       'total_sem_melhora': total_sem_melhora,
+                                       'terminou': terminou}, config=config_treino))
+    if terminou:
       print(f"Acabou a paciência com {epoca+1} épocas ")
       break
 
+gravador.fecha()  # Espera terminar a gravação dos arquivos
+descarta_checkpoint(arquivo_checkpoint)  # Terminou: o próximo treinamento começa do zero
 print("Terminou a fase de aprendizagem !")
 
 # Pega algumas imagens para o tensorboard mostrar depois
-# images,anotacoes = LoteDeImagens(pasta_data,nomes_treino,tamanho_lote)
+# images,anotacoes = next(iter(lote_treino))
 # images = images.to(device)
 # anotacoes = anotacoes.to(device)
 # Cria uma grade de imagens para o tensorboard
@@ -398,7 +470,7 @@ plt.axis("off")
 cols, rows = 4, 4  # Irá mostrar imagens com suas anotações em uma grade 4x2
 
 # Carrega um lote de imagens e de anotações de teste
-X,y = LoteDeImagens(pasta_data,nomes_teste,tamanho_lote)
+X,y = next(iter(lote_teste))
 
 # Passa por cada imagem do lote
 for i in range(0,len(X)):
@@ -436,34 +508,28 @@ plt.show() # Este é o comando que vai mostrar as imagens
 
 """## Gerando algumas estatísticas no conjunto de teste"""
 
-# Listas para guardar valores preditos e reais
-predicoes = []
-reais = []
-
-size = len(nomes_teste)  # Total de imagens
-num_batches = int(size/tamanho_lote)   # Total de lotes
-pixels = num_batches*tamanho_lote*tamanho_imagens*tamanho_imagens
-
-# Vai acumular acertos para calcular acurácia
-test_correct=0
+# Vai acumulando a matriz de confusão lote a lote, no próprio dispositivo,
+# sem guardar uma lista com o valor de cada pixel
+matriz_confusao = MatrizConfusao(len(classes), device)
 
 model.eval() # Coloca a rede no modo de avaliação (e não de aprendizagem)
 with torch.no_grad():   # Avisa que não devem ser calculados gradientes
-   for batch in range(0,num_batches):
-      X,y = LoteDeImagens(pasta_data,nomes_teste,tamanho_lote)
+   for X,y in lote_teste:
       X, y = X.to(device), y.to(device)  # Prepara os dados para o dispositivo (GPU ou CPU)
       predicao = model(X)['out']    # Realiza uma previsão usando os pesos atuais
-      test_correct += (predicao.argmax(1) == y).type(torch.float).sum().item()     
       predicao = predicao.argmax(1)  # Pega a classe com maior valor
+      matriz_confusao.atualiza(predicao, y)  # Acumula na matriz de confusão
 
-      predicoes.extend(predicao.flatten().tolist()) # Guarda predição na lista
-      reais.extend(y.flatten().tolist())        # Guarda valor real na lista
-
-# Acurácia no conjunto de teste
-test_acuracia = test_correct/pixels
+# Calcula todas as métricas a partir da matriz de confusão
+resultados = matriz_confusao.calcula()
+matriz = resultados['matriz']
+test_correct = np.trace(matriz)  # Total de pixels classificados corretamente
+test_acuracia = resultados['acuracia']  # Acurácia no conjunto de teste
 
-# Constroi a matriz de confusão
-matriz = metrics.confusion_matrix(reais,predicoes)
+# Bibliotecas usadas apenas para o mapa de calor. São importadas só aqui
+# para não atrasar o início do exemplo.
+import seaborn as sn  # Usado para gerar um mapa de calor para a matriz de confusão
+import pandas as pd   # Ajuda a trabalhar com tabelas
 
 # Normaliza a matriz para o intervalo 0 e 1 e arredonda em 2 casas decimais 
 # cada célula
@@ -478,9 +544,11 @@ sn.heatmap(df_matriz, annot=True)
 plt.savefig('matriz_confusao.png')
 
 print('Métricas de desempenho no conjunto de teste:')
-print(metrics.classification_report(reais,predicoes))
+print(matriz_confusao.relatorio())
 
-precision,recall,fscore,support=score(reais,predicoes,average='macro')
+precision = resultados['precisao_macro']
+recall = resultados['revocacao_macro']
+fscore = resultados['fscore_macro']
 print('-----------------------------------')
 print(f'Resumo para as {len(nomes_teste)} imagens de teste:')
 print(f"Acertos: {int(test_correct)}")
@@ -488,4 +556,5 @@ print(f"Acurácia: {(100*test_acuracia):>0.2f}%")
 print(f"Precisão: {100*precision:>0.2f}%")
 print(f"Revocação: {100*recall:>0.2f}%")
 print(f"Medida-F: {100*fscore:>0.2f}%")
+print(f"IoU: {100*resultados['iou_macro']:>0.2f}%")
 print('-----------------------------------')
@@ -24,40 +24,59 @@ import torch   # Pytorch principal
 from torch import nn  # Módulo para redes neurais (neural networks)
 import os,fnmatch      # Funções para manipulação de pastas e arquivos
 import numpy as np    # Várias funções numéricas
-import torchvision
-import torchvision.models.segmentation # Redes famosas para segmentação semântica
-import torchvision.transforms as transforms
-from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 import matplotlib.pyplot as plt # Mostra imagens e gráficos
 from torch.utils.tensorboard import SummaryWriter # Salva "log" da aprendizagem
-from torch.utils.data import Dataset, DataLoader
-import cv2  # Biblioteca OpenCV para manipular imagens
-import albumentations as A  # Biblioteca com diversos tipos de transformações
-                            # para imagens
-from albumentations.pytorch import ToTensorV2                            
-from xml.etree import ElementTree as et # Manipulação de arquivos XML
-import torch.utils.data as data
-import sklearn.metrics as metrics  # Ajuda a calcular métricas de desempenho
-from sklearn.metrics import precision_recall_fscore_support as score
-from sklearn.model_selection import train_test_split
-import seaborn as sn  # Usado para gerar um mapa de calor para a matriz de confusão
-import pandas as pd   # Ajuda a trabalhar com tabelas
-import numpy as np    # Várias funções numéricas
+from utilitarios.aumento_deteccao import AumentoDeteccao # Aumento de dados no lote inteiro
+from utilitarios.avaliacao import avalia_deteccao # mAP calculado lote a lote
+from utilitarios.carregadores import cria_dataloader # Carrega os lotes em paralelo
+from utilitarios.acumulacao import AcumulacaoGradientes # Lote efetivo maior que o lote
+from utilitarios.checkpoint import (GravadorCheckpoint, monta_checkpoint, retoma_checkpoint,
+                                   nome_checkpoint, descarta_checkpoint) # Checkpoints
+from utilitarios.recomputacao import ativa_recomputacao, compara_recomputacao # Menos memória no treino
+from utilitarios.conjuntos import DeteccaoDataset, junta_deteccao, junta_deteccao_empacotada # Banco de imagens
+from utilitarios.divisao import divide_pasta # Divisão salva entre execuções
+from utilitarios.indice_voc import cria_indice_anotacoes
+from utilitarios.transformacoes_lote import prepara_lote_deteccao # Lote para a GPU (float no lote inteiro)
 
 
 # Definindo alguns hiperparâmetros importantes:
 epocas = 100  # Total de passagens durante a aprendizagem pelo conjunto de imagens
 tamanho_lote = 4  # Tamanho de cada lote sobre o qual é calculado o gradiente
+acumula_gradientes = 1  # Total de lotes cujos gradientes são somados antes de
+                        # ajustar os pesos: simula um lote de
+                        # tamanho_lote*acumula_gradientes imagens sem precisar
+                        # de mais memória (ex.: 8 para um lote efetivo de 32).
+                        # Com um lote efetivo maior, em geral a taxa de
+                        # aprendizagem também pode ser maior.
+recomputa_ativacoes = False  # Não guarda as ativações de dentro dos blocos da
+                             # ResNet para o backward, recalcula quando precisar:
+                             # gasta menos memória (permite lotes ou imagens
+                             # maiores), mas cada passo fica mais lento
+compara_recomputacao_antes = False  # Antes de treinar, mede o tempo e o pico de
+                                    # memória de um passo com e sem a recomputação
+processos_carregamento = None  # Total de processos que carregam as imagens em
+                               # paralelo. None = escolhe pelo total de núcleos,
+                               # "auto" = testa alguns valores e usa o mais rápido
+intervalo_log = 2  # Mostra a perda do treinamento a cada "intervalo_log" lotes
+                   # (cada vez que mostra, o processamento espera a GPU terminar)
 taxa_aprendizagem = 0.01   # Magnitude das alterações nos pesos
 momento = 0.1  # Mantem informação de pesos anteriores (as mudanças de
                # de peso passam a ser mais suaves). Não é usado no
                # otimizador ADAM, apenas no SGD.
 peso_regularizador = 0 # Peso do regularizador, geralmente norma L2,
                             # que é adicionado à função de perda (weigth_decay)
-paciencia = 10  # Total de épocas sem melhoria da acurácia na validação até parar
+paciencia = 10  # Total de épocas sem melhoria do mAP na validação até parar
 tolerancia = 0.001 # Melhoria menor que este valor não é considerada melhoria
+retomar = False  # True = se existir o checkpoint de um treinamento interrompido
+                 # com os mesmos hiperparâmetros, continua de onde parou
+                 # (False = começa do zero)
+intervalo_checkpoint = 1  # Salva o estado completo do treinamento a cada
+                          # "intervalo_checkpoint" épocas
 perc_teste = 0.2  # Percentual a ser usado para teste
 perc_val = 0.3    # Percentual do treinamento a ser usado para validação
+semente_divisao = 0  # Semente da divisão entre treino, validação e teste
+                     # (a mesma semente sempre gera a mesma divisão)
+semente_aumento = 0  # Semente dos sorteios do aumento de dados
 
 # Define uma arquitetura já conhecida que será usada
 # Opções atuais: "fasterRCNN"
@@ -65,6 +84,18 @@ nome_rede = "faster"
 largura_imagens = 416  # Largura das imagem para a arquitetura escolhida
 altura_imagens = 416  # Altura das imagem para a arquitetura escolhida
 
+# Se True, cada imagem é lida do disco, convertida e redimensionada uma única
+# vez e guardada em um arquivo de cache (um para treino, validação e teste).
+# As épocas seguintes leem as imagens direto do cache, bem mais rápido.
+usar_cache = False
+
+# Se True, as imagens de cada lote são empilhadas em um único tensor e as
+# anotações de todas as imagens ficam juntas em poucos tensores (ver
+# junta_deteccao_empacotada em utilitarios/conjuntos.py). O lote vai para a
+# GPU com poucas cópias grandes, em vez de várias cópias pequenas por imagem.
+# False = um dicionário de anotações por imagem, como antes.
+empacota_lotes = True
+
 # Lista de classes. Tem que colocar sempre a classe fundo.
 classes=['fundo','conde']
 
@@ -95,124 +126,27 @@ print("Vai ler as imagens de: ",pasta_data)
 device = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"Usando {device}")
 
-"""### Definindo a classe CustomDataset
+"""### A classe DeteccaoDataset
 
-Diferentemente dos exemplos até agora, desta vez iremos criar uma classe para tratar o nosso banco de imagens pois as anotações são um pouco mais complexas.
+Diferentemente dos exemplos até agora, desta vez usamos uma classe própria para tratar o nosso banco de imagens pois as anotações são um pouco mais complexas. A classe DeteccaoDataset, que tem como base a classe "Dataset" do pytorch, está em utilitarios/conjuntos.py.
 """
 
-# Cria uma classe para tratar o meu próprio banco de imagens (Custom) tendo
-# como base a classe "Dataset" do pytorch
-class CustomDataset(Dataset):
-    def __init__(self, pasta, nomes_arquivos, largura, altura, classes, transformacoes=None):
-        self.pasta = pasta  # Pasta onde estão as imagens
-        self.nomes_arquivos = nomes_arquivos  # Nomes das imagens a serem utilizadas
-        self.altura = altura   # Altura que as imagens deverão ter
-        self.largura = largura    # Largura que as imagens deverão ter 
-        self.classes = classes  # Nomes das classes do problema
-        self.transformacoes = transformacoes # Transformações a serem aplicadas      
-    def __getitem__(self, idx):
-        # Lê uma imagem com o OpenCV
-        nome_imagem = self.nomes_arquivos[idx]
-        imagem = cv2.imread(os.path.join(self.pasta,nome_imagem))
-        # Converte de BGR, que usado pelo OpenCV, para RGB 
-        imagem = cv2.cvtColor(imagem, cv2.COLOR_BGR2RGB).astype(np.float32)
-        # Redimensiona a imagem
-        redimensionada = cv2.resize(imagem, (self.largura, self.altura))
-        # Coloca os valores dos pixels no intervalo [0,1]
-        redimensionada /= 255.0
-        
-        # Troca a extensão do arquivo para poder pegar as anotações em xml
-        nome_anotacao = nome_imagem[:-4] + '.xml'
-        xml_anotacao = os.path.join(self.pasta, nome_anotacao)
-        
-        # Vai guardar os retângulos e classe de cada retângulo
-        boxes = []
-        labels = []
-        # Lê o arquivo XML
-        tree = et.parse(xml_anotacao)
-        root = tree.getroot()
-        
-        # Altura e Largura original da imagem
-        altura = imagem.shape[0]
-        largura = imagem.shape[1]
-        
-        # Vai ler as coordenadas dos retângulos de anotações e ajustar para
-        # o novo tamanho da imagem (usa vários comandos da biblioteca xml.etree
-        # para isso)
-        for member in root.findall('object'):
-            # Pega a classe da anotação (neste exemplo, "conde" (condenador))
-            labels.append(self.classes.index(member.find('name').text))
-            
-            # Pega as coordenadas das extremidades do retângulo
-            xmin = int(member.find('bndbox').find('xmin').text)
-            xmax = int(member.find('bndbox').find('xmax').text)
-            ymin = int(member.find('bndbox').find('ymin').text)
-            ymax = int(member.find('bndbox').find('ymax').text)
-            
-            # Redimensiona os retângulos de anotação         
-            xmin_final = (xmin/largura)*self.largura
-            xmax_final = (xmax/largura)*self.largura
-            ymin_final = (ymin/altura)*self.altura
-            ymax_final = (ymax/altura)*self.altura
-
-            # Pelo arredondamento, na hora de converter os retângulos, 
-            # pode passar da largura ou da altura da imagem. O código
-            # abaixo verifica e corrige isso.
-            if xmax_final > self.largura: xmax_final = self.largura
-            if ymax_final > self.altura: ymax_final = self.altura
-            if xmin_final < 0: xmin_final = 0
-            if ymin_final < 0: ymin_final = 0                       
-          
-            # Guarda o retângulo na lista de retângulos
-            boxes.append([xmin_final, ymin_final, xmax_final, ymax_final])
-        
-        # Converte os retângulo para um tensor
-        boxes = torch.as_tensor(boxes, dtype=torch.float32)
-
-        # Calcula a área do retângulo
-        area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
-        # Avisa que não é um problema de detecção de multidões
-        iscrowd = torch.zeros((boxes.shape[0],), dtype=torch.int64)
-        # Converte as classes para um tensor
-        labels = torch.as_tensor(labels, dtype=torch.int64)
-        # Cria um dicionário com todas as informações que a rede vai
-        # precisar depois
-        target = {}
-        target["boxes"] = boxes
-        target["labels"] = labels
-        target["area"] = area
-        target["iscrowd"] = iscrowd
-        image_id = torch.tensor([idx])
-        target["image_id"] = image_id
-        # Aplica as transformações que foram passadas como parâmetro
-        if self.transformacoes:
-            sample = self.transformacoes(image = redimensionada,
-                                     bboxes = target['boxes'],
-                                     labels = labels)
-            redimensionada = sample['image']
-            target['boxes'] = torch.Tensor(sample['bboxes'])
-
-            
-        return redimensionada, target
-
-    def __len__(self):
-        return len(self.nomes_arquivos)
-
 """### Criando os bancos de treino, validação e teste"""
 
-# Cria uma lista com os nomes de todas imagens disponíveis
-nomes_todas=fnmatch.filter(os.listdir(pasta_data), "*.jpg")
+# Lê todas as anotações (arquivos XML) uma única vez. O índice fica salvo
+# na pasta das imagens e só os XML novos ou modificados são lidos de novo
+# nas próximas execuções.
+indice_anotacoes = cria_indice_anotacoes(pasta_data, classes,
+                                         os.path.join(pasta_data, "indice_anotacoes.npz"))
 
 
-# Dividirá as imagens entre treino, validação e teste
-# Primeiro separa o teste
-other_idx,test_idx = train_test_split(list(range(len(nomes_todas))), test_size=perc_teste)
-nomes_teste = [nomes_todas[i] for i in test_idx]
-nomes_other = [nomes_todas[i] for i in other_idx]
-# E depois separa entre treino e validação
-train_idx, val_idx = train_test_split(list(range(len(nomes_other))), test_size=perc_val)
-nomes_treino = [nomes_other[i] for i in train_idx]
-nomes_val = [nomes_other[i] for i in val_idx]
+# Dividirá as imagens entre treino, validação e teste (primeiro separa o
+# teste e depois o restante entre treino e validação). A divisão é feita uma
+# única vez e salva em um manifesto (ver utilitarios/divisao.py),
+# reaproveitado nas próximas execuções enquanto as imagens forem as mesmas.
+nomes_treino, nomes_val, nomes_teste = divide_pasta(pasta_data, os.path.join(pasta_data, "divisao.npz"),
+                                                    perc_teste, perc_val, semente_divisao,
+                                                    padrao="*.jpg")
 
 # Mostra os nomes das imagens de treino, validação e teste
 print('Treino:',nomes_treino)
@@ -230,70 +164,82 @@ print(f"Total de imagens de teste: {len(nomes_teste)} ({100*len(nomes_teste)/tot
 print('Classes: ',classes,'Total = ',len(classes))
 
 # Cria o objeto que vai representar os bancos de treino validação e teste
-# usando a classe CustomDataset criada anteriormente
-# Aplica aumento de dados no treinamento com flip, rotação e 3 tipos de suavização
-# Usa uma biblioteca chamada Albumentation para fazer isso (A.)
-treino = CustomDataset(pasta_data,nomes_treino,largura_imagens,altura_imagens,classes,
-                       A.Compose([
-                                      A.Flip(0.5),  
-#                                     A.RandomRotate90(0.5),
-#                                     A.MotionBlur(p=0.2),
-#                                     A.MedianBlur(blur_limit=3, p=0.1),
-#                                     A.Blur(blur_limit=3, p=0.1),
-                                     ToTensorV2(p=1.0)
-                                 ], bbox_params={
-                                      'format': 'pascal_voc',
-                                      'label_fields': ['labels']
-                                 }))
-
-val = CustomDataset(pasta_data,nomes_val,largura_imagens,altura_imagens,classes,
-                       A.Compose([
-                                    ToTensorV2(p=1.0)
-                                 ], bbox_params={
-                                      'format': 'pascal_voc', 
-                                      'label_fields': ['labels']
-                                 }))
-
-teste = CustomDataset(pasta_data,nomes_teste,largura_imagens,altura_imagens,classes,
-                       A.Compose([
-                                    ToTensorV2(p=1.0)
-                                 ], bbox_params={
-                                      'format': 'pascal_voc', 
-                                      'label_fields': ['labels']
-                                 }))
+# usando a classe DeteccaoDataset
+# O banco já entrega cada imagem como um tensor uint8 (canais x altura x
+# largura), sem nenhuma transformação. O aumento de dados do treinamento
+# (flip, rotação e 3 tipos de suavização) é feito depois, no lote inteiro
+# (ver "aumento" logo abaixo)
+#
+# Se usar_cache for True, cada conjunto ganha o seu arquivo de cache dentro
+# da pasta das imagens
+def arquivo_cache(nome_conjunto):
+    if not usar_cache:
+        return None
+    return os.path.join(pasta_data, f"cache_{nome_conjunto}_{largura_imagens}x{altura_imagens}.bin")
+
+treino = DeteccaoDataset(pasta_data,nomes_treino,largura_imagens,altura_imagens,classes,
+                         None,
+                         arquivo_cache('treino'),
+                         indice_anotacoes)
+
+# Aumento de dados no treinamento, aplicado no lote inteiro de uma vez
+# (imagens e retângulos), no dispositivo onde o lote estiver (ver
+# utilitarios/aumento_deteccao.py). Cada valor é a probabilidade da
+# operação ser aplicada em uma imagem. Mesmas operações que antes eram
+# feitas imagem por imagem com o albumentations (Flip, RandomRotate90,
+# MotionBlur, MedianBlur e Blur). A mesma semente gera sempre os mesmos sorteios.
+aumento = AumentoDeteccao(flip_horizontal=0.5, flip_vertical=0.5, rotacao_90=0.5,
+                          desfoque_movimento=0.2, desfoque_mediana=0.1, desfoque=0.1,
+                          semente=semente_aumento)
+
+val = DeteccaoDataset(pasta_data,nomes_val,largura_imagens,altura_imagens,classes,
+                         None,
+                         arquivo_cache('val'),
+                         indice_anotacoes)
+
+teste = DeteccaoDataset(pasta_data,nomes_teste,largura_imagens,altura_imagens,classes,
+                         None,
+                         arquivo_cache('teste'),
+                         indice_anotacoes)
 
 # Ajusta os dados para quando o número de objetos em cada imagem
 # é diferente
-def collate_fn(lote):
-    return tuple(zip(*lote))
+collate_fn = junta_deteccao_empacotada if empacota_lotes else junta_deteccao
 
 # Cria os objetos para carregar lotes de imagens e anotações para treino
-lote_treino = DataLoader(
+lote_treino = cria_dataloader(
         treino,
-        batch_size=tamanho_lote,
+        tamanho_lote,
         shuffle=True,
-        collate_fn=collate_fn
+        collate_fn=collate_fn,
+        num_workers=processos_carregamento
     )
 
 # Cria os objetos para carregar lotes de imagens e anotações para validação
-lote_val = DataLoader(
+lote_val = cria_dataloader(
         val,
-        batch_size=tamanho_lote,
+        tamanho_lote,
         shuffle=True,
-        collate_fn=collate_fn
+        collate_fn=collate_fn,
+        num_workers=processos_carregamento
     )
 
 
 # Cria os objetos para carregar lotes de imagens e anotações para treino
-lote_teste = DataLoader(
+lote_teste = cria_dataloader(
         teste,
-        batch_size=tamanho_lote,
+        tamanho_lote,
         shuffle=True,
-        collate_fn=collate_fn
+        collate_fn=collate_fn,
+        num_workers=processos_carregamento
     )
 
 """### Mostrando algumas imagens"""
 
+# Biblioteca OpenCV, usada só para desenhar as anotações. É importada só
+# aqui para não atrasar o início do exemplo.
+import cv2
+
 # Vai colocar os retângulos de anotação dentro da imagem
 def cria_imagem_anotada(imagem,anotacoes,cor,espessura=2,mostra_texto=False):
 
@@ -320,12 +266,10 @@ figure = plt.figure(figsize=(8, 8))  # Cria o local para mostrar as imagens
 plt.axis("off")
 cols, rows = 2, 2  # Irá mostrar 4 imagens com suas anotações em uma grade 2x2
 
-# Pega um lote de imagens com sua estrutura de anotações
-images, targets = next(iter(lote_treino))
-# Converte as imagens para uso no dispositivo escolhido (GPU ou CPU)
-images = list(image.to(device) for image in images)
-# Converte as anotações para uso no dispositivo escolhido (GPU ou CPU)
-targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+# Pega um lote de imagens com sua estrutura de anotações e converte para uso
+# no dispositivo escolhido (GPU ou CPU). Os pixels ficam entre 0 e 1 (o
+# banco entrega as imagens em uint8).
+images, targets = prepara_lote_deteccao(next(iter(lote_treino)), device)
 
 # Laço para pegar 4 imagens do treino
 for i in range(0,4):
@@ -350,9 +294,13 @@ plt.show() # Este é o comando que vai mostrar as imagens
 # Ajusta a última camada para poder corresponder ao total de classes do
 # problema atual. 
 if nome_rede == "faster":
+   # Só a parte de detecção do torchvision é importada, e só aqui (o
+   # torchvision inteiro demora alguns segundos para ser importado)
+   from torchvision.models.detection import fasterrcnn_resnet50_fpn
+   from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
    # Usa um modelo pré-treinado da Faster RCNN com ResNet50 como 
    # espinha dorsal (backbone)
-   model = torchvision.models.detection.fasterrcnn_resnet50_fpn(pretrained=True)
+   model = fasterrcnn_resnet50_fpn(pretrained=True)
    # Pega o total de atributos de entrada da camada de previsão (classificação)
    total_atributos = model.roi_heads.box_predictor.cls_score.in_features
    # Altera a camada que faz a previsão das classes para o total de classes
@@ -371,6 +319,19 @@ print(model)
 otimizador = torch.optim.SGD(model.parameters(), lr=taxa_aprendizagem, 
                                                  momentum=momento,
                                                  weight_decay=peso_regularizador)
+
+# Recomputação de ativações (activation checkpointing) na ResNet da rede
+# (ver utilitarios/recomputacao.py)
+if compara_recomputacao_antes:
+    # Mede um passo de treinamento com um lote de treino, com e sem a
+    # recomputação (os pesos da rede voltam ao que eram antes)
+    images, targets = prepara_lote_deteccao(next(iter(lote_treino)), device)
+    model.train()
+    def passo():
+        sum(model(images, targets).values()).backward()
+    compara_recomputacao(model, passo, device)
+if recomputa_ativacoes:
+    print(f"Recomputação de ativações ligada em {ativa_recomputacao(model)} blocos da ResNet")
   
 # Cria o módulo do tensorboard de coleta de dados
 writer = SummaryWriter()
@@ -382,41 +343,54 @@ writer = SummaryWriter()
 def train(lotes, model, optimizer):
 
     size = len(lotes.dataset)  # Total de imagens
-    num_batches = int(size/tamanho_lote)   # Total de lotes
+    num_batches = len(lotes)   # Total de lotes (o último pode ter menos imagens)
+    # Diz o peso da perda de cada lote e quando ajustar os pesos (a cada
+    # "acumula_gradientes" lotes, ver utilitarios/acumulacao.py)
+    acumulacao = AcumulacaoGradientes(size, tamanho_lote, acumula_gradientes)
+    print(f"Lote efetivo: {tamanho_lote*acumula_gradientes} imagens ({acumulacao.total_passos} ajustes dos pesos)")
 
     model.train()  # Avisa que a rede vai entrar em modo de aprendizagem
+    optimizer.zero_grad()  # Começa a época sem gradientes acumulados
 
-    train_loss = 0  # Usado para calcular perda média
+    # Usado para calcular perda média. Fica no dispositivo (GPU ou CPU) para
+    # não precisar esperar a GPU a cada lote. Só é lido no final.
+    train_loss = torch.zeros((), device=device)
 
     # Pega um lote de imagens de cada vez do conjunto de treinamento
-    for batch, (images, targets) in enumerate(lotes):
+    for batch, lote in enumerate(lotes):
     
         # Coloca imagens e anotações no formato necessário (CPU ou GPU)
-        images = list(image.to(device) for image in images)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+        # (o banco entrega as imagens em uint8: a conversão para float entre
+        # 0 e 1 é feita aqui, no lote inteiro)
+        images, targets = prepara_lote_deteccao(lote, device, aumento)
 
         # Realiza a previsão e pega os valores de perda (no caso da detecção
         # nós podemos ter várias funções de perda trabalhando em conjunto)
         loss_dict = model(images, targets)
         loss_sum = sum(loss for loss in loss_dict.values()) # Soma todas as perdas 
 
-        train_loss += loss_sum.item() # Guarda para calcular a perda média
+        train_loss += loss_sum.detach() # Guarda para calcular a perda média
 
-        loss_sum.backward()        # Calcula os gradientes com base no erro (loss)
-        optimizer.step()       # Ajusta os pesos com base nos gradientes
-        optimizer.zero_grad()  # Zera os gradientes pois vai acumular para todas
-                               # as imagens do lote
+        # Calcula os gradientes com base no erro (loss). Eles são somados
+        # aos dos lotes anteriores do grupo, por isso a perda é multiplicada
+        # pela fração das imagens do grupo que estão neste lote.
+        (loss_sum*acumulacao.peso(batch)).backward()
+        if acumulacao.ajusta(batch):  # Último lote do grupo
+            optimizer.step()       # Ajusta os pesos com base nos gradientes
+            optimizer.zero_grad()  # Zera os gradientes para o próximo grupo
 
-        # Imprime informação a cada 2 lotes processados
-        if (batch) % 2 == 0:
+        # Imprime informação a cada "intervalo_log" lotes processados
+        if batch % intervalo_log == 0:
             # Mostra a perda e o total de imagens já processadas          
             print(f"Perda Total no Treino: {loss_sum.item():>7f} [{batch*tamanho_lote:>5d}/{len(lotes.dataset):>5d}]")
             # Mostra cada uma das perdas individualmente
             print('   Por partes: ',[(perda,loss_dict[perda].item()) for perda in loss_dict])
 
 
-    train_loss /= num_batches  # Como a perda foi calculada por lote, divide
-                               # pelo total de lotes para calcular a média
+    # Como a perda foi calculada por lote (sem o peso da acumulação), divide
+    # pelo total de lotes para calcular a média (só aqui o valor sai do
+    # dispositivo)
+    train_loss = train_loss.item() / num_batches
 
     return train_loss
 
@@ -425,72 +399,97 @@ def train(lotes, model, optimizer):
 # do conjunto usado para aprender)
 def validation(lotes, model):
 
-    size = len(lotes.dataset)  # Total de imagens
-    num_batches = int(size/tamanho_lote)   # Total de lotes
-
-    #model.eval()  # Avisa que a rede vai entrar em modo de aprendizagem
-
-    val_loss = 0  # Usado para calcular perda média
-
-    # Pega um lote de imagens de cada vez do conjunto de treinamento
-    for batch, (images, targets) in enumerate(lotes):
-    
-        # Coloca imagens e anotações no formato necessário (CPU ou GPU)
-        images = list(image.to(device) for image in images)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-
-        # Realiza a previsão e pega os valores de perda (no caso da detecção
-        # nós podemos ter várias funções de perda trabalhando em conjunto)
-        with torch.no_grad():
-           loss_dict = model(images, targets)
+    # A rede fica no modo de avaliação e passa uma única vez por cada lote:
+    # a mesma passada gera as detecções (para o mAP) e as perdas, que a
+    # Faster RCNN normalmente só calcula no modo de treinamento (ver
+    # deteccoes_e_perdas em utilitarios/avaliacao.py)
+    acumulador, val_loss = avalia_deteccao(model, lotes, len(classes), device, calcula_perda=True)
 
-        loss_sum = sum(loss for loss in loss_dict.values()) # Soma todas as perdas 
+    # Calcula o mAP (média da precisão média de cada classe) com as
+    # detecções da rede (ver utilitarios/metricas.py)
+    resultados = acumulador.calcula()
 
-        val_loss += loss_sum.item() # Guarda para calcular a perda média
-
-
-    val_loss /= num_batches  # Como a perda foi calculada por lote, divide
-                               # pelo total de lotes para calcular a média
-
-    # Ainda não implementamos métricas de desempenho
     print("Informações na Validação:")
     print(f"===> Perda total média: {val_loss:>8f}")            
-    return val_loss
+    print(f"===> mAP@0.5: {resultados['map_50']:>0.4f}  mAP@[.5:.95]: {resultados['map']:>0.4f}")
+    return val_loss, resultados['map']
 
 """## Treinando a Rede Neural (Aprendizagem)"""
 
 # A aprendizagem agora tem parada antecipada (early stopping)
-# Diferente de v5, estamos acompanhando a perda e não a acurácia 
-menor_perda = 10000  # Guarda a menor perda no conjunto de validação até o momento
+# Diferente de v5, estamos acompanhando o mAP@[.5:.95] e não a acurácia 
+maior_map = None  # Guarda o maior mAP no conjunto de validação até o momento (None = nenhuma época ainda)
 total_sem_melhora = 0  # Guarda quantas épocas passou sem melhoria na acurácia
 
+# O estado completo do treinamento (rede, otimizador, época, variáveis da
+# parada antecipada e dos números aleatórios) é salvo em segundo plano, sem
+# parar o treinamento para esperar o disco (ver utilitarios/checkpoint.py)
+gravador = GravadorCheckpoint()
+# O arquivo do checkpoint depende dos hiperparâmetros abaixo: um treinamento
+# com outros valores não continua o checkpoint deste (e vice-versa). O
+# checkpoint é apagado quando o treinamento termina.
+config_treino = {'nome_rede': nome_rede, 'largura_imagens': largura_imagens,
+                 'altura_imagens': altura_imagens, 'classes': classes,
+                 'tamanho_lote': tamanho_lote, 'acumula_gradientes': acumula_gradientes,
+                 'taxa_aprendizagem': taxa_aprendizagem, 'momento': momento,
+                 'peso_regularizador': peso_regularizador, 'perc_teste': perc_teste,
+                 'perc_val': perc_val, 'semente_divisao': semente_divisao,
+                 'semente_aumento': semente_aumento}
+arquivo_checkpoint = nome_checkpoint(pasta_data+"checkpoint_"+nome_rede, config_treino)
+epoca_inicial = 0
+if retomar:
+    retomado = retoma_checkpoint(arquivo_checkpoint, model, otimizador, device=device,
+                                 config=config_treino)
+    if retomado is not None:
+        epoca_inicial, variaveis = retomado
+        maior_map = variaveis['maior_map']
+        if 'estado_aumento' in variaveis:
+            aumento.restaura(variaveis['estado_aumento'])
+        total_sem_melhora = variaveis['total_sem_melhora']
+        print(f"Continuando o treinamento interrompido a partir da época {epoca_inicial+1}")
+        if variaveis['terminou']:
+            epoca_inicial = epocas  # Já tinha acabado a paciência
+
 # Passa por todas as imagens várias vezes (a quantidade de vezes
 # é definida pelo hiperparâmetro "epocas")
-for epoca in range(epocas):
+for epoca in range(epoca_inicial, epocas):
 
     print(f"-------------------------------")
     print(f"Época {epoca+1} \n-------------------------------")
     train_loss = train(lote_treino, model, otimizador)
-    val_loss = validation(lote_val, model)
+    val_loss, val_map = validation(lote_val, model)
 
     # Guarda informações para o tensorboard pode criar os gráficos depois
     writer.add_scalars('Loss', {'train':train_loss,'val':val_loss}, epoca)
+    writer.add_scalar('mAP/val', val_map, epoca)
 
-    # Diminui uma tolerancia no valor da menor perda para que melhoras muito
-    # pequenas não sejam consideradas
-    if val_loss < (menor_perda-tolerancia): 
+    # Soma uma tolerancia no valor do maior mAP para que melhoras muito
+    # pequenas não sejam consideradas. A rede da primeira época é sempre
+    # salva, mesmo com mAP zero, para que exista um modelo para o teste.
+    if maior_map is None or val_map > (maior_map+tolerancia): 
       # Salva a melhor rede encontrada até o momento
-      torch.save(model.state_dict(), pasta_data+"modelo_treinado_"+nome_rede+".pth")
-      print("Salvou o modelo com a maior acurácia na validação até agora em modelo_treinado_"+nome_rede+".pth")      
-      menor_perda = val_loss
+      gravador.salva(pasta_data+"modelo_treinado_"+nome_rede+".pth", model.state_dict())
+      print("Salvou o modelo com o maior mAP na validação até agora em modelo_treinado_"+nome_rede+".pth")      
+      maior_map = val_map
       total_sem_melhora = 0
     else: 
       total_sem_melhora += 1 
-      print(f"Sem melhora há {total_sem_melhora} épocas ({100*val_loss}% <= {100*(menor_perda-tolerancia)}%)")
-    if total_sem_melhora > paciencia:
+      print(f"Sem melhora há {total_sem_melhora} épocas ({val_map:.4f} <= {maior_map+tolerancia:.4f})")
+    terminou = total_sem_melhora > paciencia
+    # Salva o estado completo do treinamento (em segundo plano)
+    if (epoca+1) % intervalo_checkpoint == 0 or terminou or epoca+1 == epocas:
+      gravador.salva(arquivo_checkpoint,
+                     monta_checkpoint(epoca+1, model, otimizador,
+                                      {'maior_map': maior_map,
+                                       'estado_aumento': aumento.estado(),
+                                       'total_sem_melhora': total_sem_melhora,
+                                       'terminou': terminou}, config=config_treino))
+    if terminou:
       print(f"Acabou a paciência com {epoca+1} épocas ")
       break
 
+gravador.fecha()  # Espera terminar a gravação dos arquivos
+descarta_checkpoint(arquivo_checkpoint)  # Terminou: o próximo treinamento começa do zero
 print("Terminou a fase de aprendizagem !")
 
 writer.close()
@@ -520,12 +519,10 @@ figure = plt.figure(figsize=(8, 8))  # Cria o local para mostrar as imagens
 plt.axis("off")
 cols, rows = 2, 2  # Irá mostrar 4 imagens com suas anotações em uma grade 2x2
 
-# Pega um lote de imagens com sua estrutura de anotações
-images, targets = next(iter(lote_teste))
-# Converte as imagens para uso no dispositivo escolhido (GPU ou CPU)
-images = list(image.to(device) for image in images)
-# Converte as anotações para uso no dispositivo escolhido (GPU ou CPU)
-targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+# Pega um lote de imagens com sua estrutura de anotações e converte para uso
+# no dispositivo escolhido (GPU ou CPU). Os pixels ficam entre 0 e 1 (o
+# banco entrega as imagens em uint8).
+images, targets = prepara_lote_deteccao(next(iter(lote_teste)), device)
 
 # Modo de uso do modelo já treinado
 model.eval()
@@ -559,5 +556,24 @@ plt.show() # Este é o comando que vai mostrar as imagens
 
 """## Gerando algumas estatísticas no conjunto de teste
 
-AINDA NÃO FOI IMPLEMENTADO
+Calcula a precisão média (AP) de cada classe, como no COCO: com IoU mínima de 0.5 (AP50) e a média para IoU entre 0.5 e 0.95 (AP50:95). O mAP é a média entre as classes.
 """
+
+# Passa o conjunto de teste inteiro pela rede, em lotes. Só os totais de
+# acertos por faixa de score ficam guardados (ver utilitarios/metricas.py)
+acumulador = avalia_deteccao(model, lote_teste, len(classes), device)
+print(acumulador.relatorio(classes))
+resultados = acumulador.calcula()
+
+# Curvas de precisão x revocação (IoU 0.5) de cada classe
+for i, classe in enumerate(classes):
+    if resultados['total_reais'][i] > 0:
+        revocacao, precisao = resultados['curvas_pr'][i]
+        plt.plot(revocacao, precisao,
+                 label=f"{classe} (AP50 = {resultados['ap_50'][i]:.3f})")
+plt.xlabel("Revocação")
+plt.ylabel("Precisão")
+plt.xlim(0, 1)
+plt.ylim(0, 1.05)
+plt.legend()
+plt.show()
@@ -0,0 +1,17 @@
+# Treina as redes dos exemplos pela linha de comando, sem editar os scripts
+#
+# Exemplos:
+#
+#    python treina.py --tarefa classificacao --pasta_data ./data/ --nome_rede densenet
+#    python treina.py --tarefa segmentacao --pasta_data ./data/ --epocas 20
+#    python treina.py --tarefa deteccao --pasta_data ./data/condensadores/ --tamanho_lote 4
+#    python treina.py --config minha_config.json --taxa_aprendizagem 0.001
+#    python treina.py --tarefa deteccao --mostra_config
+#    python treina.py --tarefa segmentacao --pasta_data ./data/ --tamanho_lote 2 --compara_recomputacao
+#
+# Ver utilitarios/motor.py para a lista de hiperparâmetros.
+
+from utilitarios.motor import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+# Funções e classes auxiliares compartilhadas pelos exemplos (exemplo_pytorch_v*.py)
+#
+# Cada módulo é independente e deve ser importado diretamente, por exemplo:
+#
+#    from utilitarios.cache_deteccao import CacheDeteccao
+#
+# Para usar no Google Colab, envie (ou clone) a pasta "utilitarios" junto
+# com o exemplo que for rodar.
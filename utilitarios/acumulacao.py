@@ -0,0 +1,53 @@
+# Acumulação de gradientes: simula um lote grande (ex.: 32 imagens) com
+# vários lotes pequenos que cabem na memória
+#
+# Os gradientes de "micro_lotes" lotes seguidos são somados e o otimizador
+# só ajusta os pesos no fim de cada grupo. Para que a soma seja igual ao
+# gradiente da perda média do lote grande, a perda de cada lote é
+# multiplicada pela fração das imagens do grupo que estão nele (peso). Com
+# perdas que já são médias por imagem (ou por pixel), como a
+# CrossEntropyLoss do v5, o gradiente fica igual ao do lote grande.
+#
+# O último grupo da época pode ser menor (o total de lotes nem sempre é
+# múltiplo de micro_lotes, e o último lote pode ter menos imagens): os pesos
+# levam isso em conta e os pesos da rede são sempre ajustados no último lote.
+# Assim nenhum gradiente passa de uma época para a outra, e a validação, a
+# parada antecipada e os checkpoints (que acontecem entre as épocas) nunca
+# encontram um grupo pela metade.
+#
+# A BatchNorm continua vendo só as imagens de cada lote: as médias e
+# variâncias são calculadas com tamanho_lote imagens, não com o lote grande.
+
+
+class AcumulacaoGradientes:
+    # total_imagens = total de imagens da época (len(dataloader.dataset))
+    # tamanho_lote = total de imagens em cada lote (o último pode ter menos)
+    # micro_lotes = total de lotes somados antes de cada ajuste dos pesos
+    #               (1 = sem acumulação, ajusta os pesos a cada lote)
+    def __init__(self, total_imagens, tamanho_lote, micro_lotes=1):
+        if micro_lotes < 1:
+            raise ValueError(f"micro_lotes deve ser pelo menos 1, recebeu {micro_lotes!r}")
+        self.total_imagens = total_imagens
+        self.tamanho_lote = tamanho_lote
+        self.micro_lotes = micro_lotes
+        self.total_lotes = -(-total_imagens // tamanho_lote)
+
+    # Total de ajustes dos pesos em uma época
+    @property
+    def total_passos(self):
+        return -(-self.total_lotes // self.micro_lotes)
+
+    # Total de imagens dos lotes de "inicio" até "fim" (sem incluir o fim)
+    def _imagens(self, inicio, fim):
+        return min(fim*self.tamanho_lote, self.total_imagens) - inicio*self.tamanho_lote
+
+    # Peso da perda do lote "batch": fração das imagens do seu grupo que
+    # estão nele
+    def peso(self, batch):
+        inicio = batch // self.micro_lotes * self.micro_lotes
+        fim = min(inicio + self.micro_lotes, self.total_lotes)
+        return self._imagens(batch, batch+1) / self._imagens(inicio, fim)
+
+    # True se o lote "batch" é o último do seu grupo (hora de ajustar os pesos)
+    def ajusta(self, batch):
+        return (batch+1) % self.micro_lotes == 0 or batch+1 == self.total_lotes
@@ -0,0 +1,185 @@
+# Aumento de dados para detecção aplicado no lote inteiro
+#
+# Substitui o A.Compose([A.Flip, A.RandomRotate90, A.MotionBlur,
+# A.MedianBlur, A.Blur]) do albumentations, que é aplicado imagem por imagem
+# (e convertendo cada imagem e os seus retângulos para o formato dele). Aqui
+# tudo é feito direto nos tensores uint8 do lote (na CPU ou na GPU, onde o
+# lote estiver): os desfoques de uma vez só em todas as imagens sorteadas,
+# os flips e giros de cada imagem juntos em uma única cópia, e os
+# retângulos de todas as imagens com uma única operação.
+#
+# O lote precisa estar no formato empacotado (LoteDeteccao, ver
+# utilitarios/conjuntos.py). O uso normal é pelo prepara_lote_deteccao
+# (utilitarios/transformacoes_lote.py), que aplica o aumento depois de
+# levar o lote para o dispositivo.
+#
+# Os sorteios usam um gerador próprio (na CPU), criado com a semente dada:
+# a mesma semente e a mesma sequência de lotes geram sempre os mesmos
+# aumentos, qualquer que seja o dispositivo ou o total de processos de
+# carregamento. estado() e restaura() permitem guardar o gerador em um
+# checkpoint.
+
+import torch
+import torch.nn.functional as F
+
+
+class AumentoDeteccao:
+    # Cada valor é a probabilidade de aplicar a operação em uma imagem
+    #
+    # flip_horizontal, flip_vertical = espelha a imagem
+    # rotacao_90 = gira 90, 180 ou 270 graus (só 180 se a imagem não for quadrada)
+    # desfoque_movimento = desfoque em linha reta, com ângulo qualquer e
+    #                      tamanho ímpar entre 3 e limite_movimento (A.MotionBlur)
+    # desfoque_mediana = mediana 3x3 (A.MedianBlur(blur_limit=3))
+    # desfoque = média 3x3 (A.Blur(blur_limit=3))
+    def __init__(self, flip_horizontal=0.5, flip_vertical=0.5, rotacao_90=0.0,
+                 desfoque_movimento=0.0, desfoque_mediana=0.0, desfoque=0.0,
+                 limite_movimento=7, semente=0):
+        self.flip_horizontal = flip_horizontal
+        self.flip_vertical = flip_vertical
+        self.rotacao_90 = rotacao_90
+        self.desfoque_movimento = desfoque_movimento
+        self.desfoque_mediana = desfoque_mediana
+        self.desfoque = desfoque
+        self.limite_movimento = limite_movimento
+        self.gerador = torch.Generator().manual_seed(semente)
+
+    def estado(self):
+        return self.gerador.get_state()
+
+    def restaura(self, estado):
+        self.gerador.set_state(estado.cpu())
+
+    # Imagens sorteadas (máscara na CPU, uma posição por imagem)
+    def _sorteia(self, total, probabilidade):
+        return torch.rand(total, generator=self.gerador) < probabilidade
+
+    # Aplica o aumento em um LoteDeteccao e retorna um novo LoteDeteccao (o
+    # original não é alterado)
+    def __call__(self, lote):
+        imagens, boxes = lote.imagens.clone(), lote.boxes
+        total, altura, largura = imagens.shape[0], imagens.shape[-2], imagens.shape[-1]
+        # Imagem de cada objeto (para passar as escolhas de cada imagem para
+        # os seus retângulos)
+        imagem_do_objeto = torch.repeat_interleave(torch.arange(total), lote.inicios.diff())
+
+        def dos_objetos(mascara):
+            return mascara[imagem_do_objeto].to(boxes.device, non_blocking=True).unsqueeze(1)
+
+        # Sorteios das operações geométricas
+        horizontal = self._sorteia(total, self.flip_horizontal)
+        vertical = self._sorteia(total, self.flip_vertical)
+        giradas = self._sorteia(total, self.rotacao_90)
+        giros = torch.randint(1, 4, (total,), generator=self.gerador)
+        if altura != largura:
+            giros.fill_(2)  # 90 e 270 graus mudariam o tamanho da imagem
+        giros[~giradas] = 0
+
+        # Retângulos de todas as imagens, uma operação de cada vez
+        x1, y1, x2, y2 = boxes.unbind(1)
+        boxes = torch.where(dos_objetos(horizontal), torch.stack((largura-x2, y1, largura-x1, y2), 1), boxes)
+        x1, y1, x2, y2 = boxes.unbind(1)
+        boxes = torch.where(dos_objetos(vertical), torch.stack((x1, altura-y2, x2, altura-y1), 1), boxes)
+        x1, y1, x2, y2 = boxes.unbind(1)
+        # Depois de girar k*90 graus no sentido anti-horário (como o torch.rot90)
+        girados = {1: (y1, largura-x2, y2, largura-x1),
+                   2: (largura-x2, altura-y2, largura-x1, altura-y1),
+                   3: (altura-y2, x1, altura-y1, x2)}
+        for k, novos in girados.items():
+            boxes = torch.where(dos_objetos(giros == k), torch.stack(novos, 1), boxes)
+
+        # Nas imagens, os flips e o giro de cada imagem são feitos juntos e
+        # copiados de volta uma única vez (mais rápido, na CPU, do que juntar
+        # as imagens sorteadas de cada operação e espalhá-las de volta)
+        for i in (horizontal | vertical | giradas).nonzero().squeeze(1).tolist():
+            dims = [dim for dim, sorteada in ((-1, horizontal[i]), (-2, vertical[i])) if sorteada]
+            imagem = imagens[i].flip(dims) if dims else imagens[i]
+            if giros[i]:
+                imagem = torch.rot90(imagem, int(giros[i]), dims=(1, 2))
+            imagens[i].copy_(imagem)
+
+        # Desfoques (não mudam os retângulos)
+        sorteadas = self._sorteia(total, self.desfoque_movimento)
+        tamanhos = 2*torch.randint(1, self.limite_movimento//2 + 1, (total,), generator=self.gerador) + 1
+        angulos = torch.rand(total, generator=self.gerador) * torch.pi
+        nucleos = _nucleos_movimento(tamanhos[sorteadas], angulos[sorteadas], self.limite_movimento)
+        _aplica(imagens, sorteadas, lambda X: _desfoque_movimento(X, nucleos, self.limite_movimento))
+        _aplica(imagens, self._sorteia(total, self.desfoque_mediana), _mediana_3x3)
+        _aplica(imagens, self._sorteia(total, self.desfoque), _media_3x3)
+
+        return lote._replace(imagens=imagens, boxes=boxes)
+
+
+# Aplica "funcao" nas imagens sorteadas (todas juntas) e copia o resultado
+# de volta para o lote
+def _aplica(imagens, sorteadas, funcao):
+    indices = sorteadas.nonzero().squeeze(1).tolist()
+    if indices:
+        resultado = funcao(imagens.index_select(0, torch.tensor(indices, device=imagens.device)))
+        for j, i in enumerate(indices):
+            imagens[i].copy_(resultado[j])
+
+
+# As operações abaixo trabalham direto com os tensores uint8 (n x canais x
+# A x L): somam ou comparam cópias deslocadas da imagem (com a borda já
+# acrescentada), em vez de usar convoluções em float. Ficam rápidas também
+# na CPU e dão o mesmo resultado do OpenCV.
+
+# Cópias deslocadas (sem cópia de memória, são fatias) da imagem X, que tem
+# uma borda de k//2 pixels: uma para cada posição (dy, dx) de uma janela k x k
+def _deslocadas(X, altura, largura, posicoes):
+    return [X[..., dy:dy+altura, dx:dx+largura] for dy, dx in posicoes]
+
+
+# Células de cada núcleo do desfoque em linha reta (uma lista de posições
+# (dy, dx) dentro de uma janela limite x limite por imagem): as células a
+# menos de meio pixel da reta que passa pelo centro com o ângulo dado, até
+# a metade do tamanho para cada lado
+def _nucleos_movimento(tamanhos, angulos, limite):
+    coordenadas = torch.arange(limite, dtype=torch.float32) - limite//2
+    v, u = torch.meshgrid(coordenadas, coordenadas, indexing='ij')
+    cos, sen = angulos.cos()[:, None, None], angulos.sin()[:, None, None]
+    ao_longo = u*cos + v*sen
+    distancia = (-u*sen + v*cos).abs()
+    nucleos = (distancia <= 0.5) & (ao_longo.abs() <= (tamanhos//2)[:, None, None])
+    return [nucleo.nonzero().tolist() for nucleo in nucleos]
+
+
+# Desfoque em linha reta: média das células do núcleo de cada imagem (todas
+# com o mesmo peso, como no A.MotionBlur), com borda espelhada
+def _desfoque_movimento(imagens, nucleos, limite):
+    altura, largura = imagens.shape[-2:]
+    X = F.pad(imagens, (limite//2,)*4, mode='reflect').to(torch.int16)
+    resultado = torch.empty_like(imagens)
+    for i, nucleo in enumerate(nucleos):
+        soma = sum(_deslocadas(X[i], altura, largura, nucleo))
+        resultado[i] = (soma + len(nucleo)//2) // len(nucleo)
+    return resultado
+
+
+# Média 3x3 (igual ao cv2.blur, com borda espelhada). A soma é separável:
+# primeiro as linhas e depois as colunas.
+def _media_3x3(imagens):
+    altura, largura = imagens.shape[-2:]
+    X = F.pad(imagens, (1, 1, 1, 1), mode='reflect').to(torch.int16)
+    linhas = X[..., :, 0:largura] + X[..., :, 1:largura+1] + X[..., :, 2:largura+2]
+    soma = linhas[..., 0:altura, :] + linhas[..., 1:altura+1, :] + linhas[..., 2:altura+2, :]
+    return ((soma + 4) // 9).to(torch.uint8)
+
+
+# Rede de comparações que deixa a mediana de 9 valores na posição 4
+# (Devillard, "Fast median search", opt_med9)
+_REDE_MEDIANA_9 = [(1, 2), (4, 5), (7, 8), (0, 1), (3, 4), (6, 7), (1, 2), (4, 5), (7, 8),
+                   (0, 3), (5, 8), (4, 7), (3, 6), (1, 4), (2, 5), (4, 7), (4, 2), (6, 4),
+                   (4, 2)]
+
+
+# Mediana 3x3 (igual ao cv2.medianBlur, que repete a borda), só com mínimos
+# e máximos elemento a elemento
+def _mediana_3x3(imagens):
+    altura, largura = imagens.shape[-2:]
+    X = F.pad(imagens, (1, 1, 1, 1), mode='replicate')
+    p = _deslocadas(X, altura, largura, [(dy, dx) for dy in range(3) for dx in range(3)])
+    for a, b in _REDE_MEDIANA_9:
+        p[a], p[b] = torch.minimum(p[a], p[b]), torch.maximum(p[a], p[b])
+    return p[4]
@@ -0,0 +1,154 @@
+# Avaliação de redes treinadas em um conjunto de teste inteiro
+#
+# As imagens passam pela rede em lotes (e não uma de cada vez) e as
+# predições ficam no dispositivo (CPU ou GPU) até o final, acumuladas em uma
+# matriz de confusão (ou, na detecção, no acumulador do mAP). Assim não
+# existe uma sincronização GPU->CPU por imagem na classificação.
+#
+# Na detecção, deteccoes_e_perdas() calcula as detecções e as perdas com uma
+# única passada da rede no modo de avaliação (a Faster R-CNN do torchvision
+# só calcula as perdas no modo de treinamento, o que obrigava a passar duas
+# vezes pelo conjunto de validação).
+
+import contextlib
+import torch
+from utilitarios.conjuntos import anotacoes_lote
+from utilitarios.metricas import AcumuladorDeteccao, MatrizConfusao
+from utilitarios.transformacoes_lote import prepara_lote_deteccao
+
+
+# Avalia uma rede de classificação
+#
+# model = rede já treinada
+# dataloader = fornece os lotes de imagens e classes do conjunto de teste
+# total_classes = total de classes do problema
+# device = dispositivo onde a rede está ("cpu" ou "cuda")
+# modo = ModoDesempenho usado no treinamento (ver utilitarios/precisao.py):
+#        as imagens passam pela rede com a mesma precisão e o mesmo formato
+#        de memória da validação. None = float32, formato normal.
+#
+# Retorna a MatrizConfusao acumulada (use .calcula() para as métricas e
+# .relatorio() para o texto no formato do sklearn)
+def avalia_classificacao(model, dataloader, total_classes, device, modo=None):
+    matriz_confusao = MatrizConfusao(total_classes, device)
+    model.eval()  # Coloca a rede no modo de avaliação (e não de aprendizagem)
+    with torch.no_grad():  # Avisa que não devem ser calculados gradientes
+        for X, y in dataloader:
+            X = X.to(device, non_blocking=True)
+            y = y.to(device, non_blocking=True)
+            if modo is not None:
+                X = modo.prepara_entrada(X)
+            with modo.autocast() if modo is not None else contextlib.nullcontext():
+                predicao = model(X).argmax(1)  # Pega a classe com maior valor
+            matriz_confusao.atualiza(predicao, y)
+    return matriz_confusao
+
+
+# Detecções e perdas de uma Faster R-CNN (torchvision) com uma única passada
+# no modo de avaliação
+#
+# A rede roda normalmente (model.eval()) e ganchos (forward hooks) guardam o
+# que é preciso para as perdas: as anotações redimensionadas, as saídas da
+# RPN, as âncoras, as propostas e as saídas da camada de previsão. As perdas
+# são então calculadas com as mesmas funções usadas no treinamento, só que
+# sobre as propostas da avaliação (sem as anotações acrescentadas como
+# propostas). O sorteio das âncoras e propostas que entram nas perdas usa
+# sempre a mesma semente, então a perda não varia de uma época para outra só
+# pelo sorteio, e não mexe nos números aleatórios do treinamento.
+#
+# Retorna (detecções, dicionário de perdas com as mesmas chaves do treino)
+def deteccoes_e_perdas(model, images, targets):
+    from torchvision.models.detection.rpn import concat_box_prediction_layers
+    from torchvision.models.detection.roi_heads import fastrcnn_loss
+    rpn, roi_heads = model.rpn, model.roi_heads
+    capturado = {}
+
+    def guarda(nome):
+        def gancho(modulo, entrada, saida):
+            capturado[nome] = saida
+        return gancho
+
+    ganchos = [model.transform.register_forward_hook(guarda('transform')),
+               rpn.head.register_forward_hook(guarda('rpn_head')),
+               rpn.anchor_generator.register_forward_hook(guarda('ancoras')),
+               rpn.register_forward_hook(guarda('rpn')),
+               roi_heads.box_predictor.register_forward_hook(guarda('previsao'))]
+    try:
+        # No modo de avaliação as anotações são só redimensionadas junto com
+        # as imagens (e ignoradas pela RPN e pelas cabeças)
+        deteccoes = model(images, targets)
+    finally:
+        for gancho in ganchos:
+            gancho.remove()
+    _, anotacoes = capturado['transform']
+    objectness, pred_bbox_deltas = capturado['rpn_head']
+    ancoras = capturado['ancoras']
+    propostas = capturado['rpn'][0]
+    class_logits, box_regression = capturado['previsao']
+
+    dispositivos = [class_logits.device.index or 0] if class_logits.is_cuda else []
+    with torch.random.fork_rng(devices=dispositivos):
+        torch.manual_seed(0)
+        # Perdas da RPN (igual a RegionProposalNetwork.forward no treino)
+        objectness, pred_bbox_deltas = concat_box_prediction_layers(objectness, pred_bbox_deltas)
+        rotulos, reais = rpn.assign_targets_to_anchors(ancoras, anotacoes)
+        alvos_regressao = rpn.box_coder.encode(reais, ancoras)
+        loss_objectness, loss_rpn_box_reg = rpn.compute_loss(objectness, pred_bbox_deltas,
+                                                             rotulos, alvos_regressao)
+
+        # Perdas da cabeça de detecção sobre uma amostra das propostas. Imagens
+        # sem nenhuma proposta (rede ainda no começo do treino, por exemplo)
+        # não entram nessas perdas.
+        boxes_reais = [t['boxes'].to(propostas[0].dtype) for t in anotacoes]
+        com_propostas = [i for i in range(len(propostas)) if len(propostas[i])]
+        indices_reais, rotulos = roi_heads.assign_targets_to_proposals(
+            [propostas[i] for i in com_propostas], [boxes_reais[i] for i in com_propostas],
+            [anotacoes[i]['labels'] for i in com_propostas])
+        amostras = roi_heads.subsample(rotulos)
+        inicios = [0] + torch.tensor([len(proposta) for proposta in propostas]).cumsum(0).tolist()
+        linhas, rotulos_amostra, alvos_regressao = [], [], []
+        for j, (i, amostra) in enumerate(zip(com_propostas, amostras)):
+            reais = boxes_reais[i] if boxes_reais[i].numel() else propostas[i].new_zeros((1, 4))
+            linhas.append(amostra + inicios[i])
+            rotulos_amostra.append(rotulos[j][amostra])
+            alvos_regressao.append(roi_heads.box_coder.encode_single(reais[indices_reais[j][amostra]],
+                                                                     propostas[i][amostra]))
+        if linhas:
+            linhas = torch.cat(linhas)
+            loss_classifier, loss_box_reg = fastrcnn_loss(class_logits[linhas], box_regression[linhas],
+                                                          rotulos_amostra, alvos_regressao)
+        else:
+            loss_classifier = loss_box_reg = class_logits.new_zeros(())
+    perdas = {'loss_classifier': loss_classifier, 'loss_box_reg': loss_box_reg,
+              'loss_objectness': loss_objectness, 'loss_rpn_box_reg': loss_rpn_box_reg}
+    return deteccoes, perdas
+
+
+# Avalia uma rede de detecção (Faster R-CNN e outras do torchvision)
+#
+# dataloader = fornece os lotes (lista de imagens e lista de anotações, ou
+#              LoteDeteccao, ver utilitarios/conjuntos.py)
+# calcula_perda = também calcula a perda média (só Faster R-CNN), na mesma
+#                 passada (ver deteccoes_e_perdas)
+#
+# Retorna o AcumuladorDeteccao (use .calcula() para o mAP e as curvas de
+# precisão x revocação e .relatorio() para o texto). Com calcula_perda=True
+# retorna (acumulador, perda média por lote).
+def avalia_deteccao(model, dataloader, total_classes, device, calcula_perda=False):
+    acumulador = AcumuladorDeteccao(total_classes)
+    # Soma das perdas (fica no dispositivo e só é lida no final)
+    perda = torch.zeros((), device=device)
+    model.eval()  # No modo de avaliação a rede retorna as detecções
+    with torch.no_grad():
+        for lote in dataloader:
+            images, anotacoes = prepara_lote_deteccao(lote, device)
+            if calcula_perda:
+                previsoes, perdas = deteccoes_e_perdas(model, images, anotacoes)
+                perda += sum(perdas.values()).float()
+            else:
+                previsoes = model(images)
+            # As anotações que ficaram na CPU (evita copiar de volta da GPU)
+            acumulador.atualiza(previsoes, anotacoes_lote(lote))
+    if calcula_perda:
+        return acumulador, perda.item() / max(1, len(dataloader))
+    return acumulador
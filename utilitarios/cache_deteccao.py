@@ -0,0 +1,195 @@
+# Cache em disco para o banco de imagens de detecção (exemplo_pytorch_v6.py)
+#
+# Decodificar o JPEG, converter de BGR para RGB, redimensionar e ler o XML
+# de anotações é sempre o mesmo trabalho em todas as épocas. Este módulo faz
+# esse trabalho uma única vez e guarda o resultado em um único arquivo binário
+# que depois é mapeado em memória (memmap). Nas épocas seguintes as imagens
+# são apenas "fatias" (views) do arquivo, sem cópia e sem decodificação.
+#
+# Organização do arquivo (tudo em sequência):
+#
+# - cabeçalho: 8 inteiros de 64 bits (ver _CAMPOS_CABECALHO)
+# - pixels: total_imagens x altura x largura x 3 (uint8, RGB)
+# - retângulos: total_retangulos x 4 (float32, xmin,ymin,xmax,ymax já
+#   redimensionados para largura x altura)
+# - classes: total_retangulos (int64, índice na lista de classes)
+# - inícios: total_imagens+1 (int64). Os retângulos da imagem i estão entre
+#   inicios[i] e inicios[i+1]
+
+import os
+import zlib
+import numpy as np
+from utilitarios.indice_voc import le_xml_voc, redimensiona_boxes
+
+_MAGICO = 0x43414348454445  # "CACHEDE" em hexadecimal, identifica o arquivo
+_VERSAO = 2  # 2: imagens lidas com utilitarios/decodificacao.py
+_CAMPOS_CABECALHO = ['magico','versao','total_imagens','altura','largura',
+                     'total_retangulos','assinatura','reservado']
+_TAMANHO_CABECALHO = 8*len(_CAMPOS_CABECALHO)
+
+
+# Calcula uma assinatura (número inteiro) que muda sempre que a lista de
+# imagens, as classes, o tamanho final ou a data de modificação de algum
+# arquivo mudar. Se a assinatura gravada no cache for diferente, o cache
+# é refeito.
+def assinatura_cache(pasta, nomes_arquivos, largura, altura, classes):
+    partes = [str(largura), str(altura), ','.join(classes)]
+    for nome in nomes_arquivos:
+        nome_anotacao = nome[:-4] + '.xml'
+        partes.append(nome)
+        partes.append(str(os.path.getmtime(os.path.join(pasta, nome))))
+        partes.append(str(os.path.getmtime(os.path.join(pasta, nome_anotacao))))
+    return zlib.crc32('\n'.join(partes).encode('utf-8'))
+
+
+# Calcula onde começa cada parte do arquivo (em bytes)
+def _posicoes(total_imagens, altura, largura, total_retangulos):
+    inicio_pixels = _TAMANHO_CABECALHO
+    fim_pixels = inicio_pixels + total_imagens*altura*largura*3
+    # Alinha em 8 bytes para os tensores float32/int64 que vêm depois
+    inicio_retangulos = (fim_pixels + 7) // 8 * 8
+    inicio_classes = inicio_retangulos + total_retangulos*4*4
+    inicio_inicios = inicio_classes + total_retangulos*8
+    tamanho_total = inicio_inicios + (total_imagens+1)*8
+    return inicio_pixels, inicio_retangulos, inicio_classes, inicio_inicios, tamanho_total
+
+
+# Pega os retângulos (coordenadas originais) e as classes de uma imagem, do
+# índice de anotações se ele for passado ou direto do arquivo XML
+def _le_anotacao(pasta, nome_imagem, classes, indice=None):
+    nome_anotacao = nome_imagem[:-4] + '.xml'
+    if indice is not None:
+        return indice.anotacoes(indice.posicao(nome_anotacao))
+    _, _, nomes_classes, boxes = le_xml_voc(os.path.join(pasta, nome_anotacao))
+    labels = [classes.index(nome_classe) for nome_classe in nomes_classes]
+    return (np.asarray(boxes, dtype=np.float32).reshape(-1, 4),
+            np.asarray(labels, dtype=np.int64))
+
+
+# Cria o arquivo de cache. Decodifica e redimensiona cada imagem apenas uma
+# vez e grava os pixels (uint8) e as anotações já redimensionadas.
+# O arquivo é escrito com outro nome e renomeado no final, para que uma
+# execução interrompida nunca deixe um cache pela metade.
+def cria_cache(arquivo_cache, pasta, nomes_arquivos, largura, altura, classes, indice=None):
+    from utilitarios.decodificacao import le_imagem  # Só para criar o cache (usa o OpenCV)
+    total_imagens = len(nomes_arquivos)
+    print(f"Criando cache de {total_imagens} imagens em {arquivo_cache}")
+
+    todas_boxes, todas_labels = [], []
+    arquivo_temporario = arquivo_cache + '.tmp'
+    with open(arquivo_temporario, 'wb') as arquivo:
+        # O cabeçalho só é conhecido no final. Reserva o espaço dele.
+        arquivo.write(bytes(_TAMANHO_CABECALHO))
+
+        # Os pixels de cada imagem são gravados em sequência, logo após o
+        # cabeçalho. As anotações ficam na memória até o final (são pequenas).
+        for nome in nomes_arquivos:
+            # Mesma leitura do DeteccaoDataset (JPEG decodificado já reduzido)
+            redimensionada, (largura_original, altura_original) = le_imagem(os.path.join(pasta, nome),
+                                                                            largura, altura)
+            arquivo.write(np.ascontiguousarray(redimensionada).tobytes())
+
+            boxes, labels = _le_anotacao(pasta, nome, classes, indice)
+            boxes, _ = redimensiona_boxes(boxes, largura_original, altura_original, largura, altura)
+            todas_boxes.append(boxes)
+            todas_labels.append(labels)
+
+        inicios = np.zeros(total_imagens+1, dtype=np.int64)
+        inicios[1:] = np.cumsum([len(labels) for labels in todas_labels])
+        total_retangulos = int(inicios[-1])
+        (_, inicio_retangulos, _, _, _) = _posicoes(total_imagens, altura, largura, total_retangulos)
+
+        # Completa com zeros até o alinhamento e grava as anotações
+        arquivo.write(bytes(inicio_retangulos - arquivo.tell()))
+        if total_retangulos > 0:
+            arquivo.write(np.concatenate(todas_boxes).astype(np.float32).tobytes())
+            arquivo.write(np.concatenate(todas_labels).astype(np.int64).tobytes())
+        arquivo.write(inicios.tobytes())
+
+        # Agora sim grava o cabeçalho
+        arquivo.seek(0)
+        cabecalho = np.array([_MAGICO, _VERSAO, total_imagens, altura, largura, total_retangulos,
+                              assinatura_cache(pasta, nomes_arquivos, largura, altura, classes), 0],
+                             dtype=np.int64)
+        arquivo.write(cabecalho.tobytes())
+
+    os.replace(arquivo_temporario, arquivo_cache)
+
+
+# Lê apenas o cabeçalho do arquivo. Retorna None se o arquivo não existir
+# ou não for um cache válido.
+def le_cabecalho(arquivo_cache):
+    if not os.path.exists(arquivo_cache):
+        return None
+    cabecalho = np.fromfile(arquivo_cache, dtype=np.int64, count=len(_CAMPOS_CABECALHO))
+    if len(cabecalho) < len(_CAMPOS_CABECALHO) or cabecalho[0] != _MAGICO or cabecalho[1] != _VERSAO:
+        return None
+    return dict(zip(_CAMPOS_CABECALHO, (int(valor) for valor in cabecalho)))
+
+
+# Verifica se o cache existe e corresponde às imagens, classes e tamanho
+# pedidos. Caso contrário, (re)cria o cache.
+# Se o índice de anotações (utilitarios/indice_voc.py) for passado, os
+# retângulos são pegos dele em vez de ler os arquivos XML.
+def prepara_cache(arquivo_cache, pasta, nomes_arquivos, largura, altura, classes, indice=None):
+    cabecalho = le_cabecalho(arquivo_cache)
+    assinatura = assinatura_cache(pasta, nomes_arquivos, largura, altura, classes)
+    if cabecalho is None or cabecalho['assinatura'] != assinatura:
+        cria_cache(arquivo_cache, pasta, nomes_arquivos, largura, altura, classes, indice)
+    else:
+        print(f"Usando cache já existente em {arquivo_cache}")
+
+
+# Dá acesso ao conteúdo do cache sem copiar nada para a memória.
+# O arquivo é aberto no modo "c" (copy-on-write): as páginas são
+# compartilhadas entre os processos e nada é escrito de volta no disco.
+#
+# O mapeamento é aberto só no primeiro acesso e não é levado junto quando
+# o objeto é enviado para outro processo (DataLoader com num_workers > 0),
+# cada processo abre o seu.
+class CacheDeteccao:
+    def __init__(self, arquivo_cache):
+        self.arquivo_cache = arquivo_cache
+        cabecalho = le_cabecalho(arquivo_cache)
+        if cabecalho is None:
+            raise ValueError(f"{arquivo_cache} não é um arquivo de cache válido")
+        self.total_imagens = cabecalho['total_imagens']
+        self.altura = cabecalho['altura']
+        self.largura = cabecalho['largura']
+        self.total_retangulos = cabecalho['total_retangulos']
+        self._mapa = None
+
+    def _abre(self):
+        (inicio_pixels, inicio_retangulos, inicio_classes,
+         inicio_inicios, tamanho_total) = _posicoes(self.total_imagens, self.altura,
+                                                    self.largura, self.total_retangulos)
+        self._mapa = np.memmap(self.arquivo_cache, dtype=np.uint8, mode='c', shape=(tamanho_total,))
+        self._pixels = self._mapa[inicio_pixels:inicio_retangulos][:self.total_imagens*self.altura*self.largura*3]
+        self._pixels = self._pixels.reshape(self.total_imagens, self.altura, self.largura, 3)
+        self._boxes = self._mapa[inicio_retangulos:inicio_classes].view(np.float32).reshape(-1, 4)
+        self._labels = self._mapa[inicio_classes:inicio_inicios].view(np.int64)
+        self._inicios = self._mapa[inicio_inicios:tamanho_total].view(np.int64)
+
+    # Não envia o mapeamento para outros processos
+    def __getstate__(self):
+        estado = self.__dict__.copy()
+        for campo in ['_mapa', '_pixels', '_boxes', '_labels', '_inicios']:
+            estado.pop(campo, None)
+        estado['_mapa'] = None
+        return estado
+
+    def __len__(self):
+        return self.total_imagens
+
+    # Pixels da imagem idx (altura x largura x 3, uint8, RGB)
+    def imagem(self, idx):
+        if self._mapa is None:
+            self._abre()
+        return self._pixels[idx]
+
+    # Retângulos (já redimensionados) e classes da imagem idx
+    def anotacoes(self, idx):
+        if self._mapa is None:
+            self._abre()
+        inicio, fim = self._inicios[idx], self._inicios[idx+1]
+        return self._boxes[inicio:fim], self._labels[inicio:fim]
@@ -0,0 +1,97 @@
+# Gerador de carga para o servidor de detecção (utilitarios/servidor_deteccao.py)
+#
+# Envia as imagens de uma pasta (em ciclo) usando várias conexões ao mesmo
+# tempo e mostra a vazão e as latências vistas pelo cliente, seguidas das
+# estatísticas do próprio servidor.
+#
+# Uso:
+#
+#    python -m utilitarios.carga_deteccao --pasta ./data/condensadores/ --requisicoes 500 --concorrencia 16
+#    python -m utilitarios.carga_deteccao --socket /tmp/deteccao.sock --pasta ./data/condensadores/
+
+import argparse
+import fnmatch
+import http.client
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+# Conexão HTTP por um socket Unix
+class _ConexaoUnix(http.client.HTTPConnection):
+    def __init__(self, arquivo_socket):
+        super().__init__("localhost")
+        self.arquivo_socket = arquivo_socket
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.arquivo_socket)
+
+
+def _conecta(args):
+    if args.socket:
+        return _ConexaoUnix(args.socket)
+    return http.client.HTTPConnection(args.host, args.porta)
+
+
+# Faz uma requisição e retorna a resposta (JSON já convertido)
+def requisita(conexao, metodo, caminho, corpo=None):
+    conexao.request(metodo, caminho, body=corpo,
+                    headers={'Content-Type': 'application/octet-stream'} if corpo else {})
+    resposta = conexao.getresponse()
+    dados = json.loads(resposta.read())
+    if resposta.status != 200:
+        raise RuntimeError(f"Erro {resposta.status}: {dados}")
+    return dados
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mede a vazão e a latência do servidor de detecção.")
+    parser.add_argument('--pasta', required=True, help="pasta com as imagens a enviar")
+    parser.add_argument('--padrao', default="*.jpg")
+    parser.add_argument('--requisicoes', type=int, default=200)
+    parser.add_argument('--concorrencia', type=int, default=8, help="conexões ao mesmo tempo")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--porta', type=int, default=8000)
+    parser.add_argument('--socket', help="arquivo de socket Unix do servidor")
+    args = parser.parse_args(argv)
+
+    nomes = sorted(fnmatch.filter(os.listdir(args.pasta), args.padrao))
+    if not nomes:
+        parser.error(f"nenhuma imagem {args.padrao} em {args.pasta}")
+    # As imagens são lidas antes, para medir apenas o servidor
+    imagens = []
+    for nome in nomes:
+        with open(os.path.join(args.pasta, nome), 'rb') as f:
+            imagens.append(f.read())
+
+    # Cada thread mantém a sua conexão aberta (keep-alive)
+    local = threading.local()
+
+    def envia(i):
+        if not hasattr(local, 'conexao'):
+            local.conexao = _conecta(args)
+        inicio = time.perf_counter()
+        requisita(local.conexao, 'POST', '/detecta', imagens[i % len(imagens)])
+        return time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concorrencia) as executor:
+        latencias = np.array(list(executor.map(envia, range(args.requisicoes)))) * 1000
+    duracao = time.perf_counter() - inicio
+
+    print(f"{args.requisicoes} requisições, {args.concorrencia} conexões, {duracao:.2f} s")
+    print(f"Vazão: {args.requisicoes/duracao:.1f} imagens por segundo")
+    print(f"Latência (cliente): p50 {np.percentile(latencias, 50):.1f} ms, "
+          f"p99 {np.percentile(latencias, 99):.1f} ms, média {latencias.mean():.1f} ms")
+    print("Servidor:", requisita(_conecta(args), 'GET', '/estatisticas'))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+# Criação dos DataLoaders usados pelos exemplos
+#
+# Por padrão o DataLoader do pytorch carrega (abre, decodifica e transforma)
+# as imagens no mesmo processo que treina a rede, uma de cada vez. Aqui o
+# carregamento é feito por vários processos em paralelo ("workers"), que
+# continuam vivos entre as épocas e já vão preparando os próximos lotes
+# enquanto a rede processa o lote atual.
+
+import multiprocessing
+import os
+import time
+import torch
+from torch.utils.data import DataLoader
+
+
+# Total de núcleos que este processo pode usar
+def total_nucleos():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# True se os novos processos são criados com "fork" (padrão do Linux até o
+# Python 3.13). Com "spawn" (Windows, macOS) ou "forkserver" cada processo
+# começa do zero: importa de novo o script principal (os exemplos não têm
+# um "if __name__ == '__main__'", então o script inteiro rodaria de novo) e
+# recebe os dados com o pickle.
+def usa_fork():
+    metodo = multiprocessing.get_start_method(allow_none=True) or multiprocessing.get_all_start_methods()[0]
+    return metodo == 'fork'
+
+
+# Escolhe o total de processos para carregar as imagens a partir do total
+# de núcleos. Deixa um núcleo para o processo principal (que treina a rede).
+#
+# Só usa outros processos quando eles são criados com "fork" (ver usa_fork).
+# Com "spawn" ou "forkserver" o banco de imagens é enviado para cada
+# processo com o pickle, e as funções definidas no próprio script ou
+# notebook (ex.: o invert do v2, usado em um transforms.Lambda) não podem
+# ser enviadas. Nesses casos o padrão é carregar tudo no processo principal
+# (um número ou "auto" passado em num_workers continua sendo respeitado).
+def num_workers_padrao():
+    if not usa_fork():
+        return 0
+    return max(1, min(8, total_nucleos()-1))
+
+
+# Cria um DataLoader já configurado para carregar os lotes em paralelo
+#
+# dataset = banco de imagens
+# tamanho_lote = total de imagens em cada lote
+# shuffle = embaralha as imagens a cada época
+# collate_fn = função que junta as imagens em um lote (None = padrão do pytorch)
+# num_workers = total de processos para carregar as imagens. None escolhe
+#               pelo total de núcleos e "auto" mede alguns valores e fica
+#               com o mais rápido (ver escolhe_num_workers)
+# prefetch_factor = quantos lotes cada processo deixa preparados
+# drop_last = descarta o último lote se ele tiver menos de tamanho_lote imagens
+def cria_dataloader(dataset, tamanho_lote, shuffle=False, collate_fn=None,
+                    num_workers=None, prefetch_factor=2, drop_last=False):
+    if num_workers is None:
+        num_workers = num_workers_padrao()
+    elif num_workers == "auto":
+        num_workers = escolhe_num_workers(dataset, tamanho_lote, collate_fn)
+
+    opcoes = {}
+    if num_workers > 0:
+        # Os processos continuam vivos entre as épocas (não precisa criar
+        # tudo de novo a cada época) e já deixam lotes preparados
+        opcoes['persistent_workers'] = True
+        opcoes['prefetch_factor'] = prefetch_factor
+
+    return DataLoader(dataset, batch_size=tamanho_lote, shuffle=shuffle,
+                      collate_fn=collate_fn, num_workers=num_workers, drop_last=drop_last,
+                      # Memória "fixa" deixa a cópia para a GPU mais rápida
+                      pin_memory=torch.cuda.is_available(), **opcoes)
+
+
+# Mede quantas imagens por segundo são carregadas com alguns valores de
+# num_workers e retorna o mais rápido
+#
+# candidatos = valores de num_workers a testar (None = alguns valores até o
+#              total de núcleos)
+# lotes_por_teste = quantos lotes carregar em cada teste
+def escolhe_num_workers(dataset, tamanho_lote, collate_fn=None, candidatos=None,
+                        lotes_por_teste=10):
+    if candidatos is None:
+        maximo = num_workers_padrao()
+        candidatos = sorted({0, min(2, maximo), min(4, maximo), maximo})
+
+    print("Escolhendo o total de processos para carregar as imagens:")
+    melhor, melhor_velocidade = 0, 0
+    for num_workers in candidatos:
+        opcoes = {'prefetch_factor': 2} if num_workers > 0 else {}
+        carregador = DataLoader(dataset, batch_size=tamanho_lote, shuffle=True,
+                                collate_fn=collate_fn, num_workers=num_workers, **opcoes)
+        iterador = iter(carregador)
+        # O primeiro lote inclui o tempo de criar os processos. Não conta.
+        if next(iterador, None) is None:
+            continue
+        total, inicio = 0, time.perf_counter()
+        for _ in range(lotes_por_teste):
+            lote = next(iterador, None)
+            if lote is None:
+                break
+            total += len(lote[0])
+        tempo = time.perf_counter() - inicio
+        del iterador  # Encerra os processos deste teste
+        if total == 0:
+            continue
+        velocidade = total / tempo
+        print(f"   num_workers={num_workers}: {velocidade:>0.1f} imagens/s")
+        if velocidade > melhor_velocidade:
+            melhor, melhor_velocidade = num_workers, velocidade
+
+    print(f"Usando num_workers={melhor}")
+    return melhor
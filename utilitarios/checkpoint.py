@@ -0,0 +1,163 @@
+# Checkpoints com o estado completo do treinamento, gravados em segundo plano
+#
+# Além dos pesos da rede, o checkpoint guarda o estado do otimizador (o
+# momento do SGD, por exemplo), a época, as variáveis da parada antecipada
+# (melhor valor, épocas sem melhora) e o estado dos geradores de números
+# aleatórios. Assim um treinamento interrompido (máquina desligada, sessão
+# do Colab encerrada) pode continuar exatamente de onde parou.
+#
+# A gravação é feita por uma thread separada: o treinamento só espera o
+# tempo de copiar os tensores para a memória da CPU e segue para a próxima
+# época enquanto o arquivo é escrito. O arquivo é gravado com outro nome e
+# renomeado no final, então um checkpoint nunca fica pela metade.
+#
+# O checkpoint só serve para continuar o mesmo treinamento: o nome do arquivo
+# leva uma assinatura da configuração (ver nome_checkpoint), a configuração é
+# guardada dentro dele e conferida antes de retomar, e o arquivo é apagado
+# quando o treinamento termina normalmente (ver descarta_checkpoint). Assim
+# um treinamento novo, ou com outros hiperparâmetros, nunca pega o estado de
+# outro.
+
+import json
+import os
+import random
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+
+# Copia (recursivamente) todos os tensores para a CPU. A cópia é necessária
+# porque a rede continua treinando (e alterando os pesos) durante a gravação.
+def _copia_para_cpu(valor):
+    if torch.is_tensor(valor):
+        return valor.detach().to('cpu', copy=True)
+    if isinstance(valor, dict):
+        return {chave: _copia_para_cpu(v) for chave, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        return type(valor)(_copia_para_cpu(v) for v in valor)
+    return valor
+
+
+def _grava(arquivo, estado):
+    temporario = arquivo + '.tmp'
+    torch.save(estado, temporario)
+    os.replace(temporario, arquivo)
+
+
+class GravadorCheckpoint:
+    def __init__(self):
+        # Uma única thread: as gravações acontecem na ordem em que foram pedidas
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pendentes = []
+
+    # Grava "estado" (qualquer objeto que o torch.save aceite) em "arquivo"
+    # sem esperar terminar
+    def salva(self, arquivo, estado):
+        self._verifica_erros()
+        self.pendentes.append(self.executor.submit(_grava, arquivo, _copia_para_cpu(estado)))
+
+    # Espera todas as gravações pedidas até agora
+    def espera(self):
+        for pendente in self.pendentes:
+            pendente.result()  # Repassa qualquer erro de gravação
+        self.pendentes = []
+
+    # Espera as gravações e encerra a thread
+    def fecha(self):
+        self.espera()
+        self.executor.shutdown()
+
+    # Mostra logo (e não só no final) um erro de uma gravação anterior
+    def _verifica_erros(self):
+        for pendente in [p for p in self.pendentes if p.done()]:
+            pendente.result()
+            self.pendentes.remove(pendente)
+
+
+# Estado de todos os geradores de números aleatórios usados no treinamento
+# (divisão dos conjuntos, ordem dos lotes, aumento de dados, dropout)
+def estado_aleatorio():
+    estado = {'python': random.getstate(), 'numpy': np.random.get_state(),
+              'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        estado['cuda'] = torch.cuda.get_rng_state_all()
+    return estado
+
+
+def restaura_aleatorio(estado):
+    random.setstate(estado['python'])
+    np.random.set_state(estado['numpy'])
+    # Os estados precisam estar na CPU (o checkpoint pode ter sido carregado
+    # com map_location="cuda")
+    torch.set_rng_state(estado['torch'].cpu())
+    if 'cuda' in estado and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([parte.cpu() for parte in estado['cuda']])
+
+
+# Configuração em um formato que pode ser comparado depois de gravada e lida
+# (tuplas viram listas, valores que não são do JSON viram texto)
+def _normaliza_config(config):
+    return json.loads(json.dumps(config, sort_keys=True, default=str))
+
+
+# Nome do arquivo de checkpoint de uma configuração: prefixo + assinatura da
+# configuração. Treinamentos com hiperparâmetros diferentes (outra rede, outra
+# precisão, outro tamanho de lote...) usam arquivos diferentes.
+#
+# config = dicionário com os hiperparâmetros que definem o treinamento (não
+#          coloque valores que podem mudar ao continuar, como o total de épocas)
+def nome_checkpoint(prefixo, config):
+    texto = json.dumps(_normaliza_config(config), sort_keys=True)
+    return f"{prefixo}_{zlib.crc32(texto.encode('utf-8')):08x}.pth"
+
+
+# Monta o checkpoint com o estado completo do treinamento
+#
+# epoca = total de épocas já concluídas (a próxima a ser treinada)
+# variaveis = dicionário com as demais variáveis do laço de treinamento
+#             (por exemplo, maior_acuracia e total_sem_melhora)
+# escalador = GradScaler usado com precisão fp16 (ver utilitarios/precisao.py)
+# config = configuração do treinamento (conferida em retoma_checkpoint)
+def monta_checkpoint(epoca, model, otimizador, variaveis, escalador=None, config=None):
+    return {'epoca': epoca,
+            'modelo': model.state_dict(),
+            'otimizador': otimizador.state_dict(),
+            'escalador': escalador.state_dict() if escalador is not None else None,
+            'variaveis': dict(variaveis),
+            'aleatorio': estado_aleatorio(),
+            'config': _normaliza_config(config) if config is not None else None}
+
+
+# Restaura um checkpoint criado com monta_checkpoint
+#
+# Retorna None se o arquivo não existir ou (epoca, variaveis) com a próxima
+# época a ser treinada e as variáveis do laço de treinamento
+#
+# Se config for passado e o checkpoint tiver sido criado com outra
+# configuração, não retoma (ValueError) em vez de misturar os treinamentos
+def retoma_checkpoint(arquivo, model, otimizador, escalador=None, device="cpu", config=None):
+    if not os.path.exists(arquivo):
+        return None
+    # weights_only=False porque o estado do numpy e do python não são tensores
+    checkpoint = torch.load(arquivo, map_location=device, weights_only=False)
+    if config is not None:
+        gravada, atual = checkpoint.get('config') or {}, _normaliza_config(config)
+        if gravada != atual:
+            diferentes = sorted(chave for chave in set(gravada) | set(atual)
+                                if gravada.get(chave) != atual.get(chave))
+            raise ValueError(f"O checkpoint {arquivo} é de um treinamento com outra configuração "
+                             f"(diferenças em {diferentes}). Use retomar=False ou apague o arquivo.")
+    model.load_state_dict(checkpoint['modelo'])
+    otimizador.load_state_dict(checkpoint['otimizador'])
+    if escalador is not None and checkpoint['escalador'] is not None:
+        escalador.load_state_dict(checkpoint['escalador'])
+    restaura_aleatorio(checkpoint['aleatorio'])
+    return checkpoint['epoca'], checkpoint['variaveis']
+
+
+# Apaga o checkpoint de um treinamento que terminou normalmente (o próximo
+# treinamento começa do zero)
+def descarta_checkpoint(arquivo):
+    if os.path.exists(arquivo):
+        os.remove(arquivo)
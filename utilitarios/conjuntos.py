@@ -0,0 +1,249 @@
+# Bancos de imagens (Datasets) usados pelos exemplos e pelo motor de treino
+#
+# Ficam aqui, e não dentro dos exemplos, para que possam ser importados sem
+# executar o restante do exemplo (downloads, gráficos, treinamento, etc).
+
+import os
+from collections import namedtuple
+import torch
+from PIL import Image,ImageOps
+from torch.utils.data import Dataset
+from xml.etree import ElementTree as et # Manipulação de arquivos XML
+from utilitarios.cache_deteccao import CacheDeteccao, prepara_cache
+from utilitarios.decodificacao import le_imagem
+from utilitarios.indice_voc import redimensiona_boxes
+
+
+# Banco de imagens para segmentação semântica (exemplo v5): imagens na
+# subpasta "imagens" e máscaras .png com o mesmo nome na subpasta "anotacoes".
+# Junto com o DataLoader, cada época passa uma vez por todas as imagens (em
+# ordem aleatória quando shuffle=True) e as imagens podem ser lidas por
+# vários processos em paralelo.
+class SegmentacaoDataset(Dataset):
+    def __init__(self, pasta, nomes, transformacao):
+        self.pasta = pasta  # Pasta com as subpastas "imagens" e "anotacoes"
+        self.nomes = nomes  # Nomes das imagens a serem utilizadas
+        self.transformacao = transformacao  # Transformações a serem aplicadas
+
+    def __getitem__(self, idx):
+        # Lê a imagem
+        imagem=Image.open(os.path.join(self.pasta, "imagens", self.nomes[idx]))
+
+        # Aplica operações para resolver problema de orientação
+        # de imagens com tag de orientação EXIF
+        imagem = ImageOps.exif_transpose(imagem)
+
+        # Lê a anotação. Assume que as anotações são do tipo png
+        arquivo_anotacao=os.path.splitext(self.nomes[idx])[0]+'.png'
+        anotacao=Image.open(os.path.join(self.pasta, "anotacoes", arquivo_anotacao))
+        # Aplica as transformações
+        imagem=self.transformacao(imagem)
+        anotacao=self.transformacao(anotacao)
+        # Binariza a anotação (e retira a dimensão do canal, que é só um)
+        # Dependendo do tipo do arquivo de anotação pode ser preciso mudar
+        # o teste "anotacao > 0". Tem que dar uma inspecionada nos valores dos pixels
+        anotacao=torch.where(anotacao[0] > 0, 1, 0)
+
+        return imagem,anotacao
+
+    def __len__(self):
+        return len(self.nomes)
+
+
+# Banco de imagens para detecção de objetos (exemplo v6): imagens .jpg com
+# as anotações no formato Pascal VOC (um .xml com o mesmo nome da imagem)
+#
+# As imagens são entregues em uint8 (0 a 255), em um tensor canais x altura
+# x largura (ou no formato que "transformacoes" devolver, se for passada).
+# Use normaliza_imagens (utilitarios/transformacoes_lote.py) no lote antes
+# de passá-lo à rede.
+class DeteccaoDataset(Dataset):
+    def __init__(self, pasta, nomes_arquivos, largura, altura, classes, transformacoes=None,
+                 arquivo_cache=None, indice=None):
+        self.pasta = pasta  # Pasta onde estão as imagens
+        self.nomes_arquivos = nomes_arquivos  # Nomes das imagens a serem utilizadas
+        self.altura = altura   # Altura que as imagens deverão ter
+        self.largura = largura    # Largura que as imagens deverão ter 
+        self.classes = classes  # Nomes das classes do problema
+        self.transformacoes = transformacoes # Transformações a serem aplicadas      
+        # Índice com as anotações de todos os arquivos XML já lidas
+        # (ver utilitarios/indice_voc.py). Se for None, lê o XML a cada imagem.
+        self.indice = indice
+        if indice is not None:
+            # Posição de cada imagem dentro do índice
+            self.posicoes = [indice.posicao(nome[:-4] + '.xml') for nome in nomes_arquivos]
+            # Ajusta os retângulos de todas as imagens para o novo tamanho
+            # de uma só vez (e calcula as áreas)
+            self.boxes_redimensionados, self.areas = indice.redimensiona(largura, altura)
+        # Se for passado um arquivo de cache, as imagens são decodificadas e
+        # redimensionadas uma única vez e depois lidas direto do arquivo
+        # mapeado em memória (ver utilitarios/cache_deteccao.py)
+        self.cache = None
+        if arquivo_cache is not None:
+            prepara_cache(arquivo_cache, pasta, nomes_arquivos, largura, altura, classes, indice)
+            self.cache = CacheDeteccao(arquivo_cache)
+    def __getitem__(self, idx):
+        if self.cache is not None:
+            return self._item_do_cache(idx)
+        # Lê a imagem já no tamanho da rede (RGB, uint8). O JPEG é
+        # decodificado em tamanho reduzido e o redimensionamento é feito em
+        # uint8 (ver utilitarios/decodificacao.py). A conversão para float
+        # entre 0 e 1 é feita depois, no lote inteiro (ver normaliza_imagens
+        # em utilitarios/transformacoes_lote.py).
+        nome_imagem = self.nomes_arquivos[idx]
+        redimensionada, (largura, altura) = le_imagem(os.path.join(self.pasta,nome_imagem),
+                                                      self.largura, self.altura)
+
+        # Se tiver o índice de anotações e o tamanho da imagem for o mesmo
+        # que está no XML, os retângulos já foram ajustados para o novo
+        # tamanho (todos de uma vez, ao criar o banco). Só pega uma fatia.
+        if self.indice is not None:
+            posicao = self.posicoes[idx]
+            inicio, fim = self.indice.inicios[posicao], self.indice.inicios[posicao+1]
+            labels = self.indice.labels[inicio:fim]
+            if self.indice.larguras[posicao] == largura and self.indice.alturas[posicao] == altura:
+                boxes = self.boxes_redimensionados[inicio:fim]
+                area = self.areas[inicio:fim]
+            else:
+                boxes, area = redimensiona_boxes(self.indice.boxes[inicio:fim],
+                                                 largura, altura, self.largura, self.altura)
+        else:
+            # Sem o índice, lê o arquivo XML e ajusta os retângulos para o
+            # novo tamanho da imagem (todos os retângulos de uma vez). Pelo
+            # arredondamento, na hora de converter os retângulos, pode passar
+            # da largura ou da altura da imagem e isso também é corrigido.
+            boxes, labels = self._le_xml(nome_imagem)
+            boxes, area = redimensiona_boxes(boxes, largura, altura, self.largura, self.altura)
+
+        # Converte os retângulos, as áreas e as classes para tensores
+        boxes = torch.as_tensor(boxes, dtype=torch.float32)
+        area = torch.as_tensor(area, dtype=torch.float32)
+        labels = torch.as_tensor(labels, dtype=torch.int64)
+
+        return self._monta_item(idx, redimensionada, boxes, labels, area)
+
+    # Lê as anotações de uma imagem direto do arquivo XML (usado quando não
+    # foi passado o índice de anotações)
+    def _le_xml(self, nome_imagem):
+        # Troca a extensão do arquivo para poder pegar as anotações em xml
+        nome_anotacao = nome_imagem[:-4] + '.xml'
+        xml_anotacao = os.path.join(self.pasta, nome_anotacao)
+
+        boxes = []
+        labels = []
+        # Lê o arquivo XML
+        tree = et.parse(xml_anotacao)
+        root = tree.getroot()
+
+        # Vai ler as coordenadas dos retângulos de anotações (usa vários
+        # comandos da biblioteca xml.etree para isso)
+        for member in root.findall('object'):
+            # Pega a classe da anotação (neste exemplo, "conde" (condenador))
+            labels.append(self.classes.index(member.find('name').text))
+
+            # Pega as coordenadas das extremidades do retângulo
+            xmin = int(member.find('bndbox').find('xmin').text)
+            xmax = int(member.find('bndbox').find('xmax').text)
+            ymin = int(member.find('bndbox').find('ymin').text)
+            ymax = int(member.find('bndbox').find('ymax').text)
+            boxes.append([xmin, ymin, xmax, ymax])
+        return boxes, labels
+
+    # Pega a imagem e as anotações já prontas do cache (sem ler o JPEG e o XML)
+    def _item_do_cache(self, idx):
+        # A imagem no cache já está redimensionada e em RGB (uint8). É uma
+        # fatia do arquivo mapeado, sem cópia: o mapeamento é "copy-on-write"
+        # (mode='c', ver utilitarios/cache_deteccao.py), então alterações na
+        # imagem (ex.: uma transformação que escreve nela) ficam só na memória
+        # deste processo e nunca chegam ao arquivo.
+        redimensionada = self.cache.imagem(idx)
+        # Os retângulos já estão redimensionados e corrigidos
+        boxes, labels = self.cache.anotacoes(idx)
+        boxes = torch.from_numpy(boxes)
+        labels = torch.from_numpy(labels)
+        # Calcula a área dos retângulos (todos de uma vez)
+        area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
+        return self._monta_item(idx, redimensionada, boxes, labels, area)
+
+    # Monta o dicionário de anotações e aplica as transformações
+    def _monta_item(self, idx, redimensionada, boxes, labels, area):
+        # Avisa que não é um problema de detecção de multidões
+        iscrowd = torch.zeros((boxes.shape[0],), dtype=torch.int64)
+        # Cria um dicionário com todas as informações que a rede vai
+        # precisar depois
+        target = {}
+        target["boxes"] = boxes
+        target["labels"] = labels
+        target["area"] = area
+        target["iscrowd"] = iscrowd
+        image_id = torch.tensor([idx])
+        target["image_id"] = image_id
+        # Aplica as transformações que foram passadas como parâmetro
+        if self.transformacoes:
+            sample = self.transformacoes(image = redimensionada,
+                                     bboxes = target['boxes'],
+                                     labels = labels)
+            redimensionada = sample['image']
+            target['boxes'] = torch.Tensor(sample['bboxes'])
+        else:
+            # Altura x largura x canais -> canais x altura x largura (como o
+            # ToTensorV2, sem cópia e sem converter para float)
+            redimensionada = torch.from_numpy(redimensionada).permute(2, 0, 1)
+
+        return redimensionada, target
+
+    def __len__(self):
+        return len(self.nomes_arquivos)
+
+
+# Junta as imagens e anotações de um lote de detecção. Cada imagem tem uma
+# quantidade diferente de objetos, por isso não dá para empilhar tudo em um
+# único tensor como faz o DataLoader por padrão.
+def junta_deteccao(lote):
+    return tuple(zip(*lote))
+
+
+# Lote de detecção "empacotado" (ver junta_deteccao_empacotada): as imagens
+# em um único tensor (lote x canais x altura x largura, uint8) e as
+# anotações de todas as imagens juntas, uma linha por objeto. Os objetos da
+# imagem i estão nas linhas inicios[i] até inicios[i+1] (inicios fica
+# sempre na CPU).
+LoteDeteccao = namedtuple('LoteDeteccao', ['imagens', 'boxes', 'labels', 'area', 'iscrowd',
+                                           'image_id', 'inicios'])
+
+
+# Junta um lote de detecção em poucos tensores contíguos (LoteDeteccao), em
+# vez de uma tupla com uma imagem e um dicionário de anotações por imagem.
+# Assim o lote vai para a GPU com uma cópia por campo (e não várias cópias
+# pequenas por imagem) e, com pin_memory=True, o DataLoader já deixa todos
+# os tensores em memória "fixa". Todas as imagens do lote precisam ter o
+# mesmo tamanho (é o caso do DeteccaoDataset, que redimensiona todas).
+#
+# Use anotacoes_lote e prepara_lote_deteccao (utilitarios/transformacoes_lote.py)
+# para separar as anotações de cada imagem.
+def junta_deteccao_empacotada(lote):
+    imagens, anotacoes = zip(*lote)
+    totais = [len(anotacao['labels']) for anotacao in anotacoes]
+    inicios = torch.zeros(len(totais)+1, dtype=torch.int64)
+    inicios[1:] = torch.tensor(totais, dtype=torch.int64).cumsum(0)
+    return LoteDeteccao(torch.stack(imagens),
+                        torch.cat([anotacao['boxes'].reshape(-1, 4) for anotacao in anotacoes]),
+                        torch.cat([anotacao['labels'] for anotacao in anotacoes]),
+                        torch.cat([anotacao['area'] for anotacao in anotacoes]),
+                        torch.cat([anotacao['iscrowd'] for anotacao in anotacoes]),
+                        torch.cat([anotacao['image_id'] for anotacao in anotacoes]),
+                        inicios)
+
+
+# Separa as anotações de cada imagem de um lote (empacotado ou não): retorna
+# uma lista de dicionários, como o DeteccaoDataset entrega. No lote
+# empacotado os tensores de cada imagem são fatias (sem cópia) dos tensores
+# do lote, no mesmo dispositivo deles.
+def anotacoes_lote(lote):
+    if not isinstance(lote, LoteDeteccao):
+        return list(lote[1])
+    inicios = lote.inicios.tolist()
+    return [{'boxes': lote.boxes[inicio:fim], 'labels': lote.labels[inicio:fim],
+             'area': lote.area[inicio:fim], 'iscrowd': lote.iscrowd[inicio:fim],
+             'image_id': lote.image_id[i:i+1]}
+            for i, (inicio, fim) in enumerate(zip(inicios[:-1], inicios[1:]))]
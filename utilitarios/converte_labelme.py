@@ -0,0 +1,171 @@
+# Converte as anotações do labelme (polígonos em arquivos .json) para
+# máscaras .png, como as usadas no exemplo v5
+#
+# Substitui o data/convertePoligonoPNG.sh. Em vez de rodar o programa
+# labelme_json_to_dataset uma vez para cada arquivo (que cria uma pasta com
+# vários arquivos, dos quais só o label.png era aproveitado), os polígonos
+# são lidos e desenhados aqui mesmo, em vários processos ao mesmo tempo, e
+# cada máscara é gravada direto na pasta de anotações. O labelme nem precisa
+# estar instalado.
+#
+# A máscara gravada tem a mesma data de modificação do .json. Assim, nas
+# próximas vezes, só são convertidos os .json novos ou modificados.
+#
+# O valor de cada pixel na máscara é o índice da classe: 0 para o fundo e,
+# como no labelme, as demais classes em ordem alfabética dentro de cada
+# arquivo. Use --classes para fixar os índices (a posição na lista, com o
+# fundo na posição 0), o que é o recomendado quando há mais de uma classe.
+#
+# Uso (a partir da pasta data/, como o script antigo):
+#
+#    python -m utilitarios.converte_labelme
+#    python -m utilitarios.converte_labelme --origem ./serpentes_anotadas_no_labelme --classes fundo serpente
+
+import argparse
+import fnmatch
+import json
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw
+
+# Abaixo desta quantidade de arquivos não compensa criar processos
+_MINIMO_PARA_PARALELIZAR = 16
+
+# Mesmos tamanhos usados pelo labelme para pontos e linhas
+_RAIO_PONTO = 5
+_LARGURA_LINHA = 10
+
+
+# Paleta de cores do Pascal VOC (a mesma do labelme): fundo preto, classe 1
+# vermelha, classe 2 verde, ...
+def paleta_voc(total=256):
+    paleta = []
+    for i in range(total):
+        r = g = b = 0
+        c = i
+        for j in range(8):
+            r |= ((c >> 0) & 1) << (7-j)
+            g |= ((c >> 1) & 1) << (7-j)
+            b |= ((c >> 2) & 1) << (7-j)
+            c >>= 3
+        paleta += [r, g, b]
+    return paleta
+
+
+# Desenha uma forma do labelme (polígono, retângulo, círculo, linha ou
+# ponto) com o valor "valor"
+def _desenha_forma(desenho, forma, valor):
+    pontos = [tuple(ponto) for ponto in forma['points']]
+    tipo = forma.get('shape_type') or 'polygon'
+    if tipo == 'rectangle':
+        (x1, y1), (x2, y2) = pontos
+        desenho.rectangle([min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)],
+                          outline=valor, fill=valor)
+    elif tipo == 'circle':
+        (cx, cy), (px, py) = pontos
+        raio = math.hypot(cx-px, cy-py)
+        desenho.ellipse([cx-raio, cy-raio, cx+raio, cy+raio], outline=valor, fill=valor)
+    elif tipo in ('line', 'linestrip'):
+        desenho.line(pontos, fill=valor, width=_LARGURA_LINHA)
+    elif tipo == 'point':
+        cx, cy = pontos[0]
+        desenho.ellipse([cx-_RAIO_PONTO, cy-_RAIO_PONTO, cx+_RAIO_PONTO, cy+_RAIO_PONTO],
+                        outline=valor, fill=valor)
+    else:
+        desenho.polygon(pontos, outline=valor, fill=valor)
+
+
+# Tamanho da imagem anotada: vem do .json (versões recentes do labelme) ou
+# do cabeçalho da própria imagem
+def _tamanho_imagem(arquivo_json, dados):
+    if dados.get('imageWidth') and dados.get('imageHeight'):
+        return dados['imageWidth'], dados['imageHeight']
+    pasta = os.path.dirname(arquivo_json)
+    candidatos = [os.path.join(pasta, os.path.basename(dados.get('imagePath') or ''))]
+    if dados.get('imagePath'):
+        candidatos.append(os.path.join(pasta, dados['imagePath']))
+    for candidato in candidatos:
+        if os.path.isfile(candidato):
+            with Image.open(candidato) as imagem:  # Lê só o cabeçalho
+                return imagem.size
+    raise ValueError(f"Não encontrei o tamanho da imagem de {arquivo_json}")
+
+
+# Converte um .json do labelme em uma máscara .png (modo "P", com a paleta
+# do Pascal VOC, igual ao label.png do labelme)
+def converte_json(arquivo_json, arquivo_png, classes=None):
+    with open(arquivo_json) as f:
+        dados = json.load(f)
+    formas = dados.get('shapes', [])
+    if classes is None:
+        # Mesma regra do labelme_json_to_dataset
+        nomes = sorted({forma['label'] for forma in formas})
+        indices = {nome: i+1 for i, nome in enumerate(nomes)}
+    else:
+        indices = {nome: i for i, nome in enumerate(classes)}
+    largura, altura = _tamanho_imagem(arquivo_json, dados)
+    mascara = Image.new('P', (largura, altura), 0)
+    mascara.putpalette(paleta_voc())
+    desenho = ImageDraw.Draw(mascara)
+    for forma in formas:
+        if forma['label'] not in indices:
+            raise ValueError(f"Classe {forma['label']!r} de {arquivo_json} não está em {classes}")
+        _desenha_forma(desenho, forma, indices[forma['label']])
+    temporario = arquivo_png + '.tmp'
+    mascara.save(temporario, format='PNG')
+    os.replace(temporario, arquivo_png)
+    # Mesma data do .json: indica que a máscara está atualizada
+    mtime = os.stat(arquivo_json).st_mtime_ns
+    os.utime(arquivo_png, ns=(mtime, mtime))
+    return arquivo_png
+
+
+def _converte(argumentos):
+    return converte_json(*argumentos)
+
+
+# Converte todos os .json de "origem" que são novos ou foram modificados
+#
+# Retorna o total de arquivos convertidos
+def converte_pasta(origem, destino, classes=None, processos=None, forca=False):
+    os.makedirs(destino, exist_ok=True)
+    tarefas = []
+    total = 0
+    for nome in sorted(fnmatch.filter(os.listdir(origem), "*.json")):
+        total += 1
+        arquivo_json = os.path.join(origem, nome)
+        arquivo_png = os.path.join(destino, os.path.splitext(nome)[0]+'.png')
+        if (not forca and os.path.exists(arquivo_png) and
+                os.stat(arquivo_png).st_mtime_ns == os.stat(arquivo_json).st_mtime_ns):
+            continue
+        tarefas.append((arquivo_json, arquivo_png, classes))
+    print(f"Convertendo {len(tarefas)} de {total} arquivos .json de {origem} para {destino}")
+    if processos is None:
+        processos = os.cpu_count() or 1
+    if processos > 1 and len(tarefas) >= _MINIMO_PARA_PARALELIZAR:
+        with ProcessPoolExecutor(max_workers=processos) as executor:
+            list(executor.map(_converte, tarefas, chunksize=max(1, len(tarefas)//(4*processos))))
+    else:
+        for argumentos in tarefas:
+            _converte(argumentos)
+    return len(tarefas)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Converte polígonos do labelme (.json) em máscaras .png.")
+    parser.add_argument('--origem', default="./imagens", help="pasta com os .json do labelme")
+    parser.add_argument('--destino', default="./anotacoes", help="pasta onde ficam as máscaras .png")
+    parser.add_argument('--classes', nargs='+',
+                        help="nomes das classes (a posição é o valor na máscara, o fundo é a primeira)")
+    parser.add_argument('--processos', type=int, default=None)
+    parser.add_argument('--forca', action='store_true', help="converte de novo mesmo os que não mudaram")
+    args = parser.parse_args(argv)
+    converte_pasta(args.origem, args.destino, args.classes, args.processos, args.forca)
+    print("Terminei...")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
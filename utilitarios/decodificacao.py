@@ -0,0 +1,82 @@
+# Leitura de imagens já no tamanho da rede, sem passar pela imagem inteira
+# em float
+#
+# As fotos do drone têm 4000x3000 pixels e a rede usa 416x416. Decodificar a
+# imagem inteira, converter para float32 e só então redimensionar cria um
+# buffer de 4000x3000x3x4 bytes (~144 MB) por imagem. Aqui o JPEG já é
+# decodificado em 1/2, 1/4 ou 1/8 do tamanho (o próprio decodificador JPEG
+# faz isso, quase de graça, com os flags IMREAD_REDUCED_* do OpenCV), o
+# redimensionamento final é feito em uint8 e a conversão para float entre 0
+# e 1 fica para depois, no lote inteiro (ver normaliza_imagens em
+# utilitarios/transformacoes_lote.py).
+#
+# A redução usada é a maior que ainda deixa a imagem maior ou igual ao
+# tamanho final, então a imagem nunca é ampliada.
+
+import io
+import numpy as np
+from PIL import Image
+
+# Orientações EXIF que trocam a largura pela altura (rotação de 90 graus).
+# O OpenCV aplica a orientação ao decodificar.
+_ORIENTACOES_GIRADAS = (5, 6, 7, 8)
+
+
+# Tamanho (largura, altura) da imagem como o OpenCV a entrega, lendo só o
+# cabeçalho do arquivo
+def tamanho_imagem(arquivo):
+    with Image.open(arquivo) as imagem:
+        largura, altura = imagem.size
+        if imagem.getexif().get(0x0112, 1) in _ORIENTACOES_GIRADAS:
+            largura, altura = altura, largura
+    return largura, altura
+
+
+# Maior redução (1, 2, 4 ou 8) que deixa a imagem com pelo menos
+# largura x altura pixels
+def fator_reducao(largura_original, altura_original, largura, altura):
+    for fator in (8, 4, 2):
+        if -(-largura_original//fator) >= largura and -(-altura_original//fator) >= altura:
+            return fator
+    return 1
+
+
+def _flag_leitura(fator):
+    import cv2
+    return {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+            4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}[fator]
+
+
+# Redimensiona (em uint8) e converte de BGR para RGB
+def _finaliza(imagem, largura, altura):
+    import cv2
+    if imagem.shape[1] != largura or imagem.shape[0] != altura:
+        imagem = cv2.resize(imagem, (largura, altura))
+    return cv2.cvtColor(imagem, cv2.COLOR_BGR2RGB)
+
+
+# Lê um arquivo de imagem já redimensionado para largura x altura
+#
+# Retorna a imagem (altura x largura x 3, RGB, uint8) e o tamanho original
+# (largura, altura), usado para ajustar os retângulos das anotações
+def le_imagem(arquivo, largura, altura):
+    import cv2
+    original = tamanho_imagem(arquivo)
+    imagem = cv2.imread(arquivo, _flag_leitura(fator_reducao(*original, largura, altura)))
+    if imagem is None:
+        raise ValueError(f"não foi possível ler a imagem {arquivo}")
+    return _finaliza(imagem, largura, altura), original
+
+
+# Igual a le_imagem, mas com o conteúdo do arquivo (bytes) já na memória
+def decodifica_imagem(conteudo, largura, altura):
+    import cv2
+    try:
+        original = tamanho_imagem(io.BytesIO(conteudo))
+    except (OSError, SyntaxError):
+        raise ValueError("não foi possível decodificar a imagem")
+    imagem = cv2.imdecode(np.frombuffer(conteudo, dtype=np.uint8),
+                          _flag_leitura(fator_reducao(*original, largura, altura)))
+    if imagem is None:
+        raise ValueError("não foi possível decodificar a imagem")
+    return _finaliza(imagem, largura, altura), original
@@ -0,0 +1,142 @@
+# Divisão das imagens entre treino, validação e teste, salva em um manifesto
+#
+# A divisão é feita com semente e estratificada quando os rótulos são
+# conhecidos (cada classe fica com a mesma proporção em treino, validação e
+# teste). O resultado fica salvo em um arquivo .npz pequeno (o "manifesto"),
+# com:
+#
+# - nomes: os nomes dos arquivos (em ordem alfabética)
+# - conjuntos: 0 (treino), 1 (validação) ou 2 (teste) para cada nome
+# - assinatura: resumo (sha1) dos nomes (e rótulos) dos arquivos
+# - os parâmetros da divisão (semente e percentuais)
+#
+# A ordem em que os arquivos são distribuídos vem de um sorteio feito a
+# partir do próprio nome do arquivo (e da semente), não da posição dele na
+# lista. Quando a pasta muda (imagens novas ou removidas), os arquivos que
+# já estavam no manifesto continuam no mesmo conjunto e só os novos são
+# distribuídos, completando as proporções de cada classe. Assim uma imagem
+# de teste nunca passa para o treino, todos os experimentos continuam
+# comparáveis e os caches de cada conjunto que não recebeu imagens novas
+# continuam válidos. Mudar a semente ou os percentuais refaz a divisão.
+#
+# Com verifica=False nem a pasta é lida: o manifesto com os mesmos
+# parâmetros é usado diretamente (útil em pastas muito grandes, quando se
+# sabe que nada mudou).
+
+import fnmatch
+import hashlib
+import os
+import numpy as np
+
+TREINO, VALIDACAO, TESTE = 0, 1, 2
+_SEM_CONJUNTO = -1  # Arquivo novo, ainda não distribuído
+
+# Extensões mais comuns de imagens (para ignorar outros arquivos da pasta,
+# como os .json do labelme)
+PADRAO_IMAGENS = ("*.jpg", "*.jpeg", "*.png", "*.bmp", "*.tif", "*.tiff")
+
+
+# Lista os arquivos de uma pasta (uma única passada com os.scandir) em ordem
+# alfabética
+#
+# padrao = um padrão (ex.: "*.jpg") ou uma lista de padrões
+def lista_arquivos(pasta, padrao="*"):
+    padroes = [padrao] if isinstance(padrao, str) else list(padrao)
+    with os.scandir(pasta) as itens:
+        return sorted(item.name for item in itens
+                      if item.is_file() and any(fnmatch.fnmatch(item.name, p) for p in padroes))
+
+
+# Assinatura dos nomes (e rótulos). Não depende da data de modificação: tocar
+# ou regravar um arquivo não muda a divisão.
+def assinatura_nomes(nomes, rotulos=None):
+    resumo = hashlib.sha1()
+    for i, nome in enumerate(nomes):
+        resumo.update(f"{nome}\t{rotulos[i] if rotulos is not None else ''}\n".encode())
+    return resumo.hexdigest()
+
+
+# Número entre 0 e 1 sorteado a partir do nome do arquivo e da semente (o
+# mesmo nome sempre dá o mesmo número)
+def _sorteio_nome(nome, semente):
+    resumo = hashlib.sha1(f"{semente}\t{nome}".encode()).digest()
+    return int.from_bytes(resumo[:8], 'big') / 2**64
+
+
+# Total de itens de treino, validação e teste para uma classe com "total"
+# itens: primeiro separa perc_teste para teste e depois perc_val do restante
+# para validação (como nos exemplos)
+def _quantidades(total, perc_teste, perc_val):
+    total_teste = int(round(total*perc_teste))
+    total_val = int(round((total-total_teste)*perc_val))
+    return np.array([total-total_teste-total_val, total_val, total_teste])
+
+
+# Distribui os nomes entre TREINO, VALIDACAO e TESTE
+#
+# Com rotulos, a distribuição é feita dentro de cada classe (estratificada).
+# anteriores = conjunto já definido de cada nome (-1 para os nomes novos).
+# Só os nomes novos são distribuídos, na ordem do sorteio pelo nome, cada um
+# no conjunto que está mais longe da sua quantidade na classe.
+def sorteia_conjuntos(nomes, perc_teste, perc_val, semente=0, rotulos=None, anteriores=None):
+    total = len(nomes)
+    conjuntos = (np.full(total, _SEM_CONJUNTO, dtype=np.int8) if anteriores is None
+                 else np.array(anteriores, dtype=np.int8))
+    rotulos = np.zeros(total, dtype=np.int64) if rotulos is None else np.asarray(rotulos)
+    for rotulo in np.unique(rotulos):
+        da_classe = np.flatnonzero(rotulos == rotulo)
+        ja_definidos = conjuntos[da_classe][conjuntos[da_classe] != _SEM_CONJUNTO]
+        faltam = _quantidades(len(da_classe), perc_teste, perc_val) - np.bincount(ja_definidos, minlength=3)
+        novos = da_classe[conjuntos[da_classe] == _SEM_CONJUNTO]
+        sorteios = [_sorteio_nome(nomes[i], semente) for i in novos]
+        for i in novos[np.argsort(sorteios, kind='stable')]:
+            conjunto = int(np.argmax(faltam))
+            conjuntos[i] = conjunto
+            faltam[conjunto] -= 1
+    return conjuntos
+
+
+# Grava o manifesto com outro nome e renomeia no final (nunca fica pela metade)
+def grava_manifesto(arquivo, dados):
+    temporario = arquivo + '.tmp.npz'  # np.savez acrescenta .npz se não tiver
+    np.savez_compressed(temporario, **dados)
+    os.replace(temporario, arquivo)
+
+
+# Retorna os índices de treino, validação e teste de uma lista de nomes,
+# reaproveitando o manifesto salvo em "arquivo" se ele ainda servir
+def divide_com_manifesto(arquivo, nomes, perc_teste, perc_val, semente=0, rotulos=None,
+                         assinatura=None):
+    if assinatura is None:
+        assinatura = assinatura_nomes(nomes, rotulos)
+    parametros = np.array([semente, perc_teste, perc_val], dtype=np.float64)
+    conjuntos, anteriores = None, None
+    if os.path.exists(arquivo):
+        with np.load(arquivo) as salvo:
+            if np.array_equal(salvo['parametros'], parametros):
+                if str(salvo['assinatura']) == assinatura:
+                    conjuntos = salvo['conjuntos']
+                else:
+                    # A pasta mudou: os arquivos que já estavam no manifesto
+                    # continuam no mesmo conjunto
+                    salvos = dict(zip(salvo['nomes'].tolist(), salvo['conjuntos'].tolist()))
+                    anteriores = [salvos.get(nome, _SEM_CONJUNTO) for nome in nomes]
+    if conjuntos is None:
+        conjuntos = sorteia_conjuntos(nomes, perc_teste, perc_val, semente, rotulos, anteriores)
+        grava_manifesto(arquivo, {'nomes': np.array(nomes, dtype=str), 'conjuntos': conjuntos,
+                                   'assinatura': np.array(assinatura), 'parametros': parametros})
+    return [np.flatnonzero(conjuntos == conjunto).tolist() for conjunto in (TREINO, VALIDACAO, TESTE)]
+
+
+# Divide os arquivos de uma pasta (que combinam com "padrao") entre treino,
+# validação e teste. Retorna as três listas de nomes.
+def divide_pasta(pasta, arquivo, perc_teste, perc_val, semente=0, padrao="*", verifica=True):
+    if not verifica and os.path.exists(arquivo):
+        with np.load(arquivo) as salvo:
+            if np.array_equal(salvo['parametros'], [semente, perc_teste, perc_val]):
+                nomes, conjuntos = salvo['nomes'].tolist(), salvo['conjuntos']
+                return [[nomes[i] for i in np.flatnonzero(conjuntos == conjunto)]
+                        for conjunto in (TREINO, VALIDACAO, TESTE)]
+    nomes = lista_arquivos(pasta, padrao)
+    indices = divide_com_manifesto(arquivo, nomes, perc_teste, perc_val, semente)
+    return [[nomes[i] for i in idx] for idx in indices]
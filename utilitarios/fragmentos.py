@@ -0,0 +1,207 @@
+# Banco de imagens em fragmentos: substitui o datasets.ImageFolder quando ler
+# muitos arquivos pequenos é o gargalo (disco de rede, por exemplo)
+#
+# Cada imagem da pasta (uma subpasta por classe, como no ImageFolder) é
+# decodificada e redimensionada uma única vez. Os pixels (uint8) são
+# guardados em poucos arquivos grandes ("fragmentos"), cada um com até
+# imagens_por_fragmento imagens. Nas épocas seguintes as imagens são lidas
+# dos fragmentos mapeados em memória (np.load com mmap_mode), sem abrir
+# nenhum JPEG. Organização da pasta de fragmentos:
+#
+# - indice.json: classes, tamanho das imagens, nomes dos arquivos de origem,
+#   total de imagens de cada fragmento e a assinatura da pasta de origem
+# - rotulos.npy: classe de cada imagem (int64)
+# - fragmento_00000.npy, fragmento_00001.npy, ...: total x altura x largura x
+#   canais (uint8)
+#
+# O redimensionamento é o mesmo do transforms.Resize (PIL, bilinear), então
+# as imagens são iguais às que o ImageFolder entregaria com
+# Compose([Resize((altura,largura)), ToTensor()]).
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from utilitarios.carregadores import usa_fork
+
+_VERSAO = 1
+_EXTENSOES = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
+
+
+# Lista as imagens da pasta do mesmo jeito que o ImageFolder (classes em
+# ordem alfabética, arquivos em ordem alfabética dentro de cada classe) e
+# calcula a assinatura (nome, tamanho e data de modificação de cada arquivo)
+def lista_imagens(pasta):
+    classes = sorted(item.name for item in os.scandir(pasta) if item.is_dir())
+    nomes, rotulos = [], []
+    resumo = hashlib.sha1()
+    for rotulo, classe in enumerate(classes):
+        for raiz, _, arquivos in sorted(os.walk(os.path.join(pasta, classe), followlinks=True)):
+            for arquivo in sorted(arquivos):
+                if arquivo.lower().endswith(_EXTENSOES):
+                    caminho = os.path.join(raiz, arquivo)
+                    nome = os.path.relpath(caminho, pasta)
+                    info = os.stat(caminho)
+                    resumo.update(f"{nome}\t{info.st_size}\t{info.st_mtime_ns}\n".encode())
+                    nomes.append(nome)
+                    rotulos.append(rotulo)
+    return classes, nomes, rotulos, resumo.hexdigest()
+
+
+# Decodifica e redimensiona uma imagem. Retorna altura x largura x canais (uint8)
+def _le_imagem(argumentos):
+    from PIL import Image, ImageOps
+    caminho, altura, largura, modo, inverte = argumentos
+    with Image.open(caminho) as imagem:
+        imagem = imagem.convert('RGB').resize((largura, altura), Image.BILINEAR)
+        if modo == 'L':
+            imagem = imagem.convert('L')  # Igual ao transforms.Grayscale
+        if inverte:
+            imagem = ImageOps.invert(imagem)
+        pixels = np.asarray(imagem, dtype=np.uint8)
+    return pixels.reshape(altura, largura, -1)
+
+
+def _parametros(altura, largura, modo, inverte):
+    return {'versao': _VERSAO, 'altura': altura, 'largura': largura, 'modo': modo, 'inverte': inverte}
+
+
+# Cria os fragmentos a partir de uma pasta no formato do ImageFolder
+#
+# modo = "RGB" (3 canais) ou "L" (tons de cinza, 1 canal)
+# inverte = inverte as cores (como no conjunto de teste do exemplo v2)
+# processos = total de processos para decodificar as imagens (None = total
+#             de núcleos). Com 0 ou 1, ou se os processos não forem criados
+#             com "fork" (ver usa_fork em utilitarios/carregadores.py), as
+#             imagens são decodificadas no próprio processo.
+def cria_fragmentos(pasta, destino, altura, largura, modo='RGB', inverte=False,
+                    imagens_por_fragmento=4096, processos=None):
+    classes, nomes, rotulos, assinatura = lista_imagens(pasta)
+    print(f"Criando fragmentos de {len(nomes)} imagens de {pasta} em {destino}")
+    os.makedirs(destino, exist_ok=True)
+    # Sem o índice os fragmentos antigos não são usados, mesmo se a criação
+    # for interrompida no meio
+    if os.path.exists(os.path.join(destino, "indice.json")):
+        os.remove(os.path.join(destino, "indice.json"))
+    canais = 1 if modo == 'L' else 3
+    totais = []
+    if processos is None:
+        processos = os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=processos) if processos > 1 and usa_fork() else None
+    try:
+        for numero, inicio in enumerate(range(0, len(nomes), imagens_por_fragmento)):
+            nomes_fragmento = nomes[inicio:inicio+imagens_por_fragmento]
+            fragmento = np.empty((len(nomes_fragmento), altura, largura, canais), dtype=np.uint8)
+            argumentos = [(os.path.join(pasta, nome), altura, largura, modo, inverte)
+                          for nome in nomes_fragmento]
+            if executor is not None:
+                imagens = executor.map(_le_imagem, argumentos, chunksize=64)
+            else:
+                imagens = map(_le_imagem, argumentos)
+            for i, pixels in enumerate(imagens):
+                fragmento[i] = pixels
+            arquivo = os.path.join(destino, f"fragmento_{numero:05d}.npy")
+            np.save(arquivo + '.tmp.npy', fragmento)
+            os.replace(arquivo + '.tmp.npy', arquivo)
+            totais.append(len(nomes_fragmento))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    np.save(os.path.join(destino, "rotulos.npy"), np.asarray(rotulos, dtype=np.int64))
+    # Apaga fragmentos que sobraram de uma versão anterior (maior) do banco
+    numero = len(totais)
+    while os.path.exists(os.path.join(destino, f"fragmento_{numero:05d}.npy")):
+        os.remove(os.path.join(destino, f"fragmento_{numero:05d}.npy"))
+        numero += 1
+
+    # O índice é gravado por último: indica que os fragmentos estão completos
+    indice = dict(_parametros(altura, largura, modo, inverte), pasta=os.path.abspath(pasta),
+                  classes=classes, nomes=nomes, totais=totais, assinatura=assinatura)
+    with open(os.path.join(destino, "indice.json.tmp"), 'w') as f:
+        json.dump(indice, f)
+    os.replace(os.path.join(destino, "indice.json.tmp"), os.path.join(destino, "indice.json"))
+
+
+# Cria os fragmentos, se ainda não existirem ou se a pasta de origem ou os
+# parâmetros mudaram, e retorna o banco de imagens (ConjuntoFragmentos)
+#
+# verifica=False usa os fragmentos existentes sem listar a pasta de origem
+def prepara_fragmentos(pasta, destino, altura, largura, modo='RGB', inverte=False,
+                       transform=None, verifica=True, **opcoes):
+    arquivo_indice = os.path.join(destino, "indice.json")
+    atualizado = False
+    if os.path.exists(arquivo_indice):
+        with open(arquivo_indice) as f:
+            indice = json.load(f)
+        atualizado = all(indice.get(chave) == valor
+                         for chave, valor in _parametros(altura, largura, modo, inverte).items())
+        if atualizado and verifica:
+            atualizado = indice['assinatura'] == lista_imagens(pasta)[3]
+    if atualizado:
+        print(f"Usando fragmentos já existentes em {destino}")
+    else:
+        cria_fragmentos(pasta, destino, altura, largura, modo, inverte, **opcoes)
+    return ConjuntoFragmentos(destino, transform)
+
+
+# Banco de imagens lido dos fragmentos, com os mesmos atributos do
+# ImageFolder (classes, class_to_idx, samples, targets)
+#
+# Cada item é (imagem, classe), com a imagem em um tensor canais x altura x
+# largura (float entre 0 e 1, como o ToTensor). "transform" é aplicada a
+# esse tensor.
+#
+# Os fragmentos são mapeados só no primeiro acesso e não são levados junto
+# quando o objeto é enviado para outro processo (DataLoader com
+# num_workers > 0), cada processo abre os seus.
+class ConjuntoFragmentos(Dataset):
+    def __init__(self, destino, transform=None):
+        self.destino = destino
+        self.transform = transform
+        with open(os.path.join(destino, "indice.json")) as f:
+            indice = json.load(f)
+        self.classes = indice['classes']
+        self.class_to_idx = {classe: i for i, classe in enumerate(self.classes)}
+        self.targets = np.load(os.path.join(destino, "rotulos.npy")).tolist()
+        self.samples = [(os.path.join(indice['pasta'], nome), rotulo)
+                        for nome, rotulo in zip(indice['nomes'], self.targets)]
+        self.altura, self.largura = indice['altura'], indice['largura']
+        # Posição da primeira imagem de cada fragmento
+        self.inicios = np.concatenate([[0], np.cumsum(indice['totais'])]).astype(np.int64)
+        self._fragmentos = None
+
+    def _abre(self):
+        self._fragmentos = [np.load(os.path.join(self.destino, f"fragmento_{numero:05d}.npy"),
+                                    mmap_mode='r')
+                            for numero in range(len(self.inicios)-1)]
+
+    # Não envia os mapeamentos para outros processos
+    def __getstate__(self):
+        estado = self.__dict__.copy()
+        estado['_fragmentos'] = None
+        return estado
+
+    def __len__(self):
+        return int(self.inicios[-1])
+
+    # Pixels da imagem idx (altura x largura x canais, uint8), sem cópia
+    def pixels(self, idx):
+        if self._fragmentos is None:
+            self._abre()
+        numero = int(np.searchsorted(self.inicios, idx, side='right')) - 1
+        return self._fragmentos[numero][idx - self.inicios[numero]]
+
+    # Todas as imagens de um fragmento (leitura sequencial), sem cópia
+    def fragmento(self, numero):
+        if self._fragmentos is None:
+            self._abre()
+        return self._fragmentos[numero]
+
+    def __getitem__(self, idx):
+        imagem = torch.from_numpy(np.array(self.pixels(idx))).permute(2, 0, 1).float().div_(255)
+        if self.transform is not None:
+            imagem = self.transform(imagem)
+        return imagem, self.targets[idx]
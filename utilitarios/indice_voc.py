@@ -0,0 +1,190 @@
+# Índice das anotações no formato Pascal VOC (um .xml por imagem)
+#
+# Em vez de abrir e interpretar o XML de uma imagem toda vez que ela é usada
+# (em todas as épocas), todos os arquivos XML da pasta são lidos uma única
+# vez e guardados em poucos vetores NumPy ("colunas"):
+#
+# - boxes: total_retangulos x 4 (xmin,ymin,xmax,ymax nas coordenadas originais)
+# - labels: total_retangulos (índice da classe na lista de classes)
+# - inicios: total_xml+1. Os retângulos do arquivo i estão entre
+#   inicios[i] e inicios[i+1]
+# - larguras e alturas: tamanho original de cada imagem (campo <size> do XML,
+#   0 quando o XML não tiver essa informação)
+#
+# O índice pode ser salvo em disco (.npz) e reaproveitado nas próximas
+# execuções. Só os arquivos XML novos ou modificados (data de modificação
+# diferente) são lidos novamente.
+
+import os,fnmatch
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from xml.etree import ElementTree as et # Manipulação de arquivos XML
+from utilitarios.carregadores import usa_fork
+
+# Abaixo desta quantidade de arquivos não compensa criar processos
+_MINIMO_PARA_PARALELIZAR = 64
+
+
+# Lê um arquivo XML e retorna o tamanho da imagem, o nome da classe
+# e as coordenadas de cada retângulo
+def le_xml_voc(xml_anotacao):
+    root = et.parse(xml_anotacao).getroot()
+    size = root.find('size')
+    largura, altura = 0, 0
+    if size is not None and size.find('width') is not None:
+        largura = int(size.find('width').text)
+        altura = int(size.find('height').text)
+    nomes_classes = []
+    boxes = []
+    for member in root.findall('object'):
+        nomes_classes.append(member.find('name').text)
+        bndbox = member.find('bndbox')
+        boxes.append([int(bndbox.find('xmin').text), int(bndbox.find('ymin').text),
+                      int(bndbox.find('xmax').text), int(bndbox.find('ymax').text)])
+    return largura, altura, nomes_classes, boxes
+
+
+# Ajusta as coordenadas dos retângulos (xmin,ymin,xmax,ymax) para o novo
+# tamanho da imagem, corrige os que passaram da borda por causa do
+# arredondamento e calcula a área de cada um. Tudo de uma vez só, sem laço.
+#
+# largura_original e altura_original podem ser um único número (todos os
+# retângulos são da mesma imagem) ou um vetor com um valor por retângulo
+# (retângulos de várias imagens).
+def redimensiona_boxes(boxes, largura_original, altura_original, largura, altura):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    largura_original = np.asarray(largura_original, dtype=np.float64)
+    altura_original = np.asarray(altura_original, dtype=np.float64)
+    originais = np.stack(np.broadcast_arrays(largura_original, altura_original,
+                                             largura_original, altura_original), axis=-1)
+    novos = np.array([largura, altura, largura, altura], dtype=np.float64)
+    boxes = np.clip(boxes/originais*novos, 0, novos).astype(np.float32)
+    area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
+    return boxes, area
+
+
+class IndiceAnotacoes:
+    def __init__(self, classes, nomes, mtimes, larguras, alturas, boxes, labels, inicios):
+        self.classes = list(classes)  # Nomes das classes do problema
+        self.nomes = list(nomes)      # Nomes dos arquivos XML (sem a pasta)
+        self.mtimes = np.asarray(mtimes, dtype=np.float64)
+        self.larguras = np.asarray(larguras, dtype=np.int64)
+        self.alturas = np.asarray(alturas, dtype=np.int64)
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.inicios = np.asarray(inicios, dtype=np.int64)
+        # Dicionário para achar rapidamente a posição de um arquivo no índice
+        self._posicoes = {nome: i for i, nome in enumerate(self.nomes)}
+
+    def __len__(self):
+        return len(self.nomes)
+
+    # Posição do arquivo XML no índice
+    def posicao(self, nome_xml):
+        return self._posicoes[nome_xml]
+
+    # Retângulos (coordenadas originais) e classes do arquivo na posição i.
+    # São apenas fatias dos vetores do índice (não copiam nada).
+    def anotacoes(self, i):
+        inicio, fim = self.inicios[i], self.inicios[i+1]
+        return self.boxes[inicio:fim], self.labels[inicio:fim]
+
+    # Ajusta os retângulos de todas as imagens do índice para o tamanho
+    # largura x altura, de uma só vez, usando o tamanho original de cada
+    # imagem (campo <size> do XML). Retorna os retângulos e as áreas na
+    # mesma ordem de self.boxes (use self.inicios para achar cada imagem).
+    def redimensiona(self, largura, altura):
+        totais = np.diff(self.inicios)
+        larguras = np.repeat(self.larguras, totais)
+        alturas = np.repeat(self.alturas, totais)
+        # Quando o XML não tem o tamanho da imagem (0) não dá para ajustar
+        # aqui. Esses retângulos ficam com NaN e precisam ser ajustados
+        # depois de abrir a imagem.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            boxes, area = redimensiona_boxes(self.boxes, np.where(larguras > 0, larguras, np.nan),
+                                             np.where(alturas > 0, alturas, np.nan),
+                                             largura, altura)
+        return boxes, area
+
+    # Salva o índice em um arquivo .npz
+    def salva(self, arquivo_indice):
+        arquivo_temporario = arquivo_indice + '.tmp.npz'
+        np.savez(arquivo_temporario,
+                 classes=np.asarray(self.classes), nomes=np.asarray(self.nomes, dtype=str),
+                 mtimes=self.mtimes, larguras=self.larguras, alturas=self.alturas,
+                 boxes=self.boxes, labels=self.labels, inicios=self.inicios)
+        os.replace(arquivo_temporario, arquivo_indice)
+
+    # Carrega um índice salvo anteriormente
+    @staticmethod
+    def carrega(arquivo_indice):
+        with np.load(arquivo_indice, allow_pickle=False) as dados:
+            return IndiceAnotacoes(dados['classes'].tolist(), dados['nomes'].tolist(),
+                                   dados['mtimes'], dados['larguras'], dados['alturas'],
+                                   dados['boxes'], dados['labels'], dados['inicios'])
+
+
+# Cria (ou atualiza) o índice com todos os arquivos .xml da pasta
+#
+# pasta = pasta onde estão as imagens e as anotações
+# classes = lista com os nomes das classes (a posição na lista é o label)
+# arquivo_indice = se for passado, o índice é salvo neste arquivo e
+#                  reaproveitado nas próximas vezes
+# processos = total de processos para ler os XML (None = total de núcleos).
+#             Se os processos não forem criados com "fork" (ver usa_fork em
+#             utilitarios/carregadores.py), os XML são lidos no próprio processo.
+def cria_indice_anotacoes(pasta, classes, arquivo_indice=None, processos=None):
+    nomes = sorted(fnmatch.filter(os.listdir(pasta), "*.xml"))
+    mtimes = [os.path.getmtime(os.path.join(pasta, nome)) for nome in nomes]
+
+    # Reaproveita o que for possível de um índice salvo anteriormente
+    anterior = None
+    if arquivo_indice is not None and os.path.exists(arquivo_indice):
+        anterior = IndiceAnotacoes.carrega(arquivo_indice)
+        if anterior.classes != list(classes):
+            anterior = None  # Mudaram as classes, precisa ler tudo de novo
+    if anterior is not None and anterior.nomes == nomes and np.array_equal(anterior.mtimes, mtimes):
+        print(f"Usando índice de anotações já existente em {arquivo_indice}")
+        return anterior
+
+    lidos = {}
+    if anterior is not None:
+        for i, nome in enumerate(anterior.nomes):
+            boxes, labels = anterior.anotacoes(i)
+            lidos[nome] = (anterior.mtimes[i], anterior.larguras[i], anterior.alturas[i],
+                           boxes, labels)
+
+    # Só lê os arquivos novos ou modificados
+    para_ler = [nome for nome, mtime in zip(nomes, mtimes)
+                if nome not in lidos or lidos[nome][0] != mtime]
+    print(f"Lendo {len(para_ler)} de {len(nomes)} arquivos de anotação em {pasta}")
+    caminhos = [os.path.join(pasta, nome) for nome in para_ler]
+    if processos is None:
+        processos = os.cpu_count() or 1
+    if processos > 1 and len(caminhos) >= _MINIMO_PARA_PARALELIZAR and usa_fork():
+        with ProcessPoolExecutor(max_workers=processos) as executor:
+            resultados = list(executor.map(le_xml_voc, caminhos,
+                                           chunksize=max(1, len(caminhos)//(4*processos))))
+    else:
+        resultados = [le_xml_voc(caminho) for caminho in caminhos]
+
+    for nome, (largura, altura, nomes_classes, boxes) in zip(para_ler, resultados):
+        labels = [classes.index(nome_classe) for nome_classe in nomes_classes]
+        lidos[nome] = (None, largura, altura,
+                       np.asarray(boxes, dtype=np.float32).reshape(-1, 4),
+                       np.asarray(labels, dtype=np.int64))
+
+    # Junta tudo em vetores únicos, na ordem dos nomes
+    totais = [len(lidos[nome][4]) for nome in nomes]
+    inicios = np.zeros(len(nomes)+1, dtype=np.int64)
+    inicios[1:] = np.cumsum(totais)
+    indice = IndiceAnotacoes(classes, nomes, mtimes,
+                             [lidos[nome][1] for nome in nomes],
+                             [lidos[nome][2] for nome in nomes],
+                             np.concatenate([lidos[nome][3] for nome in nomes]) if nomes else [],
+                             np.concatenate([lidos[nome][4] for nome in nomes]) if nomes else [],
+                             inicios)
+
+    if arquivo_indice is not None:
+        indice.salva(arquivo_indice)
+    return indice
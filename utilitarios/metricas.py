@@ -0,0 +1,227 @@
+# Métricas de desempenho calculadas a partir da matriz de confusão (e, no
+# final do arquivo, o mAP para detecção de objetos)
+#
+# Em vez de guardar cada predição (ou cada pixel, na segmentação) em uma
+# lista do python e só no final calcular a matriz de confusão, a matriz é
+# acumulada lote a lote, no próprio dispositivo (CPU ou GPU), usando
+# torch.bincount. A memória usada fica constante (total_classes x
+# total_classes), não importa quantas imagens sejam avaliadas.
+
+import torch
+import numpy as np
+
+
+class MatrizConfusao:
+    def __init__(self, total_classes, device="cpu"):
+        self.total_classes = total_classes
+        # Linhas = classe real, colunas = classe predita (como no sklearn)
+        self.matriz = torch.zeros((total_classes, total_classes), dtype=torch.int64, device=device)
+
+    # Acumula as predições de um lote. preditos e reais podem ter qualquer
+    # formato (por exemplo, lote x altura x largura na segmentação), desde
+    # que os dois tenham a mesma quantidade de elementos.
+    def atualiza(self, preditos, reais):
+        preditos = preditos.reshape(-1).to(self.matriz.device, torch.int64)
+        reais = reais.reshape(-1).to(self.matriz.device, torch.int64)
+        # Cada par (real, predito) vira uma única posição da matriz "achatada"
+        posicoes = reais*self.total_classes + preditos
+        contagem = torch.bincount(posicoes, minlength=self.total_classes**2)
+        self.matriz += contagem.reshape(self.total_classes, self.total_classes)
+
+    # Calcula as métricas por classe e as médias. Só aqui os valores saem do
+    # dispositivo (uma única cópia da matriz para a CPU).
+    def calcula(self):
+        matriz = self.matriz.cpu().numpy().astype(np.float64)
+        acertos = np.diag(matriz)
+        suporte = matriz.sum(axis=1)    # Total real de cada classe
+        preditos = matriz.sum(axis=0)   # Total predito de cada classe
+        total = matriz.sum()
+
+        # Divisões por zero (classe que não aparece) viram 0, como no sklearn
+        def divide(a, b):
+            return np.divide(a, b, out=np.zeros_like(a), where=b > 0)
+
+        precisao = divide(acertos, preditos)
+        revocacao = divide(acertos, suporte)
+        fscore = divide(2*precisao*revocacao, precisao+revocacao)
+        iou = divide(acertos, suporte + preditos - acertos)
+        pesos = divide(suporte, np.full_like(suporte, total))
+        # As médias simples (macro) usam só as classes que aparecem nos
+        # valores reais ou nos preditos, como o sklearn (que só considera
+        # os rótulos encontrados em y_true e y_pred)
+        presentes = (suporte > 0) | (preditos > 0)
+
+        def media_presentes(valores):
+            return valores[presentes].mean() if presentes.any() else 0.0
+
+        return {
+            'matriz': matriz.astype(np.int64),
+            'acuracia': acertos.sum()/total if total > 0 else 0.0,
+            'precisao': precisao, 'revocacao': revocacao, 'fscore': fscore,
+            'iou': iou, 'suporte': suporte.astype(np.int64),
+            'precisao_macro': media_presentes(precisao), 'revocacao_macro': media_presentes(revocacao),
+            'fscore_macro': media_presentes(fscore), 'iou_macro': media_presentes(iou),
+            'precisao_ponderada': (precisao*pesos).sum(),
+            'revocacao_ponderada': (revocacao*pesos).sum(),
+            'fscore_ponderada': (fscore*pesos).sum(),
+        }
+
+    # Gera um texto no mesmo formato do metrics.classification_report do
+    # sklearn (com uma coluna a mais para a IoU)
+    def relatorio(self, nomes_classes=None, casas=2):
+        m = self.calcula()
+        if nomes_classes is None:
+            nomes_classes = [str(i) for i in range(self.total_classes)]
+        largura = max(len('weighted avg'), max(len(str(nome)) for nome in nomes_classes))
+        colunas = ['precision', 'recall', 'f1-score', 'iou', 'support']
+        linhas = [' '*largura + ''.join(f'{coluna:>10}' for coluna in colunas), '']
+        for i, nome in enumerate(nomes_classes):
+            linhas.append(f'{str(nome):>{largura}}' +
+                          ''.join(f'{valor:>10.{casas}f}' for valor in
+                                  [m['precisao'][i], m['revocacao'][i], m['fscore'][i], m['iou'][i]]) +
+                          f'{m["suporte"][i]:>10}')
+        total = int(m['suporte'].sum())
+        linhas.append('')
+        linhas.append(f'{"accuracy":>{largura}}' + ' '*20 + f'{m["acuracia"]:>10.{casas}f}' +
+                      ' '*10 + f'{total:>10}')
+        linhas.append(f'{"macro avg":>{largura}}' +
+                      ''.join(f'{valor:>10.{casas}f}' for valor in
+                              [m['precisao_macro'], m['revocacao_macro'], m['fscore_macro'], m['iou_macro']]) +
+                      f'{total:>10}')
+        linhas.append(f'{"weighted avg":>{largura}}' +
+                      ''.join(f'{valor:>10.{casas}f}' for valor in
+                              [m['precisao_ponderada'], m['revocacao_ponderada'], m['fscore_ponderada']]) +
+                      ' '*10 + f'{total:>10}')
+        return '\n'.join(linhas) + '\n'
+
+
+# IoU (interseção sobre união) entre todos os retângulos de "a" (N x 4) e
+# todos os de "b" (M x 4), no formato xmin,ymin,xmax,ymax. Retorna N x M.
+def iou_retangulos(a, b):
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    area_a = (a[:, 2]-a[:, 0]) * (a[:, 3]-a[:, 1])
+    area_b = (b[:, 2]-b[:, 0]) * (b[:, 3]-b[:, 1])
+    largura = np.clip(np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]), 0, None)
+    altura = np.clip(np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]), 0, None)
+    intersecao = largura*altura
+    uniao = area_a[:, None] + area_b[None, :] - intersecao
+    return np.divide(intersecao, uniao, out=np.zeros_like(intersecao), where=uniao > 0)
+
+
+# Precisão média (AP) e mAP para detecção de objetos, como no COCO
+# (mAP@0.5 e mAP@[.5:.95], 101 pontos de revocação)
+#
+# Como na MatrizConfusao, nada é guardado por imagem: para cada limiar de
+# IoU e cada classe são acumulados apenas quantos acertos (verdadeiros
+# positivos) e quantas detecções existem em cada faixa de score (faixas_score
+# faixas entre 0 e 1). A memória fica constante, não importa o tamanho do
+# conjunto de teste. Detecções com scores na mesma faixa são tratadas como
+# empatadas, o que muda o AP só a partir da terceira ou quarta casa decimal
+# com as 1000 faixas padrão.
+class AcumuladorDeteccao:
+    def __init__(self, total_classes, limiares_iou=None, faixas_score=1000):
+        self.total_classes = total_classes
+        self.limiares_iou = (np.round(np.arange(0.5, 0.951, 0.05), 2) if limiares_iou is None
+                             else np.asarray(limiares_iou, dtype=np.float64))
+        self.faixas_score = faixas_score
+        self.acertos = np.zeros((len(self.limiares_iou), total_classes, faixas_score), dtype=np.int64)
+        self.detectados = np.zeros((total_classes, faixas_score), dtype=np.int64)
+        self.total_reais = np.zeros(total_classes, dtype=np.int64)
+
+    # Para cada limiar de IoU, marca quais detecções (já em ordem decrescente
+    # de score) acertaram um objeto real. Cada objeto real só pode ser
+    # encontrado uma vez: vale a detecção de maior score, com o objeto ainda
+    # livre de maior IoU (todos os limiares são tratados de uma vez).
+    def _casa(self, iou):
+        total_detectados, total_reais = iou.shape
+        limiares = len(self.limiares_iou)
+        acertou = np.zeros((limiares, total_detectados), dtype=bool)
+        if total_detectados == 0 or total_reais == 0:
+            return acertou
+        livres = np.ones((limiares, total_reais), dtype=bool)
+        todos = np.arange(limiares)
+        for d in range(total_detectados):
+            candidatos = np.where(livres & (iou[d][None, :] >= self.limiares_iou[:, None]), iou[d][None, :], -1)
+            melhor = candidatos.argmax(axis=1)
+            encontrou = candidatos[todos, melhor] >= 0
+            acertou[encontrou, d] = True
+            livres[todos[encontrou], melhor[encontrou]] = False
+        return acertou
+
+    # Acumula as previsões de um lote, no formato retornado pelas redes de
+    # detecção do torchvision (uma lista com um dicionário boxes, labels e
+    # scores por imagem) e as anotações (dicionários com boxes e labels)
+    def atualiza(self, previsoes, anotacoes):
+        for previsao, anotacao in zip(previsoes, anotacoes):
+            boxes = previsao['boxes'].detach().cpu().numpy()
+            labels = previsao['labels'].detach().cpu().numpy()
+            scores = previsao['scores'].detach().cpu().numpy()
+            boxes_reais = anotacao['boxes'].detach().cpu().numpy()
+            labels_reais = anotacao['labels'].detach().cpu().numpy()
+            for classe in np.union1d(labels, labels_reais):
+                desta_classe = labels == classe
+                ordem = np.argsort(-scores[desta_classe], kind='stable')
+                reais = boxes_reais[labels_reais == classe]
+                self.total_reais[classe] += len(reais)
+                acertou = self._casa(iou_retangulos(boxes[desta_classe][ordem], reais))
+                faixas = np.minimum((scores[desta_classe][ordem]*self.faixas_score).astype(np.int64),
+                                    self.faixas_score-1)
+                np.add.at(self.detectados[classe], faixas, 1)
+                limiar, deteccao = np.nonzero(acertou)
+                np.add.at(self.acertos, (limiar, classe, faixas[deteccao]), 1)
+
+    # Calcula o AP de cada classe e limiar de IoU, o mAP@0.5, o mAP@[.5:.95]
+    # e as curvas de precisão x revocação (IoU 0.5). Classes sem nenhum
+    # objeto real (como o fundo) ficam com AP = NaN e não entram na média.
+    def calcula(self):
+        # Soma acumulada do maior para o menor score
+        acertos = np.cumsum(self.acertos[..., ::-1], axis=-1).astype(np.float64)
+        detectados = np.cumsum(self.detectados[:, ::-1], axis=-1).astype(np.float64)
+        reais = self.total_reais.astype(np.float64)
+        revocacao = np.divide(acertos, reais[None, :, None], out=np.zeros_like(acertos),
+                              where=reais[None, :, None] > 0)
+        precisao = np.divide(acertos, detectados[None], out=np.zeros_like(acertos),
+                             where=detectados[None] > 0)
+        # Precisão interpolada: a maior precisão com revocação igual ou maior
+        envelope = np.maximum.accumulate(precisao[..., ::-1], axis=-1)[..., ::-1]
+        pontos = np.linspace(0, 1, 101)
+        ap = np.full((len(self.limiares_iou), self.total_classes), np.nan)
+        for t in range(len(self.limiares_iou)):
+            for classe in np.flatnonzero(self.total_reais > 0):
+                posicoes = np.searchsorted(revocacao[t, classe], pontos, side='left')
+                validos = posicoes < self.faixas_score
+                ap[t, classe] = np.where(validos, envelope[t, classe, np.minimum(posicoes, self.faixas_score-1)],
+                                         0).mean()
+        t50 = np.argmin(np.abs(self.limiares_iou-0.5))  # Posição do limiar 0.5
+        ap_50 = ap[t50]
+        ap_medio = ap.mean(axis=0)
+        com_objetos = self.total_reais > 0
+        # Um ponto da curva para cada faixa de score que tem detecções
+        curvas_pr = []
+        for classe in range(self.total_classes):
+            pontos_curva = self.detectados[classe, ::-1] > 0
+            curvas_pr.append((revocacao[t50, classe, pontos_curva], precisao[t50, classe, pontos_curva]))
+        return {
+            'ap': ap, 'ap_50': ap_50, 'ap_medio': ap_medio,
+            'map_50': float(np.mean(ap_50[com_objetos])) if com_objetos.any() else 0.0,
+            'map': float(np.mean(ap_medio[com_objetos])) if com_objetos.any() else 0.0,
+            'curvas_pr': curvas_pr,  # (revocação, precisão) de cada classe, IoU 0.5
+            'total_reais': self.total_reais.copy(),
+        }
+
+    # Texto com o AP de cada classe e o mAP
+    def relatorio(self, nomes_classes=None, casas=3):
+        m = self.calcula()
+        if nomes_classes is None:
+            nomes_classes = [str(i) for i in range(self.total_classes)]
+        largura = max(len('mAP'), max(len(str(nome)) for nome in nomes_classes))
+        linhas = [' '*largura + f'{"AP50":>10}{"AP50:95":>10}{"objetos":>10}', '']
+        for i, nome in enumerate(nomes_classes):
+            if self.total_reais[i] > 0:
+                linhas.append(f'{str(nome):>{largura}}{m["ap_50"][i]:>10.{casas}f}'
+                              f'{m["ap_medio"][i]:>10.{casas}f}{self.total_reais[i]:>10}')
+        linhas.append('')
+        linhas.append(f'{"mAP":>{largura}}{m["map_50"]:>10.{casas}f}{m["map"]:>10.{casas}f}'
+                      f'{int(self.total_reais.sum()):>10}')
+        return '\n'.join(linhas) + '\n'
@@ -0,0 +1,350 @@
+# Motor de treino: roda o treinamento dos exemplos sem precisar editar (ou
+# copiar) os scripts exemplo_pytorch_v*.py
+#
+# Os hiperparâmetros, que nos exemplos ficam no início do script, aqui vêm
+# de um dicionário de configuração montado a partir de (em ordem de
+# prioridade crescente):
+#
+# 1. CONFIG_PADRAO (abaixo)
+# 2. os valores padrão da tarefa escolhida (ver utilitarios/tarefas.py)
+# 3. um arquivo JSON (--config arquivo.json)
+# 4. a linha de comando (--chave valor)
+#
+# Exemplo:
+#
+#    python treina.py --tarefa segmentacao --pasta_data ./data/ --epocas 20
+#
+# Importar este módulo não baixa dados, não mostra gráficos e não treina
+# nada. Tudo acontece apenas em treina(config) ou main().
+
+import argparse
+import json
+import os
+import sys
+import time
+import torch
+from utilitarios.acumulacao import AcumulacaoGradientes
+from utilitarios.carregadores import cria_dataloader
+from utilitarios.checkpoint import (GravadorCheckpoint, monta_checkpoint, retoma_checkpoint,
+                                   nome_checkpoint, descarta_checkpoint)
+from utilitarios.precisao import ModoDesempenho
+from utilitarios.recomputacao import ativa_recomputacao, compara_recomputacao
+from utilitarios.tarefas import TAREFAS
+
+CONFIG_PADRAO = {
+    'tarefa': 'classificacao',  # "classificacao", "segmentacao" ou "deteccao"
+    'pasta_data': './data/',    # Pasta com as imagens (formato de cada tarefa)
+    'pasta_saida': './saida/',  # Onde ficam a rede treinada e o histórico
+    'epocas': 100,
+    'tamanho_lote': 16,
+    'acumula_gradientes': 1,    # Lotes somados antes de ajustar os pesos (lote efetivo =
+                                # tamanho_lote*acumula_gradientes, ver utilitarios/acumulacao.py)
+    'processos_carregamento': None,
+    'intervalo_log': 10,
+    'otimizador': 'sgd',        # "sgd" ou "adam"
+    'taxa_aprendizagem': 0.01,
+    'momento': 0.9,
+    'peso_regularizador': 0,
+    'paciencia': 5,
+    'tolerancia': 0.01,
+    'retomar': False,           # Continua um treinamento interrompido com a mesma configuração
+    'intervalo_checkpoint': 1,  # Épocas entre os checkpoints completos
+    'perc_teste': 0.2,
+    'perc_val': 0.2,
+    'semente': None,            # Semente para os pesos iniciais e a ordem dos lotes
+    'semente_divisao': 0,       # Semente da divisão dos conjuntos (ver utilitarios/divisao.py)
+    'pre_treinada': True,       # Começa dos pesos pré-treinados na ImageNet
+    'precisao': 'fp32',         # Ver utilitarios/precisao.py
+    'canais_no_fim': False,
+    'recomputa_ativacoes': False,  # Menos memória, passo mais lento (ver utilitarios/recomputacao.py)
+}
+
+# Chaves que podem mudar ao continuar um treinamento interrompido (não entram
+# na assinatura do checkpoint, ver _config_checkpoint)
+_CHAVES_LIVRES_AO_RETOMAR = {'epocas', 'retomar', 'intervalo_checkpoint', 'intervalo_log',
+                             'processos_carregamento', 'paciencia', 'pasta_saida'}
+
+
+# Parte da configuração que define o treinamento (a que fica no checkpoint)
+def _config_checkpoint(config):
+    return {chave: valor for chave, valor in config.items() if chave not in _CHAVES_LIVRES_AO_RETOMAR}
+
+
+# Monta a configuração completa
+#
+# arquivo = arquivo JSON com parte (ou todos) os valores
+# alteracoes = dicionário com valores que têm prioridade sobre o arquivo
+def monta_config(arquivo=None, alteracoes=None):
+    do_arquivo = {}
+    if arquivo is not None:
+        with open(arquivo) as f:
+            do_arquivo = json.load(f)
+    alteracoes = alteracoes or {}
+    tarefa = alteracoes.get('tarefa', do_arquivo.get('tarefa', CONFIG_PADRAO['tarefa']))
+    if tarefa not in TAREFAS:
+        raise ValueError(f"tarefa deve ser uma de {list(TAREFAS)}, recebeu {tarefa!r}")
+    config = dict(CONFIG_PADRAO)
+    config.update(TAREFAS[tarefa].padrao)
+    for origem in (do_arquivo, alteracoes):
+        desconhecidas = set(origem) - set(config)
+        if desconhecidas:
+            raise ValueError(f"Chaves desconhecidas para a tarefa {tarefa}: {sorted(desconhecidas)}")
+        config.update(origem)
+    return config
+
+
+def _cria_otimizador(config, model):
+    if config['otimizador'] == 'sgd':
+        return torch.optim.SGD(model.parameters(), lr=config['taxa_aprendizagem'],
+                               momentum=config['momento'], weight_decay=config['peso_regularizador'])
+    if config['otimizador'] == 'adam':
+        return torch.optim.Adam(model.parameters(), lr=config['taxa_aprendizagem'],
+                                weight_decay=config['peso_regularizador'])
+    raise ValueError(f"otimizador deve ser 'sgd' ou 'adam', recebeu {config['otimizador']!r}")
+
+
+# Total de imagens que passam pela rede em uma época (sem o último lote, se
+# ele for descartado por estar incompleto)
+def _total_imagens(lotes):
+    if lotes.drop_last:
+        return len(lotes)*lotes.batch_size
+    return len(lotes.dataset)
+
+
+# Passa uma vez por todos os lotes. Com treinando=True ajusta os pesos.
+# Retorna a perda média e a acurácia (None se a tarefa não conta acertos).
+def _passa_lotes(tarefa, lotes, model, device, modo, config, otimizador=None):
+    treinando = otimizador is not None
+    model.train(treinando or tarefa.validacao_em_modo_treino)
+    # Acumulados no dispositivo, só são lidos no final
+    perda_total = torch.zeros((), device=device)
+    acertos_total = torch.zeros((), dtype=torch.int64, device=device)
+    itens_total = 0
+    if treinando:
+        acumulacao = AcumulacaoGradientes(_total_imagens(lotes), lotes.batch_size,
+                                          config['acumula_gradientes'])
+        otimizador.zero_grad()
+    with torch.set_grad_enabled(treinando):
+        for batch, lote in enumerate(lotes):
+            entrada, alvo = tarefa.prepara_lote(lote, device)
+            if torch.is_tensor(entrada):
+                entrada = modo.prepara_entrada(entrada)
+            with modo.autocast():
+                loss, acertos, itens = tarefa.calcula(model, entrada, alvo)
+            perda_total += loss.detach().float()
+            if acertos is not None:
+                acertos_total += acertos
+                itens_total += itens
+            if treinando:
+                # Com acumula_gradientes > 1 os pesos só são ajustados no fim
+                # de cada grupo de lotes
+                modo.passo(loss*acumulacao.peso(batch), otimizador, acumulacao.ajusta(batch))
+                if batch % config['intervalo_log'] == 0:
+                    print(f"Perda Treino: {loss.item():>7f}  [{batch:>5d}/{len(lotes):>5d} lotes]")
+    perda = perda_total.item() / max(1, len(lotes))
+    acuracia = acertos_total.item() / itens_total if itens_total > 0 else None
+    return perda, acuracia
+
+
+# Passa pelo conjunto de validação. Retorna a perda média e a métrica da
+# tarefa (acurácia, ou o mAP na detecção). Tarefas com um método "valida"
+# calculam a métrica do seu jeito; as outras contam os acertos dos lotes.
+def _valida(tarefa, lotes, model, device, modo, config):
+    if hasattr(tarefa, 'valida'):
+        return tarefa.valida(model, lotes, device, modo)
+    return _passa_lotes(tarefa, lotes, model, device, modo, config)
+
+
+# Cria a rede da tarefa no dispositivo, no modo de desempenho escolhido
+def _cria_rede(tarefa, config, device):
+    modo = ModoDesempenho(device, config['precisao'], config['canais_no_fim'])
+    model = modo.prepara_modelo(tarefa.cria_modelo().to(device))
+    if config['recomputa_ativacoes']:
+        print(f"Recomputação de ativações ligada em {ativa_recomputacao(model)} blocos da ResNet")
+    return modo, model
+
+
+# Mede o tempo e o pico de memória de um passo de treinamento (com o
+# primeiro lote de treino) com e sem a recomputação de ativações, sem
+# treinar a rede (ver utilitarios/recomputacao.py)
+def compara_recomputacao_config(config, repeticoes=3):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    os.makedirs(config['pasta_saida'], exist_ok=True)  # A divisão dos conjuntos fica nela
+    tarefa = TAREFAS[config['tarefa']](config)
+    treino, _, _ = tarefa.cria_conjuntos()
+    lotes = cria_dataloader(treino, config['tamanho_lote'], shuffle=True,
+                            collate_fn=tarefa.collate_fn, num_workers=0)
+    modo, model = _cria_rede(tarefa, config, device)
+    model.train()
+    entrada, alvo = tarefa.prepara_lote(next(iter(lotes)), device)
+    if torch.is_tensor(entrada):
+        entrada = modo.prepara_entrada(entrada)
+
+    def passo():
+        with modo.autocast():
+            loss, _, _ = tarefa.calcula(model, entrada, alvo)
+        loss.backward()
+
+    print(f"Um passo de {config['tarefa']} ({config['nome_rede']}), lote de {config['tamanho_lote']} "
+          f"imagens, em {device}:")
+    return compara_recomputacao(model, passo, device, repeticoes)
+
+
+# Treina uma rede com a configuração dada (ver monta_config)
+#
+# Retorna um dicionário com o histórico das épocas, o arquivo da melhor rede
+# e as métricas no conjunto de teste
+def treina(config):
+    if config['semente'] is not None:
+        torch.manual_seed(config['semente'])
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Usando {device}")
+    os.makedirs(config['pasta_saida'], exist_ok=True)
+    with open(os.path.join(config['pasta_saida'], "config.json"), 'w') as f:
+        json.dump(config, f, indent=2)
+
+    tarefa = TAREFAS[config['tarefa']](config)
+    treino, val, teste = tarefa.cria_conjuntos()
+    print(f"Imagens: {len(treino)} treino, {len(val)} validação, {len(teste)} teste")
+    lotes = {}
+    for nome, conjunto in (('treino', treino), ('val', val), ('teste', teste)):
+        lotes[nome] = cria_dataloader(conjunto, config['tamanho_lote'], shuffle=(nome == 'treino'),
+                                      collate_fn=tarefa.collate_fn,
+                                      num_workers=config['processos_carregamento'],
+                                      drop_last=(nome == 'treino' and tarefa.descarta_lote_incompleto))
+
+    modo, model = _cria_rede(tarefa, config, device)
+    otimizador = _cria_otimizador(config, model)
+    arquivo_modelo = os.path.join(config['pasta_saida'],
+                                  f"modelo_treinado_{config['tarefa']}_{config['nome_rede']}.pth")
+    # Um arquivo por configuração: treinamentos diferentes na mesma pasta de
+    # saída não continuam o checkpoint um do outro
+    config_treino = _config_checkpoint(config)
+    arquivo_checkpoint = os.path.join(config['pasta_saida'], nome_checkpoint("checkpoint", config_treino))
+
+    # Parada antecipada: acompanha a métrica da tarefa na validação (acurácia
+    # ou mAP, maior é melhor) ou a perda (menor é melhor)
+    maior_melhor = tarefa.criterio != 'perda'
+    melhor = None
+    total_sem_melhora = 0
+    historico = []
+    # Checkpoints completos gravados em segundo plano (ver utilitarios/checkpoint.py)
+    gravador = GravadorCheckpoint()
+    epoca_inicial = 0
+    if config['retomar']:
+        retomado = retoma_checkpoint(arquivo_checkpoint, model, otimizador, modo.escalador, device,
+                                     config_treino)
+        if retomado is not None:
+            epoca_inicial, variaveis = retomado
+            melhor = variaveis['melhor']
+            total_sem_melhora = variaveis['total_sem_melhora']
+            historico = variaveis['historico']
+            if tarefa.aumento is not None:
+                tarefa.aumento.restaura(variaveis['estado_aumento'])
+            print(f"Continuando o treinamento interrompido a partir da época {epoca_inicial+1}")
+            if variaveis['terminou']:
+                epoca_inicial = config['epocas']
+    for epoca in range(epoca_inicial, config['epocas']):
+        print(f"-------------------------------")
+        print(f"Época {epoca+1} \n-------------------------------")
+        inicio = time.perf_counter()
+        train_loss, train_acuracia = _passa_lotes(tarefa, lotes['treino'], model, device, modo,
+                                                  config, otimizador)
+        tempo = time.perf_counter() - inicio
+        val_loss, val_metrica = _valida(tarefa, lotes['val'], model, device, modo, config)
+        registro = {'epoca': epoca+1, 'train_loss': train_loss, 'train_acuracia': train_acuracia,
+                    'val_loss': val_loss, 'imagens_por_segundo': _total_imagens(lotes['treino'])/tempo}
+        if tarefa.criterio != 'perda':
+            registro['val_'+tarefa.criterio] = val_metrica
+        historico.append(registro)
+        print(f"Validação: perda {val_loss:>8f}" +
+              (f", acurácia {100*val_metrica:>0.2f}%" if tarefa.criterio == 'acuracia' else "") +
+              (f", mAP@[.5:.95] {val_metrica:>0.4f}" if tarefa.criterio == 'map' else ""))
+
+        valor = val_metrica if maior_melhor else val_loss
+        if melhor is None or (valor > melhor+config['tolerancia'] if maior_melhor
+                              else valor < melhor-config['tolerancia']):
+            gravador.salva(arquivo_modelo, model.state_dict())
+            print("Salvou a melhor rede até agora em "+arquivo_modelo)
+            melhor = valor
+            total_sem_melhora = 0
+        else:
+            total_sem_melhora += 1
+            print(f"Sem melhora há {total_sem_melhora} épocas")
+        terminou = total_sem_melhora > config['paciencia']
+        if (epoca+1) % config['intervalo_checkpoint'] == 0 or terminou or epoca+1 == config['epocas']:
+            variaveis = {'melhor': melhor, 'total_sem_melhora': total_sem_melhora,
+                         'historico': historico, 'terminou': terminou}
+            if tarefa.aumento is not None:
+                variaveis['estado_aumento'] = tarefa.aumento.estado()
+            gravador.salva(arquivo_checkpoint,
+                           monta_checkpoint(epoca+1, model, otimizador, variaveis,
+                                            modo.escalador, config_treino))
+        if terminou:
+            print(f"Acabou a paciência com {epoca+1} épocas ")
+            break
+
+    gravador.fecha()  # Espera terminar a gravação dos arquivos
+    descarta_checkpoint(arquivo_checkpoint)  # Terminou: o próximo treinamento começa do zero
+    print("Terminou a fase de aprendizagem !")
+    model.load_state_dict(torch.load(arquivo_modelo, map_location=device))
+    resultado = {'historico': historico, 'arquivo_modelo': arquivo_modelo,
+                 'teste': tarefa.avalia_teste(model, lotes['teste'], device, modo)}
+    print("Teste:", resultado['teste'])
+    with open(os.path.join(config['pasta_saida'], "resultado.json"), 'w') as f:
+        json.dump(resultado, f, indent=2)
+    return resultado
+
+
+# Converte um valor da linha de comando: números, true/false, null e listas
+# são lidos como JSON. O resto fica como texto.
+def _converte_valor(texto):
+    try:
+        return json.loads(texto)
+    except json.JSONDecodeError:
+        return texto
+
+
+# Lê a linha de comando, monta a configuração e treina
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Treina as redes dos exemplos (classificação, segmentação ou detecção).",
+        epilog="Qualquer hiperparâmetro pode ser alterado com --chave valor "
+               "(ex.: --epocas 10 --classes '[\"fundo\",\"conde\"]'). "
+               "Use --mostra_config para ver todas as chaves.")
+    parser.add_argument('--config', help="arquivo JSON com os hiperparâmetros")
+    parser.add_argument('--mostra_config', action='store_true',
+                        help="mostra a configuração final e sai, sem treinar")
+    parser.add_argument('--compara_recomputacao', action='store_true',
+                        help="mede o tempo e o pico de memória de um passo com e sem a "
+                             "recomputação de ativações e sai, sem treinar")
+    args, resto = parser.parse_known_args(argv)
+
+    # O restante deve ser uma sequência de --chave valor (ou --chave=valor)
+    alteracoes = {}
+    i = 0
+    while i < len(resto):
+        if not resto[i].startswith('--'):
+            parser.error(f"argumento inesperado: {resto[i]}")
+        chave = resto[i][2:]
+        if '=' in chave:
+            chave, valor = chave.split('=', 1)
+            i += 1
+        elif i+1 < len(resto):
+            valor = resto[i+1]
+            i += 2
+        else:
+            parser.error(f"falta o valor de --{chave}")
+        alteracoes[chave] = _converte_valor(valor)
+
+    try:
+        config = monta_config(args.config, alteracoes)
+    except ValueError as erro:
+        parser.error(str(erro))
+    if args.mostra_config:
+        json.dump(config, sys.stdout, indent=2)
+        print()
+        return config
+    if args.compara_recomputacao:
+        return compara_recomputacao_config(config)
+    return treina(config)
@@ -0,0 +1,112 @@
+# Modo de desempenho para o treinamento: precisão mista e channels_last
+#
+# Por padrão as redes são treinadas em float32 e com as imagens no formato
+# NCHW (lote, canais, altura, largura). Aqui é possível ligar:
+#
+# - precisão mista: as operações mais pesadas (convoluções, multiplicações de
+#   matrizes) rodam em bfloat16 ou float16 via torch.autocast, enquanto os
+#   pesos continuam em float32. O bfloat16 funciona na CPU (e em GPUs
+#   recentes) e tem o mesmo intervalo de valores do float32, então não
+#   precisa escalar a perda. O float16 (apenas GPU) tem intervalo pequeno e
+#   os gradientes podem virar zero, por isso usa um GradScaler.
+# - channels_last: guarda a rede e as imagens no formato NHWC, que é o
+#   formato mais rápido para as convoluções na CPU (oneDNN) e nos tensor
+#   cores da GPU.
+
+import contextlib
+import json
+import os
+import torch
+
+# Tipos aceitos em "precisao" (None = sem autocast)
+PRECISOES = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+class ModoDesempenho:
+    # device = dispositivo onde a rede vai rodar ("cpu" ou "cuda")
+    # precisao = "fp32", "bf16" ou "fp16"
+    # canais_no_fim = usa o formato channels_last (NHWC)
+    def __init__(self, device, precisao="fp32", canais_no_fim=False):
+        if precisao not in PRECISOES:
+            raise ValueError(f"precisao deve ser uma de {list(PRECISOES)}, recebeu {precisao!r}")
+        self.tipo_dispositivo = "cuda" if str(device).startswith("cuda") else "cpu"
+        if precisao == "fp16" and self.tipo_dispositivo != "cuda":
+            raise ValueError("precisao='fp16' só é suportada na GPU. Na CPU use 'bf16'.")
+        self.precisao = precisao
+        self.dtype = PRECISOES[precisao]
+        self.canais_no_fim = canais_no_fim
+        # Só o float16 precisa escalar a perda para os gradientes não zerarem
+        self.escalador = torch.amp.GradScaler("cuda") if precisao == "fp16" else None
+
+    # Nome curto do modo, usado nos relatórios (ex.: "bf16+channels_last")
+    @property
+    def nome(self):
+        return self.precisao + ("+channels_last" if self.canais_no_fim else "")
+
+    # Coloca a rede no formato de memória escolhido
+    def prepara_modelo(self, model):
+        if self.canais_no_fim:
+            model = model.to(memory_format=torch.channels_last)
+        return model
+
+    # Coloca um lote de imagens (4 dimensões) no formato de memória escolhido
+    def prepara_entrada(self, X):
+        if self.canais_no_fim and X.dim() == 4:
+            X = X.contiguous(memory_format=torch.channels_last)
+        return X
+
+    # Contexto para a passagem "para frente" da rede e o cálculo da perda
+    def autocast(self):
+        if self.dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(self.tipo_dispositivo, dtype=self.dtype)
+
+    # Calcula os gradientes e ajusta os pesos (escalando a perda se precisar)
+    # Com ajusta=False os gradientes só são somados aos anteriores, sem mexer
+    # nos pesos (acumulação de gradientes, ver utilitarios/acumulacao.py)
+    def passo(self, loss, optimizer, ajusta=True):
+        if self.escalador is None:
+            loss.backward()
+        else:
+            self.escalador.scale(loss).backward()
+        if not ajusta:
+            return
+        if self.escalador is None:
+            optimizer.step()
+        else:
+            self.escalador.step(optimizer)  # Pula o passo se houver inf/NaN
+            self.escalador.update()
+        optimizer.zero_grad()
+
+
+# Guarda a velocidade e a acurácia de um treinamento e compara com o
+# treinamento em fp32 (sem channels_last) da mesma rede, se já existir
+#
+# arquivo = arquivo json com os resultados de todos os modos
+# nome_rede = rede treinada (ex.: "densenet")
+# modo = ModoDesempenho usado no treinamento
+# imagens_por_segundo = velocidade média do treinamento
+# acuracia = melhor acurácia na validação
+def registra_e_compara(arquivo, nome_rede, modo, imagens_por_segundo, acuracia):
+    resultados = {}
+    if os.path.exists(arquivo):
+        with open(arquivo) as f:
+            resultados = json.load(f)
+    resultados.setdefault(nome_rede, {})[modo.nome] = {
+        'imagens_por_segundo': imagens_por_segundo, 'acuracia': acuracia}
+    temporario = arquivo + '.tmp'
+    with open(temporario, 'w') as f:
+        json.dump(resultados, f, indent=2)
+    os.replace(temporario, arquivo)
+
+    print(f"Modo {modo.nome}: {imagens_por_segundo:>0.1f} imagens/s, acurácia {100*acuracia:>0.2f}%")
+    base = resultados[nome_rede].get("fp32")
+    if modo.nome == "fp32":
+        return
+    if base is None:
+        print("(treine também com precisao='fp32' e canais_no_fim=False para comparar)")
+        return
+    ganho = imagens_por_segundo / base['imagens_por_segundo']
+    diferenca = 100*(acuracia - base['acuracia'])
+    print(f"Comparado ao fp32: {ganho:>0.2f}x a velocidade, "
+          f"acurácia {diferenca:+0.2f} pontos percentuais")
@@ -0,0 +1,164 @@
+# Recomputação de ativações (activation checkpointing) nas ResNets usadas
+# como base (backbone) da fcn_resnet50, da deeplabv3_resnet50 e da
+# fasterrcnn_resnet50_fpn
+#
+# No treinamento, todas as saídas intermediárias da rede ficam guardadas até
+# o backward, que precisa delas para calcular os gradientes. Na resnet50 com
+# imagens de 500x500 isso é a maior parte da memória usada. Com a
+# recomputação ligada, cada bloco dos estágios layer1 a layer4 guarda só a
+# sua entrada: as ativações de dentro do bloco são descartadas e calculadas
+# de novo durante o backward. Gasta menos memória (permite lotes ou imagens
+# maiores) em troca de mais tempo (uma passada "para frente" a mais nos
+# blocos).
+#
+# Os nomes dos pesos não mudam (só o forward de cada bloco é trocado), então
+# os arquivos .pth salvos com ou sem recomputação são os mesmos.
+#
+# As BatchNorm da fcn e da deeplabv3 atualizam as médias e variâncias a cada
+# passada no modo de treinamento. Para que a passada extra do backward não
+# conte duas vezes, as estatísticas não são alteradas durante o recálculo.
+#
+# Para ver o ganho de memória e o custo em tempo, use compara_recomputacao
+# (ou treina.py --compara_recomputacao).
+
+import copy
+import re
+import time
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+_ESTAGIOS = ['layer1', 'layer2', 'layer3', 'layer4']
+
+
+# Blocos dos estágios layer1 a layer4 da ResNet usada pela rede (a própria
+# rede, se for uma ResNet de classificação)
+def blocos_resnet(model):
+    corpo = getattr(model, 'backbone', model)
+    corpo = getattr(corpo, 'body', corpo)  # Faster RCNN: a ResNet fica dentro da FPN
+    estagios = [getattr(corpo, nome) for nome in _ESTAGIOS if hasattr(corpo, nome)]
+    if not estagios:
+        raise ValueError(f"{type(model).__name__} não tem uma ResNet com os estágios {_ESTAGIOS}")
+    return [bloco for estagio in estagios for bloco in estagio]
+
+
+# Liga (ou desliga, com ativa=False) a recomputação nos blocos da ResNet da
+# rede. Retorna o total de blocos alterados.
+def ativa_recomputacao(model, ativa=True):
+    blocos = blocos_resnet(model)
+    for bloco in blocos:
+        if ativa:
+            bloco.forward = _forward_recomputado(bloco)
+        elif 'forward' in vars(bloco):
+            del bloco.forward  # Volta ao forward da classe
+    return len(blocos)
+
+
+# Forward do bloco que guarda só a entrada para o backward
+def _forward_recomputado(bloco):
+    forward_original = type(bloco).forward.__get__(bloco)
+    normalizacoes = [m for m in bloco.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+
+    def forward(x):
+        # Sem gradientes (validação, teste) não há nada para economizar
+        if not torch.is_grad_enabled():
+            return forward_original(x)
+        primeira = [True]
+
+        def calcula(x):
+            if primeira[0]:
+                primeira[0] = False
+                return forward_original(x)
+            return _sem_atualizar_estatisticas(normalizacoes, forward_original, x)
+
+        return checkpoint(calcula, x, use_reentrant=False)
+
+    return forward
+
+
+# Roda "funcao" sem alterar as médias e variâncias das BatchNorm (com
+# momentum 0 a média móvel não muda, mas a normalização continua usando as
+# estatísticas do lote, como na primeira passada)
+def _sem_atualizar_estatisticas(normalizacoes, funcao, x):
+    guardados = [(m.momentum, m.num_batches_tracked.clone() if m.num_batches_tracked is not None else None)
+                 for m in normalizacoes]
+    for m in normalizacoes:
+        m.momentum = 0.0
+    try:
+        return funcao(x)
+    finally:
+        for m, (momento, contagem) in zip(normalizacoes, guardados):
+            m.momentum = momento
+            if contagem is not None:
+                m.num_batches_tracked.copy_(contagem)
+
+
+# Zera o registro do pico de memória do processo (GPU: memória alocada pelo
+# pytorch; CPU: memória residente do processo, só no Linux)
+def _zera_pico(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    try:
+        with open('/proc/self/clear_refs', 'w') as arquivo:
+            arquivo.write('5')
+    except OSError:
+        pass
+
+
+# Pico de memória (em bytes) desde o último _zera_pico. None se não for
+# possível medir.
+def _le_pico(device):
+    if str(device).startswith('cuda'):
+        return torch.cuda.max_memory_allocated(device)
+    try:
+        with open('/proc/self/status') as arquivo:
+            return 1024*int(re.search(r'VmHWM:\s+(\d+)', arquivo.read()).group(1))
+    except (OSError, AttributeError):
+        return None
+
+
+# Mede o tempo médio e o pico de memória de "passo" (uma função sem
+# argumentos que faz a passada para frente e o backward de um lote)
+def mede_passo(model, passo, device, repeticoes=3):
+    model.zero_grad(set_to_none=True)
+    passo()  # Aquecimento (alocações e escolha de algoritmos da primeira vez)
+    model.zero_grad(set_to_none=True)
+    _zera_pico(device)
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        passo()
+        model.zero_grad(set_to_none=True)
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - inicio) / repeticoes, _le_pico(device)
+
+
+# Mede um passo de treinamento com e sem a recomputação e mostra a
+# comparação. Os pesos e as estatísticas da rede voltam ao que eram antes
+# (as medições não treinam a rede), assim como o estado da recomputação.
+#
+# A medição com recomputação é feita primeiro: na CPU o pico é da memória do
+# processo, e a memória liberada depois de uma medição nem sempre volta para
+# o sistema, o que esconderia a economia se a ordem fosse a inversa.
+def compara_recomputacao(model, passo, device, repeticoes=3):
+    estado = copy.deepcopy(model.state_dict())
+    ligada = any('forward' in vars(bloco) for bloco in blocos_resnet(model))
+    resultados = {}
+    for nome, ativa in (('com', True), ('sem', False)):
+        ativa_recomputacao(model, ativa)
+        tempo, pico = mede_passo(model, passo, device, repeticoes)
+        resultados[nome] = {'segundos_por_passo': tempo, 'pico_memoria': pico}
+    ativa_recomputacao(model, ligada)
+    model.load_state_dict(estado)
+
+    for nome in ('sem', 'com'):
+        pico = resultados[nome]['pico_memoria']
+        texto_pico = f"{pico/2**20:>8.0f} MB" if pico is not None else "   (não medido)"
+        print(f"{nome:>3} recomputação: {resultados[nome]['segundos_por_passo']:>7.3f} s/passo, pico {texto_pico}")
+    sem, com = resultados['sem'], resultados['com']
+    print(f"Com recomputação: {com['segundos_por_passo']/sem['segundos_por_passo']:>0.2f}x o tempo"
+          + (f", {com['pico_memoria']/sem['pico_memoria']:>0.2f}x a memória"
+             if sem['pico_memoria'] and com['pico_memoria'] else ""))
+    return resultados
@@ -0,0 +1,177 @@
+# Separa um banco de imagens (uma subpasta por classe) entre treino e teste
+#
+# Substitui o data/split_train_test.sh. Nenhuma imagem é copiada: as pastas
+# de treino e teste recebem links para os arquivos originais ou nem são
+# criadas (só o manifesto). Modos:
+#
+# - hardlink: cada arquivo ganha um segundo nome (não ocupa espaço extra, mas
+#   origem e destino precisam estar no mesmo disco)
+# - symlink: links simbólicos relativos (funcionam entre discos diferentes)
+# - manifesto: não cria pastas, apenas o manifesto (ver abaixo)
+#
+# Em todos os modos é gravado um manifesto no mesmo formato de
+# utilitarios/divisao.py, com os nomes "classe/arquivo" e o conjunto de cada
+# um (TREINO, TESTE ou -1 para as imagens que ficaram de fora por causa de
+# --max_treino).
+#
+# As classes são processadas em paralelo. A separação depende apenas da
+# semente, então rodar de novo com os mesmos parâmetros (por exemplo, depois
+# de uma interrupção) só cria os links que faltam e remove os que sobraram.
+#
+# Uso (a partir da pasta data/, como o script antigo):
+#
+#    python -m utilitarios.separa_treino_teste 70
+#    python -m utilitarios.separa_treino_teste 70 --max_treino 100 --modo symlink
+
+import argparse
+import errno
+import os
+import random
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from utilitarios.divisao import TREINO, TESTE, grava_manifesto
+
+FORA = -1  # Imagens que não entram em nenhum conjunto (--max_treino)
+
+
+# Sorteia o conjunto de cada arquivo de uma classe. O sorteio usa a semente
+# e o nome da classe, então não depende da ordem em que as classes são
+# processadas.
+def sorteia_classe(nomes, classe, perc_treino, max_treino=-1, semente=0):
+    embaralhados = sorted(nomes)
+    random.Random(f"{semente}/{classe}").shuffle(embaralhados)
+    total_treino = int(len(embaralhados)*perc_treino/100)
+    conjuntos = {nome: TESTE for nome in embaralhados[total_treino:]}
+    for i, nome in enumerate(embaralhados[:total_treino]):
+        conjuntos[nome] = TREINO if max_treino < 0 or i < max_treino else FORA
+    return conjuntos
+
+
+# Cria (ou mantém, se já estiver certo) o link "destino" para "origem".
+# Retorna True se precisou criar.
+def _cria_link(origem, destino, modo):
+    if modo == 'symlink':
+        alvo = os.path.relpath(origem, os.path.dirname(destino))
+        if os.path.islink(destino) and os.readlink(destino) == alvo:
+            return False
+    elif os.path.exists(destino) and not os.path.islink(destino) and os.path.samefile(origem, destino):
+        return False
+    if os.path.lexists(destino):
+        os.remove(destino)
+    if modo == 'symlink':
+        os.symlink(alvo, destino)
+        return True
+    try:
+        os.link(origem, destino)
+    except OSError as erro:
+        if erro.errno == errno.EXDEV:
+            raise OSError(erro.errno, "Hardlinks só funcionam no mesmo disco. Use --modo symlink",
+                          destino) from erro
+        raise
+    return True
+
+
+# Deixa a pasta "destino" com exatamente os arquivos de "nomes" (links para
+# os arquivos da pasta "origem"). Retorna quantos links foram criados e
+# quantos arquivos foram removidos.
+def _sincroniza_pasta(origem, destino, nomes, modo):
+    os.makedirs(destino, exist_ok=True)
+    criados = sum(_cria_link(os.path.join(origem, nome), os.path.join(destino, nome), modo)
+                  for nome in nomes)
+    removidos = 0
+    desejados = set(nomes)
+    with os.scandir(destino) as itens:
+        for item in itens:
+            if item.name not in desejados:
+                if item.is_dir(follow_symlinks=False):
+                    shutil.rmtree(item.path)
+                else:
+                    os.remove(item.path)
+                removidos += 1
+    return criados, removidos
+
+
+def _processa_classe(args, classe):
+    pasta_classe = os.path.join(args.origem, classe)
+    with os.scandir(pasta_classe) as itens:
+        nomes = [item.name for item in itens if item.is_file()]
+    conjuntos = sorteia_classe(nomes, classe, args.perc_treino, args.max_treino, args.semente)
+    resumo = {conjunto: sum(1 for c in conjuntos.values() if c == conjunto)
+              for conjunto in (TREINO, TESTE, FORA)}
+    if args.modo != 'manifesto':
+        for conjunto, pasta in ((TREINO, args.treino), (TESTE, args.teste)):
+            criados, removidos = _sincroniza_pasta(
+                pasta_classe, os.path.join(pasta, classe),
+                [nome for nome, c in conjuntos.items() if c == conjunto], args.modo)
+            resumo[f"criados_{conjunto}"] = criados
+            resumo[f"removidos_{conjunto}"] = removidos
+    return conjuntos, resumo
+
+
+# Remove das pastas de treino e teste as classes que não existem mais na origem
+def _remove_classes_antigas(pasta, classes):
+    if not os.path.isdir(pasta):
+        return
+    with os.scandir(pasta) as itens:
+        for item in itens:
+            if item.name not in classes:
+                print(f"Removendo {item.path} (não existe na origem)")
+                if item.is_dir(follow_symlinks=False):
+                    shutil.rmtree(item.path)
+                else:
+                    os.remove(item.path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Separa as imagens (uma subpasta por classe) "
+                                                 "entre treino e teste sem copiar arquivos.")
+    parser.add_argument('perc_treino', type=float, help="percentual de cada classe para treino")
+    parser.add_argument('--origem', default="./exemplos_peixes")
+    parser.add_argument('--treino', default="./train")
+    parser.add_argument('--teste', default="./test")
+    parser.add_argument('--max_treino', type=int, default=-1,
+                        help="máximo de imagens de treino por classe, para balancear (-1 = sem limite)")
+    parser.add_argument('--modo', choices=['hardlink', 'symlink', 'manifesto'], default='hardlink')
+    parser.add_argument('--semente', type=int, default=0)
+    parser.add_argument('--manifesto', help="arquivo do manifesto (padrão: divisao_treino_teste.npz "
+                                            "na pasta que contém a pasta de treino)")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="total de classes processadas ao mesmo tempo (padrão: automático)")
+    args = parser.parse_args(argv)
+    if args.manifesto is None:
+        args.manifesto = os.path.join(os.path.dirname(os.path.abspath(args.treino)),
+                                      "divisao_treino_teste.npz")
+
+    with os.scandir(args.origem) as itens:
+        classes = sorted(item.name for item in itens if item.is_dir())
+    if args.modo != 'manifesto':
+        for pasta in (args.treino, args.teste):
+            _remove_classes_antigas(pasta, set(classes))
+
+    nomes, conjuntos = [], []
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        for classe, (conjuntos_classe, resumo) in zip(
+                classes, executor.map(lambda classe: _processa_classe(args, classe), classes)):
+            linha = f"{classe}: {resumo[TREINO]} treino, {resumo[TESTE]} teste"
+            if resumo[FORA]:
+                linha += f", {resumo[FORA]} fora (max_treino)"
+            if args.modo != 'manifesto':
+                criados = resumo[f"criados_{TREINO}"] + resumo[f"criados_{TESTE}"]
+                removidos = resumo[f"removidos_{TREINO}"] + resumo[f"removidos_{TESTE}"]
+                linha += f" ({criados} links criados, {removidos} removidos)"
+            print(linha)
+            for nome in sorted(conjuntos_classe):
+                nomes.append(f"{classe}/{nome}")
+                conjuntos.append(conjuntos_classe[nome])
+
+    grava_manifesto(args.manifesto, {
+        'nomes': np.array(nomes, dtype=str), 'conjuntos': np.array(conjuntos, dtype=np.int8),
+        'parametros': np.array([args.semente, args.perc_treino, args.max_treino], dtype=np.float64)})
+    print("Manifesto salvo em", args.manifesto)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
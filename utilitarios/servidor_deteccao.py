@@ -0,0 +1,268 @@
+# Servidor local de detecção com a Faster R-CNN treinada no exemplo v6
+#
+# A rede é carregada uma única vez. As imagens chegam por HTTP (ou por um
+# socket Unix) e as requisições que chegam quase ao mesmo tempo são juntadas
+# em um único lote ("micro-lotes"): o lote é processado quando atinge
+# lote_maximo imagens ou quando a primeira imagem dele já esperou
+# latencia_maxima_ms, o que acontecer primeiro. Processar várias imagens de
+# uma vez aproveita melhor a CPU (ou a GPU) do que uma de cada vez.
+#
+# Requisições:
+#
+# - POST /detecta com o arquivo da imagem (JPEG, PNG, ...) no corpo.
+#   Retorna um JSON com boxes (xmin,ymin,xmax,ymax nas coordenadas da imagem
+#   enviada), labels, classes e scores. ?limiar=0.5 descarta as detecções
+#   com score menor.
+# - GET /estatisticas: latências (p50, p99), vazão e tamanho médio dos lotes
+#
+# Uso:
+#
+#    python -m utilitarios.servidor_deteccao --modelo ./data/modelo_treinado_faster.pth
+#    python -m utilitarios.servidor_deteccao --modelo ./data/modelo_treinado_faster.pth --socket /tmp/deteccao.sock
+#
+# Para testar a vazão, ver utilitarios/carga_deteccao.py
+
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import torch
+from utilitarios.decodificacao import decodifica_imagem
+from utilitarios.tarefas import TarefaDeteccao
+from utilitarios.transformacoes_lote import normaliza_imagens
+
+
+# Cria a rede (igual à do treinamento) e carrega os pesos treinados
+def carrega_detector(arquivo_modelo, classes, device="cpu"):
+    model = TarefaDeteccao({'nome_rede': 'faster', 'pre_treinada': False,
+                            'classes': classes}).cria_modelo()
+    model.load_state_dict(torch.load(arquivo_modelo, map_location=device))
+    return model.to(device).eval()
+
+
+# Decodifica a imagem e faz o mesmo pré-processamento do treinamento (RGB,
+# já redimensionada, ver utilitarios/decodificacao.py). Retorna o tensor
+# (uint8, os pixels são colocados entre 0 e 1 no lote inteiro) e o tamanho
+# original (largura, altura).
+def prepara_imagem(conteudo, largura, altura):
+    imagem, original = decodifica_imagem(conteudo, largura, altura)
+    return torch.from_numpy(imagem).permute(2, 0, 1), original
+
+
+# Latências e tamanhos dos lotes das últimas requisições
+class Estatisticas:
+    def __init__(self, maximo=10000):
+        self.trava = threading.Lock()
+        self.latencias = deque(maxlen=maximo)
+        self.lotes = deque(maxlen=maximo)
+        self.total = 0
+        self.inicio = None  # Chegada da primeira requisição
+
+    def registra_lote(self, tamanho):
+        with self.trava:
+            self.lotes.append(tamanho)
+
+    def registra_requisicao(self, latencia):
+        with self.trava:
+            if self.inicio is None:
+                self.inicio = time.perf_counter() - latencia
+            self.latencias.append(latencia)
+            self.total += 1
+
+    def resumo(self):
+        with self.trava:
+            latencias = np.array(self.latencias) * 1000
+            duracao = time.perf_counter() - self.inicio if self.inicio is not None else 0
+            resumo = {'requisicoes': self.total,
+                      'vazao_por_segundo': self.total / duracao if duracao > 0 else 0.0,
+                      'lote_medio': float(np.mean(self.lotes)) if self.lotes else 0.0}
+        if len(latencias):
+            resumo.update({'latencia_p50_ms': float(np.percentile(latencias, 50)),
+                           'latencia_p99_ms': float(np.percentile(latencias, 99)),
+                           'latencia_media_ms': float(latencias.mean())})
+        return resumo
+
+
+# Junta as imagens que chegam em micro-lotes e passa cada lote pela rede em
+# uma thread separada. detecta() pode ser chamada de várias threads ao mesmo
+# tempo (uma por requisição).
+class AgrupadorLotes:
+    def __init__(self, model, device="cpu", lote_maximo=8, latencia_maxima_ms=10,
+                 estatisticas=None):
+        self.model = model
+        self.device = device
+        self.lote_maximo = lote_maximo
+        self.latencia_maxima = latencia_maxima_ms / 1000
+        self.estatisticas = estatisticas or Estatisticas()
+        self.fila = queue.Queue()
+        self.thread = threading.Thread(target=self._laco, daemon=True)
+        self.thread.start()
+
+    # Detecta os objetos de uma imagem (tensor já preparado). Espera o lote
+    # em que ela entrou ser processado.
+    def detecta(self, imagem):
+        pendente = Future()
+        self.fila.put((imagem, pendente))
+        return pendente.result()
+
+    def _laco(self):
+        while True:
+            lote = [self.fila.get()]  # Espera a primeira imagem do lote
+            limite = time.perf_counter() + self.latencia_maxima
+            while len(lote) < self.lote_maximo:
+                restante = limite - time.perf_counter()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(self.fila.get(timeout=restante))
+                except queue.Empty:
+                    break
+            self._processa(lote)
+
+    def _processa(self, lote):
+        self.estatisticas.registra_lote(len(lote))
+        try:
+            with torch.inference_mode():
+                previsoes = self.model(normaliza_imagens([imagem for imagem, _ in lote], self.device))
+            for (_, pendente), previsao in zip(lote, previsoes):
+                pendente.set_result({chave: valor.cpu() for chave, valor in previsao.items()})
+        except Exception as erro:
+            for _, pendente in lote:
+                pendente.set_exception(erro)
+
+
+class _Requisicao(BaseHTTPRequestHandler):
+    # self.server.detector, self.server.classes, ... (ver cria_servidor)
+
+    # HTTP/1.1: a conexão continua aberta depois de cada resposta
+    # (keep-alive), então o cliente não precisa conectar de novo a cada
+    # imagem. Todas as respostas têm Content-Length (ver _responde).
+    protocol_version = "HTTP/1.1"
+
+    def _responde(self, codigo, dados):
+        corpo = json.dumps(dados).encode()
+        self.send_response(codigo)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/estatisticas':
+            self._responde(200, self.server.detector.estatisticas.resumo())
+        else:
+            self._responde(404, {'erro': 'use POST /detecta ou GET /estatisticas'})
+
+    def do_POST(self):
+        inicio = time.perf_counter()
+        url = urlparse(self.path)
+        # O corpo é lido sempre, mesmo quando a resposta é um erro: na
+        # conexão mantida aberta, o que sobrasse dele seria lido como a
+        # próxima requisição
+        conteudo = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/detecta':
+            self._responde(404, {'erro': 'use POST /detecta ou GET /estatisticas'})
+            return
+        try:
+            limiar = float(parse_qs(url.query).get('limiar', [self.server.limiar])[0])
+            imagem, (largura, altura) = prepara_imagem(conteudo, self.server.largura, self.server.altura)
+        except ValueError as erro:
+            self._responde(400, {'erro': str(erro)})
+            return
+        try:
+            previsao = self.server.detector.detecta(imagem)
+        except Exception as erro:  # Ex.: falta de memória na GPU
+            self._responde(500, {'erro': f"{type(erro).__name__}: {erro}"})
+            return
+        manter = previsao['scores'] >= limiar
+        # Volta os retângulos para as coordenadas da imagem enviada
+        escala = torch.tensor([largura/self.server.largura, altura/self.server.altura]*2)
+        labels = previsao['labels'][manter]
+        self._responde(200, {'boxes': (previsao['boxes'][manter]*escala).tolist(),
+                             'labels': labels.tolist(),
+                             'classes': [self.server.classes[label] for label in labels.tolist()],
+                             'scores': previsao['scores'][manter].tolist()})
+        self.server.detector.estatisticas.registra_requisicao(time.perf_counter()-inicio)
+
+    # Não mostra uma linha para cada requisição
+    def log_message(self, formato, *args):
+        pass
+
+
+class _ServidorUnix(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    # HTTPServer.server_bind espera um endereço (host, porta)
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = "localhost", 0
+
+    # O endereço do cliente em um socket Unix é vazio
+    def get_request(self):
+        conexao, _ = super().get_request()
+        return conexao, ("unix", 0)
+
+
+# Cria o servidor HTTP (porta TCP ou, se "socket_unix" for passado, um
+# arquivo de socket Unix)
+def cria_servidor(detector, classes, largura, altura, limiar=0.0, porta=8000, host="127.0.0.1",
+                  socket_unix=None):
+    if socket_unix is not None:
+        if os.path.exists(socket_unix):
+            os.remove(socket_unix)
+        servidor = _ServidorUnix(socket_unix, _Requisicao)
+    else:
+        servidor = ThreadingHTTPServer((host, porta), _Requisicao)
+    servidor.daemon_threads = True
+    servidor.detector, servidor.classes = detector, classes
+    servidor.largura, servidor.altura, servidor.limiar = largura, altura, limiar
+    return servidor
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servidor de detecção com micro-lotes.")
+    parser.add_argument('--modelo', required=True, help="arquivo .pth salvo pelo exemplo v6 ou pelo treina.py")
+    parser.add_argument('--classes', nargs='+', default=['fundo', 'conde'])
+    parser.add_argument('--largura', type=int, default=416, help="largura usada no treinamento")
+    parser.add_argument('--altura', type=int, default=416, help="altura usada no treinamento")
+    parser.add_argument('--limiar', type=float, default=0.0, help="score mínimo das detecções")
+    parser.add_argument('--lote_maximo', type=int, default=8)
+    parser.add_argument('--latencia_maxima_ms', type=float, default=10,
+                        help="espera máxima para completar um lote")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--porta', type=int, default=8000)
+    parser.add_argument('--socket', help="arquivo de socket Unix (no lugar da porta TCP)")
+    parser.add_argument('--threads_torch', type=int, default=None,
+                        help="threads usadas pelo pytorch na CPU (padrão: automático)")
+    args = parser.parse_args(argv)
+
+    if args.threads_torch is not None:
+        torch.set_num_threads(args.threads_torch)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    detector = AgrupadorLotes(carrega_detector(args.modelo, args.classes, device), device,
+                              args.lote_maximo, args.latencia_maxima_ms)
+    servidor = cria_servidor(detector, args.classes, args.largura, args.altura, args.limiar,
+                             args.porta, args.host, args.socket)
+    print(f"Usando {device}. Esperando imagens em "
+          f"{args.socket or f'http://{args.host}:{args.porta}'}/detecta")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        print("Estatísticas:", detector.estatisticas.resumo())
+    finally:
+        servidor.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
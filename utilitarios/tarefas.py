@@ -0,0 +1,285 @@
+# Tarefas (classificação, segmentação e detecção) usadas pelo motor de treino
+#
+# Cada tarefa sabe criar os bancos de imagens e a rede, e calcular a perda de
+# um lote, do mesmo jeito que os exemplos fazem:
+#
+# - classificacao: exemplo v4 (pastas train/ e test/ com uma subpasta por
+#   classe) ou v3 (FashionMNIST com redes pré-treinadas)
+# - segmentacao: exemplo v5 (subpastas imagens/ e anotacoes/)
+# - deteccao: exemplo v6 (imagens .jpg e anotações Pascal VOC .xml)
+#
+# O restante (épocas, validação, parada antecipada, salvar a melhor rede) é
+# igual para todas as tarefas e fica no motor (utilitarios/motor.py).
+#
+# O torchvision demora alguns segundos para ser importado, então só é
+# importado dentro dos métodos que o usam (e só a parte necessária: a
+# detecção não carrega as redes de segmentação, por exemplo).
+
+import os
+import torch
+from torch import nn
+from torch.utils.data import Subset
+from utilitarios.aumento_deteccao import AumentoDeteccao
+from utilitarios.avaliacao import avalia_deteccao, deteccoes_e_perdas
+from utilitarios.conjuntos import SegmentacaoDataset, DeteccaoDataset, junta_deteccao_empacotada
+from utilitarios.divisao import divide_com_manifesto, divide_pasta, PADRAO_IMAGENS
+from utilitarios.fragmentos import prepara_fragmentos
+from utilitarios.indice_voc import cria_indice_anotacoes
+from utilitarios.metricas import MatrizConfusao
+from utilitarios.transformacoes_lote import amplia_lote_cinza, prepara_lote_deteccao
+
+
+# Manifesto com a divisão entre treino, validação e teste (ver
+# utilitarios/divisao.py), salvo junto com a rede treinada
+def _arquivo_divisao(config):
+    return os.path.join(config['pasta_saida'], "divisao.npz")
+
+
+# Pesos pré-treinados na ImageNet (transfer learning) ou pesos aleatórios
+def _pesos(config):
+    return "DEFAULT" if config['pre_treinada'] else None
+
+
+# Parte comum das tarefas que avaliam o teste com uma matriz de confusão
+class _TarefaComMatriz:
+    criterio = 'acuracia'  # Parada antecipada acompanha a acurácia na validação
+    validacao_em_modo_treino = False
+    descarta_lote_incompleto = False  # Treina também com o último lote, mesmo incompleto
+    collate_fn = None
+    aumento = None  # Sem aumento de dados no lote (estado guardado nos checkpoints)
+
+    def __init__(self, config):
+        self.config = config
+        self.classes = config.get('classes')
+
+    # Coloca o lote no dispositivo (GPU ou CPU)
+    def prepara_lote(self, lote, device):
+        X, y = lote
+        return X.to(device, non_blocking=True), y.to(device, non_blocking=True)
+
+    # Calcula a matriz de confusão no conjunto de teste
+    def avalia_teste(self, model, lotes, device, modo):
+        matriz_confusao = MatrizConfusao(len(self.classes), device)
+        model.eval()
+        with torch.no_grad():
+            for lote in lotes:
+                X, y = self.prepara_lote(lote, device)
+                with modo.autocast():
+                    pred = self.predicao(model, modo.prepara_entrada(X))
+                matriz_confusao.atualiza(pred.argmax(1), y)
+        print(matriz_confusao.relatorio(self.classes))
+        resultados = matriz_confusao.calcula()
+        return {chave: float(resultados[chave]) for chave in ('acuracia', 'fscore_macro', 'iou_macro')}
+
+    # Perda, total de acertos e total de itens (imagens ou pixels) de um lote
+    def calcula(self, model, X, y):
+        pred = self.predicao(model, X)
+        loss = nn.functional.cross_entropy(pred, y.long())
+        return loss, (pred.argmax(1) == y).sum(), y.numel()
+
+
+class TarefaClassificacao(_TarefaComMatriz):
+    padrao = {'nome_rede': 'resnet', 'tamanho_imagens': 224, 'banco': 'pasta', 'usar_fragmentos': False}
+
+    def cria_conjuntos(self):
+        from torchvision import datasets
+        import torchvision.transforms as transforms
+        c = self.config
+        if c['banco'] == 'fashionmnist':
+            # Imagens pequenas (uint8, 28x28). O tamanho e os 3 canais das
+            # redes pré-treinadas são ajustados no lote (ver prepara_lote)
+            transform = transforms.PILToTensor()
+            treino_val = datasets.FashionMNIST(root=c['pasta_data'], train=True,
+                                               download=True, transform=transform)
+            teste = datasets.FashionMNIST(root=c['pasta_data'], train=False,
+                                          download=True, transform=transform)
+        elif c['banco'] == 'pasta' and c['usar_fragmentos']:
+            # Imagens já redimensionadas em poucos arquivos grandes (ver
+            # utilitarios/fragmentos.py)
+            tamanho = c['tamanho_imagens']
+            treino_val, teste = (prepara_fragmentos(os.path.join(c['pasta_data'], pasta),
+                                                    os.path.join(c['pasta_data'],
+                                                                 f"fragmentos_{pasta}_{tamanho}x{tamanho}"),
+                                                    tamanho, tamanho)
+                                 for pasta in ("train", "test"))
+        elif c['banco'] == 'pasta':
+            transform = transforms.Compose([transforms.Resize((c['tamanho_imagens'],c['tamanho_imagens'])),
+                                            transforms.ToTensor()])
+            treino_val = datasets.ImageFolder(root=os.path.join(c['pasta_data'], "train"),
+                                              transform=transform)
+            teste = datasets.ImageFolder(root=os.path.join(c['pasta_data'], "test"),
+                                         transform=transform)
+        else:
+            raise ValueError(f"banco deve ser 'pasta' ou 'fashionmnist', recebeu {c['banco']!r}")
+        self.classes = treino_val.classes
+        # Separa um percentual do treino para validação, mantendo a proporção
+        # de cada classe
+        if c['banco'] == 'pasta':
+            raiz = os.path.join(c['pasta_data'], "train")
+            nomes = [os.path.relpath(caminho, raiz) for caminho, _ in treino_val.samples]
+        else:
+            nomes = [str(i) for i in range(len(treino_val))]
+        idx_treino, idx_val, _ = divide_com_manifesto(_arquivo_divisao(c), nomes, 0, c['perc_val'],
+                                                      c['semente_divisao'],
+                                                      rotulos=[int(y) for y in treino_val.targets])
+        return Subset(treino_val, idx_treino), Subset(treino_val, idx_val), teste
+
+    def cria_modelo(self):
+        from torchvision import models
+        nome_rede, total_classes = self.config['nome_rede'], len(self.classes)
+        # Ajusta a última camada para o total de classes do problema atual
+        if nome_rede == "resnet":
+            model = models.resnet18(weights=_pesos(self.config))
+            model.fc = nn.Linear(model.fc.in_features, total_classes)
+        elif nome_rede == "squeezenet":
+            model = models.squeezenet1_0(weights=_pesos(self.config))
+            model.classifier[1] = nn.Conv2d(512, total_classes, kernel_size=(1,1), stride=(1,1))
+            model.num_classes = total_classes
+        elif nome_rede == "densenet":
+            model = models.densenet161(weights=_pesos(self.config))
+            model.classifier = nn.Linear(model.classifier.in_features, total_classes)
+        else:
+            raise ValueError(f"nome_rede deve ser 'resnet', 'squeezenet' ou 'densenet', recebeu {nome_rede!r}")
+        return model
+
+    def prepara_lote(self, lote, device):
+        X, y = super().prepara_lote(lote, device)
+        if self.config['banco'] == 'fashionmnist':
+            X = amplia_lote_cinza(X, self.config['tamanho_imagens'])
+        return X, y
+
+    def predicao(self, model, X):
+        return model(X)
+
+
+class TarefaSegmentacao(_TarefaComMatriz):
+    padrao = {'nome_rede': 'fcn', 'tamanho_imagens': 500, 'classes': ['fundo','cascavel']}
+    # Um lote de treino com uma única imagem dá erro na BatchNorm do pooling
+    # (ASPP) da deeplabv3, então o último lote é descartado se estiver incompleto
+    descarta_lote_incompleto = True
+
+    def cria_conjuntos(self):
+        import torchvision.transforms as transforms
+        c = self.config
+        transform = transforms.Compose([transforms.Resize((c['tamanho_imagens'],c['tamanho_imagens'])),
+                                        transforms.ToTensor()])
+        nomes_treino, nomes_val, nomes_teste = divide_pasta(os.path.join(c['pasta_data'], "imagens"),
+                                                            _arquivo_divisao(c), c['perc_teste'],
+                                                            c['perc_val'], c['semente_divisao'],
+                                                            padrao=PADRAO_IMAGENS)
+        return (SegmentacaoDataset(c['pasta_data'], nomes_treino, transform),
+                SegmentacaoDataset(c['pasta_data'], nomes_val, transform),
+                SegmentacaoDataset(c['pasta_data'], nomes_teste, transform))
+
+    def cria_modelo(self):
+        from torchvision.models import segmentation
+        nome_rede, total_classes = self.config['nome_rede'], len(self.classes)
+        # Muda a camada final para o total de classes do problema atual
+        if nome_rede == "deeplabv3":
+            model = segmentation.deeplabv3_resnet50(weights=_pesos(self.config),
+                                                    weights_backbone=_pesos(self.config))
+            model.classifier[4] = nn.Conv2d(256, total_classes, kernel_size=(1, 1), stride=(1, 1))
+        elif nome_rede == "fcn":
+            model = segmentation.fcn_resnet50(weights=_pesos(self.config),
+                                              weights_backbone=_pesos(self.config))
+            model.classifier[4] = nn.Conv2d(512, total_classes, kernel_size=(1, 1), stride=(1, 1))
+        else:
+            raise ValueError(f"nome_rede deve ser 'deeplabv3' ou 'fcn', recebeu {nome_rede!r}")
+        return model
+
+    def predicao(self, model, X):
+        return model(X)['out']
+
+
+class TarefaDeteccao:
+    # aumento = probabilidade de cada operação do aumento de dados no lote de
+    # treino (parâmetros do AumentoDeteccao, ver utilitarios/aumento_deteccao.py),
+    # os mesmos do exemplo v6
+    padrao = {'nome_rede': 'faster', 'largura_imagens': 416, 'altura_imagens': 416,
+              'classes': ['fundo','conde'], 'usar_cache': False,
+              'aumento': {'flip_horizontal': 0.5, 'flip_vertical': 0.5, 'rotacao_90': 0.5,
+                          'desfoque_movimento': 0.2, 'desfoque_mediana': 0.1, 'desfoque': 0.1},
+              'semente_aumento': 0}
+    criterio = 'map'  # Parada antecipada acompanha o mAP@[.5:.95] na validação (como o v6)
+    # A validação roda no modo de avaliação: as perdas são calculadas junto
+    # com as detecções (ver deteccoes_e_perdas em utilitarios/avaliacao.py)
+    validacao_em_modo_treino = False
+    descarta_lote_incompleto = False
+    # Lote em poucos tensores contíguos: uma cópia por campo para a GPU
+    collate_fn = staticmethod(junta_deteccao_empacotada)
+
+    def __init__(self, config):
+        self.config = config
+        self.classes = config['classes']
+        # Aumento de dados no lote inteiro, como no exemplo v6. A mesma
+        # semente gera sempre os mesmos sorteios. Quem só usa a rede (ex.:
+        # utilitarios/servidor_deteccao.py) pode passar uma configuração
+        # sem essas chaves.
+        self.aumento = AumentoDeteccao(**config.get('aumento', self.padrao['aumento']),
+                                       semente=config.get('semente_aumento', self.padrao['semente_aumento']))
+
+    def cria_conjuntos(self):
+        c = self.config
+        pasta = c['pasta_data']
+        indice = cria_indice_anotacoes(pasta, self.classes, os.path.join(pasta, "indice_anotacoes.npz"))
+        nomes_treino, nomes_val, nomes_teste = divide_pasta(pasta, _arquivo_divisao(c), c['perc_teste'],
+                                                            c['perc_val'], c['semente_divisao'],
+                                                            padrao="*.jpg")
+
+        def cria(nomes_conjunto, nome_conjunto):
+            arquivo_cache = None
+            if c['usar_cache']:
+                arquivo_cache = os.path.join(pasta, f"cache_{nome_conjunto}_{c['largura_imagens']}x{c['altura_imagens']}.bin")
+            return DeteccaoDataset(pasta, nomes_conjunto, c['largura_imagens'], c['altura_imagens'],
+                                   self.classes, None, arquivo_cache, indice)
+
+        # O aumento de dados do treino é feito depois, no lote (ver prepara_lote)
+        return cria(nomes_treino, 'treino'), cria(nomes_val, 'val'), cria(nomes_teste, 'teste')
+
+    def cria_modelo(self):
+        from torchvision.models.detection import fasterrcnn_resnet50_fpn
+        from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
+        if self.config['nome_rede'] != "faster":
+            raise ValueError(f"nome_rede deve ser 'faster', recebeu {self.config['nome_rede']!r}")
+        model = fasterrcnn_resnet50_fpn(weights=_pesos(self.config),
+                                        weights_backbone=_pesos(self.config))
+        # Altera a camada que faz a previsão das classes para o total de classes
+        total_atributos = model.roi_heads.box_predictor.cls_score.in_features
+        model.roi_heads.box_predictor = FastRCNNPredictor(total_atributos, len(self.classes))
+        return model
+
+    # Só é usado nos lotes de treino (a validação e o teste passam por
+    # avalia_deteccao), então sempre aplica o aumento de dados
+    def prepara_lote(self, lote, device):
+        # Aumento no lote inteiro e imagens uint8 -> float entre 0 e 1, já no dispositivo
+        return prepara_lote_deteccao(lote, device, self.aumento)
+
+    # Soma das perdas da rede (não tem acertos para contar)
+    def calcula(self, model, images, targets):
+        if model.training:
+            loss_dict = model(images, targets)
+        else:
+            loss_dict = deteccoes_e_perdas(model, images, targets)[1]
+        return sum(loss for loss in loss_dict.values()), None, None
+
+    # Perda média e mAP@[.5:.95] no conjunto de validação (uma única passada)
+    def valida(self, model, lotes, device, modo):
+        with modo.autocast():
+            acumulador, perda = avalia_deteccao(model, lotes, len(self.classes), device,
+                                                calcula_perda=True)
+        return perda, acumulador.calcula()['map']
+
+    # Perda média e mAP no conjunto de teste (uma única passada)
+    def avalia_teste(self, model, lotes, device, modo):
+        with modo.autocast():
+            acumulador, perda = avalia_deteccao(model, lotes, len(self.classes), device,
+                                                calcula_perda=True)
+        print(acumulador.relatorio(self.classes))
+        resultados = acumulador.calcula()
+        return {'perda': perda,
+                'map_50': resultados['map_50'], 'map': resultados['map']}
+
+
+TAREFAS = {'classificacao': TarefaClassificacao,
+           'segmentacao': TarefaSegmentacao,
+           'deteccao': TarefaDeteccao}
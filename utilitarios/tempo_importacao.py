@@ -0,0 +1,113 @@
+# Mede o tempo de importação ("partida a frio") dos módulos de utilitarios
+#
+# Cada módulo é importado em um processo python novo (sem nada em cache na
+# memória do interpretador), várias vezes, e é mostrada a mediana. Também
+# mostra quais bibliotecas pesadas (gráficos, métricas, aumento de dados,
+# detecção) foram carregadas junto, o que não deveria acontecer: elas só
+# devem ser importadas quando a funcionalidade correspondente for usada.
+#
+# Uso:
+#
+#    python -m utilitarios.tempo_importacao
+#    python -m utilitarios.tempo_importacao utilitarios.motor --repeticoes 10
+#    python -m utilitarios.tempo_importacao --salva tempos_base.json
+#    python -m utilitarios.tempo_importacao --compara tempos_base.json
+#
+# Com --compara, termina com erro (código 1) se algum módulo ficou mais lento
+# que a referência além da tolerância, para ser usado em testes automáticos.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+MODULOS_PADRAO = ['utilitarios.motor', 'utilitarios.tarefas', 'utilitarios.conjuntos',
+                  'utilitarios.cache_deteccao', 'utilitarios.indice_voc', 'utilitarios.metricas',
+                  'utilitarios.avaliacao', 'utilitarios.carregadores', 'utilitarios.precisao',
+                  'utilitarios.transformacoes_lote', 'utilitarios.checkpoint',
+                  'utilitarios.divisao', 'utilitarios.separa_treino_teste',
+                  'utilitarios.converte_labelme', 'utilitarios.fragmentos',
+                  'utilitarios.servidor_deteccao', 'utilitarios.carga_deteccao',
+                  'utilitarios.decodificacao', 'utilitarios.aumento_deteccao',
+                  'utilitarios.acumulacao', 'utilitarios.recomputacao']
+
+# Bibliotecas que só devem ser carregadas quando forem usadas
+PESADAS = ['torchvision', 'torchvision.models.detection', 'sklearn', 'cv2', 'albumentations',
+           'matplotlib', 'seaborn', 'pandas', 'torch.utils.tensorboard']
+
+# O torch é necessário para todos os módulos. O tempo dele é medido antes e
+# descontado, para mostrar apenas o custo do próprio módulo.
+_CODIGO = '''
+import json, sys, time
+import torch
+inicio = time.perf_counter()
+import {modulo}
+tempo = time.perf_counter() - inicio
+print(json.dumps({{'tempo': tempo, 'pesadas': [m for m in {pesadas!r} if m in sys.modules]}}))
+'''
+
+
+# Importa um módulo em um processo novo "repeticoes" vezes
+#
+# Retorna a mediana do tempo (segundos) e as bibliotecas pesadas carregadas
+def mede_modulo(modulo, repeticoes=5):
+    pasta_raiz = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    codigo = _CODIGO.format(modulo=modulo, pesadas=PESADAS)
+    tempos, pesadas = [], []
+    for _ in range(repeticoes):
+        saida = subprocess.run([sys.executable, '-c', codigo], cwd=pasta_raiz,
+                               capture_output=True, text=True)
+        if saida.returncode != 0:
+            raise RuntimeError(f"Erro ao importar {modulo}:\n{saida.stderr}")
+        resultado = json.loads(saida.stdout.strip().splitlines()[-1])
+        tempos.append(resultado['tempo'])
+        pesadas = resultado['pesadas']
+    return statistics.median(tempos), pesadas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mede o tempo de importação dos módulos.")
+    parser.add_argument('modulos', nargs='*', default=MODULOS_PADRAO)
+    parser.add_argument('--repeticoes', type=int, default=5)
+    parser.add_argument('--salva', help="salva os tempos em um arquivo JSON (referência)")
+    parser.add_argument('--compara', help="compara com os tempos de um arquivo JSON")
+    parser.add_argument('--tolerancia', type=float, default=0.25,
+                        help="aumento relativo permitido em --compara (0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    referencia = {}
+    if args.compara:
+        with open(args.compara) as f:
+            referencia = json.load(f)
+
+    tempos = {}
+    piorou = []
+    largura = max(len(modulo) for modulo in args.modulos)
+    for modulo in args.modulos:
+        tempo, pesadas = mede_modulo(modulo, args.repeticoes)
+        tempos[modulo] = tempo
+        linha = f"{modulo:<{largura}} {1000*tempo:>8.1f} ms"
+        if modulo in referencia:
+            base = referencia[modulo]
+            linha += f"  (referência {1000*base:>8.1f} ms)"
+            # Diferenças de poucos milissegundos são apenas ruído
+            if tempo > base*(1+args.tolerancia) and tempo-base > 0.02:
+                piorou.append(modulo)
+                linha += "  MAIS LENTO"
+        if pesadas:
+            linha += "  carrega: " + ", ".join(pesadas)
+        print(linha)
+
+    if args.salva:
+        with open(args.salva, 'w') as f:
+            json.dump(tempos, f, indent=2)
+    if piorou:
+        print("Ficaram mais lentos que a referência:", ", ".join(piorou))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+# Transformações aplicadas no lote inteiro (e não imagem por imagem)
+#
+# Quando o Dataset já entrega as imagens no tamanho e formato da rede (por
+# exemplo, 3x224x224 em float), cada imagem ocupa muito mais memória que a
+# original e é copiada várias vezes (dataset -> processo de carregamento ->
+# lote -> GPU). Aqui o lote viaja pequeno (uint8, tamanho original) e só é
+# convertido no dispositivo que vai processá-lo, de uma vez só.
+
+import torch
+import torch.nn.functional as F
+from utilitarios.conjuntos import LoteDeteccao, anotacoes_lote, junta_deteccao_empacotada
+
+
+# Converte um lote de imagens em tons de cinza (uint8, lote x 1 x A x L,
+# como o gerado pela transforms.PILToTensor) para o formato das redes
+# pré-treinadas na ImageNet: float entre 0 e 1, tamanho x tamanho e 3 canais.
+#
+# X = lote de imagens (já no dispositivo, de preferência)
+# tamanho = altura e largura finais
+#
+# Os 3 canais são uma "visão" (expand) do canal cinza, sem cópia na memória.
+def amplia_lote_cinza(X, tamanho):
+    X = X.float().div_(255)  # Mesma escala da transforms.ToTensor
+    # Bilinear, como a transforms.Resize usada antes imagem por imagem
+    X = F.interpolate(X, size=(tamanho, tamanho), mode='bilinear', align_corners=False)
+    return X.expand(-1, 3, -1, -1)
+
+
+# Leva as imagens de um lote de detecção (tupla de tensores uint8 C x A x L,
+# como os entregues pelo DeteccaoDataset) para o dispositivo e coloca os
+# pixels entre 0 e 1. Imagens do mesmo tamanho são empilhadas e convertidas
+# de uma vez só no dispositivo.
+#
+# Retorna uma lista de tensores (float), como as redes de detecção esperam
+def normaliza_imagens(images, device):
+    if torch.is_tensor(images):  # Lote já empilhado (LoteDeteccao.imagens)
+        return list(_normaliza(images.to(device, non_blocking=True)).unbind(0))
+    images = [image.to(device, non_blocking=True) for image in images]
+    if len({image.shape for image in images}) == 1:
+        return list(_normaliza(torch.stack(images)).unbind(0))
+    return [_normaliza(image) for image in images]
+
+
+def _normaliza(X):
+    if X.dtype == torch.uint8:
+        return X.float().div_(255)
+    return X.float()
+
+
+# Leva um lote de detecção (empacotado ou não, ver conjuntos.py) para o
+# dispositivo. Retorna (imagens, anotações) no formato das redes de detecção
+# do torchvision: lista de imagens float entre 0 e 1 e lista de dicionários.
+#
+# O lote empacotado é copiado com uma cópia por campo (non_blocking, a
+# partir da memória fixa) e só depois separado por imagem, no dispositivo.
+#
+# aumento = aumento de dados aplicado no lote inteiro, já no dispositivo
+#           (AumentoDeteccao, ver utilitarios/aumento_deteccao.py)
+def prepara_lote_deteccao(lote, device, aumento=None):
+    if aumento is not None and not isinstance(lote, LoteDeteccao):
+        lote = junta_deteccao_empacotada(list(zip(*lote)))
+    if isinstance(lote, LoteDeteccao):
+        no_dispositivo = LoteDeteccao(*(campo.to(device, non_blocking=True) for campo in lote[:-1]),
+                                      lote.inicios)
+        if aumento is not None:
+            no_dispositivo = aumento(no_dispositivo)
+        return normaliza_imagens(no_dispositivo.imagens, device), anotacoes_lote(no_dispositivo)
+    images, targets = lote
+    return (normaliza_imagens(images, device),
+            [{k: v.to(device, non_blocking=True) for k, v in t.items()} for t in targets])